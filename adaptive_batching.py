@@ -0,0 +1,162 @@
+import logging
+import threading
+from typing import Any, Dict, Iterable, Iterator, Optional, Sequence, Tuple, Union
+
+import pandas as pd
+
+from metrics import PipelineMetrics, available_memory_bytes
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+# Batch size target when neither a byte size nor a latency is given
+DEFAULT_TARGET_BYTES = 32 * 1024 * 1024
+
+def estimate_bytes(data: Union[pd.DataFrame, Sequence[Dict]]) -> int:
+    """Approximate in-memory size of a batch (DataFrame or list of row dicts)"""
+    if isinstance(data, pd.DataFrame):
+        return int(data.memory_usage(index=False, deep=True).sum())
+    total = 0
+    for row in data:
+        for value in row.values():
+            # Strings dominate; everything else counts as one 8 byte value
+            total += len(value) if isinstance(value, (str, bytes)) else 8
+    return total
+
+class AdaptiveBatcher:
+    """Batch size controller targeting a byte size or a write latency per batch
+
+    After every write, record() gets the batch's size in items (rows or
+    texts, whatever the caller counts), its bytes and how long it took.
+    The controller keeps moving averages of bytes and seconds per item and
+    moves the batch size towards the size that hits target_bytes (or
+    target_seconds, or the smaller of the two when both are set), by at
+    most a factor of growth per step and within [min_size, max_size].
+    One batch may take at most memory_fraction of the available memory,
+    and below min_free_bytes of available memory the size is halved.
+    Every change is logged with the reason. Safe to call from several
+    writer threads.
+    """
+
+    def __init__(self, initial_size: int = 1000, min_size: int = 100, max_size: int = 1000000,
+                 target_bytes: Optional[int] = None, target_seconds: Optional[float] = None,
+                 min_free_bytes: int = 512 * 1024 * 1024, memory_fraction: float = 0.25,
+                 growth: float = 2.0, smoothing: float = 0.3, name: str = 'batch',
+                 metrics: Optional[PipelineMetrics] = None):
+        if target_bytes is None and target_seconds is None:
+            target_bytes = DEFAULT_TARGET_BYTES
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_bytes = target_bytes
+        self.target_seconds = target_seconds
+        self.min_free_bytes = min_free_bytes
+        self.memory_fraction = memory_fraction
+        self.growth = growth
+        self.smoothing = smoothing
+        self.name = name
+        self.metrics = metrics
+        self.size = min(max(initial_size, min_size), max_size)
+        self.bytes_per_item: Optional[float] = None
+        self.seconds_per_item: Optional[float] = None
+        self._lock = threading.Lock()
+        self._set_gauge()
+
+    def _set_gauge(self) -> None:
+        if self.metrics is not None:
+            self.metrics.set_gauge('batch_size', self.size, batch=self.name)
+
+    def _average(self, current: Optional[float], value: float) -> float:
+        return value if current is None else (1 - self.smoothing) * current + self.smoothing * value
+
+    def _target_size(self) -> Tuple[float, str]:
+        """Size that meets the targets given the averages so far, and why"""
+        candidates = []
+        if self.target_bytes is not None and self.bytes_per_item:
+            candidates.append((self.target_bytes / self.bytes_per_item, 'target bytes'))
+        if self.target_seconds is not None and self.seconds_per_item:
+            candidates.append((self.target_seconds / self.seconds_per_item, 'target latency'))
+        if not candidates:
+            return self.size, 'no measurements'
+        return min(candidates)
+
+    def record(self, items: int, nbytes: int, seconds: float) -> int:
+        """Account for one written batch and return the new batch size"""
+        if items <= 0:
+            return self.size
+        with self._lock:
+            self.bytes_per_item = self._average(self.bytes_per_item, nbytes / items)
+            self.seconds_per_item = self._average(self.seconds_per_item, seconds / items)
+            target, reason = self._target_size()
+
+            # Memory headroom
+            available = available_memory_bytes()
+            if available is not None and self.bytes_per_item:
+                if available < self.min_free_bytes:
+                    target, reason = self.size / 2, f'only {available / 2 ** 20:.0f} MB memory available'
+                else:
+                    memory_cap = (available - self.min_free_bytes) * self.memory_fraction / self.bytes_per_item
+                    if memory_cap < target:
+                        target, reason = memory_cap, f'memory headroom ({available / 2 ** 20:.0f} MB available)'
+
+            # Bounded step, ignoring changes under 10% so the size doesn't jitter
+            target = min(max(target, self.size / self.growth), self.size * self.growth)
+            new_size = int(min(max(target, self.min_size), self.max_size))
+            if abs(new_size - self.size) < 0.1 * self.size:
+                return self.size
+            logging.info(
+                f"Adaptive {self.name} size {self.size} -> {new_size} ({reason}): "
+                f"{self.bytes_per_item:.0f} bytes and {self.seconds_per_item * 1000:.3f} ms per item, "
+                f"last batch {items} items, {nbytes / 2 ** 20:.1f} MB in {seconds:.3f} seconds "
+                f"({items / max(seconds, 1e-9):.0f} items/sec)"
+            )
+            self.size = new_size
+            self._set_gauge()
+            return self.size
+
+def rebatch_frames(frames: Iterable[pd.DataFrame], batcher: AdaptiveBatcher) -> Iterator[pd.DataFrame]:
+    """Re-slice a stream of DataFrames into batches of batcher.size rows
+
+    The size is read again for every batch, so changes made by record()
+    apply to the next batch that is cut.
+    """
+    buffer = []
+    buffered = 0
+    for frame in frames:
+        start = 0
+        while start < len(frame):
+            # Writer threads may change the size at any time
+            size = batcher.size
+            take = min(max(size - buffered, 0), len(frame) - start)
+            if take:
+                buffer.append(frame.iloc[start:start + take])
+                buffered += take
+                start += take
+            if buffered >= size:
+                yield pd.concat(buffer, ignore_index=True) if len(buffer) > 1 else buffer[0]
+                buffer = []
+                buffered = 0
+    if buffer:
+        yield pd.concat(buffer, ignore_index=True) if len(buffer) > 1 else buffer[0]
+
+def batcher_from_params(params: Any, initial_size: int, name: str = 'batch',
+                        metrics: Optional[PipelineMetrics] = None) -> Optional[AdaptiveBatcher]:
+    """AdaptiveBatcher configured from the --adaptive_batching flags, or None when it is off
+
+    params is an argparse Namespace or a dict.
+    """
+    get = params.get if isinstance(params, dict) else (lambda key, default=None: getattr(params, key, default))
+    if not get('adaptive_batching'):
+        return None
+    target_mb = get('target_batch_mb')
+    return AdaptiveBatcher(
+        initial_size,
+        get('min_batch_size') or 100,
+        get('max_batch_size') or 1000000,
+        target_mb * 1024 * 1024 if target_mb else None,
+        get('target_batch_seconds'),
+        (get('min_free_memory_mb') or 512) * 1024 * 1024,
+        name=name,
+        metrics=metrics
+    )
@@ -0,0 +1,55 @@
+import argparse
+import logging
+import os
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+TOKENIZER_NAME = 'bert-base-uncased'
+
+def get_artifacts_dir(artifacts_dir: str = None) -> str:
+    """Directory of the pinned tokenizer and nltk data (PIPELINE_ARTIFACTS_DIR by default)"""
+    return artifacts_dir or os.environ.get('PIPELINE_ARTIFACTS_DIR')
+
+def is_offline(offline: bool = None) -> bool:
+    """Offline mode never touches the network (PIPELINE_OFFLINE=1 by default)"""
+    if offline is not None:
+        return offline
+    return os.environ.get('PIPELINE_OFFLINE', '').lower() in ('1', 'true', 'yes')
+
+def tokenizer_path(artifacts_dir: str) -> str:
+    return os.path.join(artifacts_dir, 'tokenizer', TOKENIZER_NAME)
+
+def nltk_data_path(artifacts_dir: str) -> str:
+    return os.path.join(artifacts_dir, 'nltk_data')
+
+def download_artifacts(artifacts_dir: str) -> None:
+    """Download the tokenizer and punkt once so later runs can load them offline"""
+    from transformers import AutoTokenizer
+    import nltk
+
+    tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_NAME)
+    tokenizer.save_pretrained(tokenizer_path(artifacts_dir))
+    logging.info(f"Saved tokenizer {TOKENIZER_NAME} to {tokenizer_path(artifacts_dir)}")
+
+    if not nltk.download('punkt', download_dir=nltk_data_path(artifacts_dir)):
+        raise RuntimeError("Failed to download nltk punkt")
+    logging.info(f"Saved nltk punkt to {nltk_data_path(artifacts_dir)}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download the tokenizer and nltk data for offline runs')
+    parser.add_argument('--dir', required=True, help='Directory to store the artifacts in')
+
+    args = parser.parse_args()
+
+    try:
+        download_artifacts(args.dir)
+    except Exception as e:
+        logging.error(str(e))
+        exit(1)
+
+# cmd
+# python artifacts.py --dir=/opt/pipeline-artifacts
@@ -0,0 +1,190 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Dict, Optional
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+# Bytes read at a time when checksumming a file
+CHECKSUM_READ_SIZE = 1 << 20
+
+def file_checksums(path: str) -> Dict[str, str]:
+    """crc32c (when google-crc32c is installed) and md5 of a file, base64 like GCS reports them"""
+    try:
+        import google_crc32c
+        crc = google_crc32c.Checksum()
+    except ImportError:
+        crc = None
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHECKSUM_READ_SIZE), b''):
+            md5.update(block)
+            if crc is not None:
+                crc.update(block)
+    checksums = {'md5': base64.b64encode(md5.digest()).decode('ascii')}
+    if crc is not None:
+        checksums['crc32c'] = base64.b64encode(crc.digest()).decode('ascii')
+    return checksums
+
+def checksums_match(path: str, crc32c: Optional[str] = None, md5: Optional[str] = None) -> bool:
+    """Compare a file with the object's checksums
+
+    crc32c is preferred: composed objects have no md5. When neither can be
+    compared the file is accepted.
+    """
+    if not crc32c and not md5:
+        return True
+    actual = file_checksums(path)
+    if crc32c and 'crc32c' in actual:
+        return actual['crc32c'] == crc32c
+    if md5:
+        return actual['md5'] == md5
+    logging.debug(f"No checksum to compare for {path} (install google-crc32c)")
+    return True
+
+class BlobCache:
+    """Size-bounded local disk cache of downloaded bucket objects
+
+    Entries are keyed by bucket, object name and generation, so a new
+    version of an object is never served from an old copy. Every entry is
+    stored with the checksums of the object and checked again when it is
+    served (verify_hits); a corrupt file is dropped and downloaded again.
+    When the cache grows over max_bytes the least recently used entries are
+    deleted, except pinned ones (files a reader is about to open or is
+    reading, see pin/unpin); pinned entries may take the cache over its
+    limit until they are unpinned. Several processes can share a directory,
+    pins are only known to the process that made them.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 10 * 1024 * 1024 * 1024, verify_hits: bool = True):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.verify_hits = verify_hits
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # Entry path -> number of readers holding it
+        self._pinned: Dict[str, int] = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def path_for(self, bucket_name: str, blob_name: str, generation: Optional[int] = None) -> str:
+        """Local path of an object's entry"""
+        key = hashlib.sha256(f"{bucket_name}/{blob_name}#{generation}".encode('utf-8')).hexdigest()
+        # Keep the extension, the readers pick the format from it
+        return os.path.join(self.directory, key + os.path.splitext(blob_name)[1])
+
+    def _meta_path(self, path: str) -> str:
+        return f"{path}.json"
+
+    def _remove(self, path: str) -> None:
+        for stale in (path, self._meta_path(path)):
+            try:
+                os.remove(stale)
+            except FileNotFoundError:
+                pass
+
+    def pin(self, bucket_name: str, blob_name: str, generation: Optional[int] = None) -> str:
+        """Keep an entry (present or still to be downloaded) from being evicted; return its path"""
+        path = self.path_for(bucket_name, blob_name, generation)
+        with self._lock:
+            self._pinned[path] = self._pinned.get(path, 0) + 1
+        return path
+
+    def unpin(self, bucket_name: str, blob_name: str, generation: Optional[int] = None) -> None:
+        """Release a pin; the entry can be evicted again once nobody holds it"""
+        path = self.path_for(bucket_name, blob_name, generation)
+        with self._lock:
+            count = self._pinned.get(path, 0) - 1
+            if count > 0:
+                self._pinned[path] = count
+            else:
+                self._pinned.pop(path, None)
+
+    def get(self, bucket_name: str, blob_name: str, generation: Optional[int] = None) -> Optional[str]:
+        """Path of a valid cached copy, None on a miss"""
+        path = self.path_for(bucket_name, blob_name, generation)
+        try:
+            with open(self._meta_path(path)) as f:
+                meta = json.load(f)
+            size = os.path.getsize(path)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        if size != meta.get('size') or (
+                self.verify_hits and not checksums_match(path, meta.get('crc32c'), meta.get('md5'))):
+            logging.warning(f"Cached copy of gs://{bucket_name}/{blob_name} is corrupt, downloading it again")
+            self._remove(path)
+            with self._lock:
+                self.misses += 1
+            return None
+
+        # Mark as recently used for the eviction
+        os.utime(path)
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def put(self, downloaded_path: str, bucket_name: str, blob_name: str, generation: Optional[int] = None,
+            crc32c: Optional[str] = None, md5: Optional[str] = None) -> str:
+        """Move a downloaded (and checked) file into the cache and return its path"""
+        path = self.path_for(bucket_name, blob_name, generation)
+        meta = {
+            'bucket': bucket_name,
+            'name': blob_name,
+            'generation': generation,
+            'size': os.path.getsize(downloaded_path),
+            'crc32c': crc32c,
+            'md5': md5
+        }
+        os.replace(downloaded_path, path)
+        tmp_meta = f"{self._meta_path(path)}.tmp"
+        with open(tmp_meta, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_meta, self._meta_path(path))
+        self.evict()
+        return path
+
+    def temp_path(self, bucket_name: str, blob_name: str, generation: Optional[int] = None) -> str:
+        """Where a download in progress is written, next to its final place"""
+        return f"{self.path_for(bucket_name, blob_name, generation)}.{os.getpid()}.{threading.get_ident()}.download"
+
+    def evict(self) -> int:
+        """Delete least recently used unpinned entries until the cache fits max_bytes; return bytes freed"""
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            # Only finished entries; downloads in progress are not counted
+            if name.endswith(('.json', '.tmp', '.download', '.partial')):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        with self._lock:
+            pinned = set(self._pinned)
+        freed = 0
+        for _, size, path in sorted(entries):
+            if total - freed <= self.max_bytes:
+                break
+            if path in pinned:
+                continue
+            self._remove(path)
+            freed += size
+        if freed:
+            logging.info(f"Evicted {freed / 2 ** 20:.1f} MB from the download cache {self.directory}")
+        return freed
+
+    def stats(self) -> Dict:
+        return {'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,300 @@
+import io
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import pandas as pd
+from psycopg2 import errors, sql
+from psycopg2.extras import execute_batch
+
+from metrics import PipelineMetrics, stage_timer
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+# Errors that mean the server (or a proxy in front of it) refuses COPY
+COPY_NOT_PERMITTED = (errors.InsufficientPrivilege, errors.FeatureNotSupported)
+
+# Characters handed to COPY per read of the row stream
+COPY_READ_SIZE = 1 << 16
+
+
+def _to_copy_field(value: Any) -> str:
+    """Format one value as a field of the CSV COPY format
+
+    Strings are always quoted so an empty string stays an empty string, while
+    an unquoted empty field is read by COPY as NULL.
+    """
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return '"' + value.replace('"', '""') + '"'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, float):
+        return '' if value != value else repr(float(value))
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        # bytea hex format
+        return '\\x' + bytes(value).hex()
+    if pd.isna(value):
+        return ''
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def _to_db_value(value: Any) -> Any:
+    """Convert numpy/pandas scalars to python values for the insert fallback"""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value)
+    if value is None or isinstance(value, str):
+        return value
+    if pd.isna(value):
+        return None
+    return value.item() if hasattr(value, 'item') else value
+
+
+class _CsvRowStream(io.TextIOBase):
+    """File-like object that serializes rows to CSV while COPY reads from it"""
+
+    def __init__(self, rows: Iterator[Tuple]):
+        self._rows = rows
+        self._pending = ''
+        self._done = False
+        self.rows_written = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def _fill(self, size: int) -> None:
+        """Serialize rows until at least size characters are pending"""
+        lines = []
+        pending_size = len(self._pending)
+        while not self._done and (size < 0 or pending_size < size):
+            try:
+                row = next(self._rows)
+            except StopIteration:
+                self._done = True
+                break
+            line = ','.join([_to_copy_field(value) for value in row]) + '\n'
+            lines.append(line)
+            pending_size += len(line)
+            self.rows_written += 1
+        self._pending += ''.join(lines)
+
+    def read(self, size: int = -1) -> str:
+        if size is None or size < 0:
+            self._fill(-1)
+            data, self._pending = self._pending, ''
+        else:
+            self._fill(size)
+            data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+
+class BulkWriter:
+    """Bulk load batches into Postgres with COPY FROM STDIN
+
+    Rows are serialized straight from the DataFrame or the list of dicts into
+    the COPY stream, so nothing is written to disk. When the server does not
+    allow COPY the writer falls back to batched executemany inserts.
+    """
+
+    def __init__(self, engine: Any, use_copy: bool = True, page_size: int = 1000):
+        self.engine = engine
+        self.use_copy = use_copy
+        self.page_size = page_size
+        self.total_rows = 0
+        self.total_seconds = 0.0
+
+    @staticmethod
+    def _resolve_columns(data: Union[pd.DataFrame, Sequence[Dict]], columns: Optional[List[str]]) -> List[str]:
+        if columns is not None:
+            return list(columns)
+        if isinstance(data, pd.DataFrame):
+            return [str(column) for column in data.columns]
+        return list(data[0].keys()) if len(data) else []
+
+    @staticmethod
+    def _iter_rows(data: Union[pd.DataFrame, Iterable[Dict]], columns: List[str]) -> Iterator[Tuple]:
+        """Yield each row as a tuple in column order"""
+        if isinstance(data, pd.DataFrame):
+            yield from data[columns].itertuples(index=False, name=None)
+        else:
+            for row in data:
+                yield tuple(row.get(column) for column in columns)
+
+    def prepare_table(self, table_name: str, df: pd.DataFrame, if_exists: str = 'replace') -> None:
+        """Create an empty table with the schema pandas would create for df"""
+        df.head(0).to_sql(table_name, self.engine, if_exists=if_exists, index=False)
+
+    def _copy(self, cursor, table_name: str, columns: List[str], rows: Iterator[Tuple]) -> int:
+        query = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(
+            sql.Identifier(table_name),
+            sql.SQL(', ').join(map(sql.Identifier, columns))
+        )
+        stream = _CsvRowStream(rows)
+        cursor.copy_expert(query.as_string(cursor), stream, size=COPY_READ_SIZE)
+        return stream.rows_written
+
+    def _copy_skip_conflicts(self, cursor, table_name: str, columns: List[str], rows: Iterator[Tuple]) -> int:
+        """COPY into a temporary staging table, then insert what does not conflict"""
+        stage_name = f"{table_name}_stage"
+        column_list = sql.SQL(', ').join(map(sql.Identifier, columns))
+        cursor.execute(sql.SQL("CREATE TEMP TABLE {} ON COMMIT DROP AS SELECT {} FROM {} WITH NO DATA").format(
+            sql.Identifier(stage_name), column_list, sql.Identifier(table_name)
+        ))
+        rows_written = self._copy(cursor, stage_name, columns, rows)
+        cursor.execute(sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {} ON CONFLICT DO NOTHING").format(
+            sql.Identifier(table_name), column_list, column_list, sql.Identifier(stage_name)
+        ))
+        if cursor.rowcount < rows_written:
+            logging.info(f"Skipped {rows_written - cursor.rowcount} rows already in {table_name}")
+        return rows_written
+
+    def _insert(self, cursor, table_name: str, columns: List[str], rows: Iterator[Tuple],
+                skip_conflicts: bool = False) -> int:
+        query = sql.SQL("INSERT INTO {} ({}) VALUES ({}){}").format(
+            sql.Identifier(table_name),
+            sql.SQL(', ').join(map(sql.Identifier, columns)),
+            sql.SQL(', ').join(sql.Placeholder() * len(columns)),
+            sql.SQL(" ON CONFLICT DO NOTHING" if skip_conflicts else "")
+        )
+        values = [tuple(_to_db_value(value) for value in row) for row in rows]
+        execute_batch(cursor, query.as_string(cursor), values, page_size=self.page_size)
+        return len(values)
+
+    def write(self, table_name: str, data: Union[pd.DataFrame, Sequence[Dict]], columns: Optional[List[str]] = None,
+              skip_conflicts: bool = False) -> int:
+        """Write a DataFrame or a list of row dicts into table_name and return the row count
+
+        With skip_conflicts rows that violate a unique index are skipped
+        (ON CONFLICT DO NOTHING), so a batch can be written again safely.
+        """
+        columns = self._resolve_columns(data, columns)
+        if not columns or len(data) == 0:
+            return 0
+
+        t_start = time()
+        conn = self.engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            if self.use_copy:
+                try:
+                    copy = self._copy_skip_conflicts if skip_conflicts else self._copy
+                    rows_written = copy(cursor, table_name, columns, self._iter_rows(data, columns))
+                except COPY_NOT_PERMITTED as e:
+                    conn.rollback()
+                    logging.warning(f"COPY not permitted ({str(e).strip()}), falling back to executemany")
+                    self.use_copy = False
+                    cursor = conn.cursor()
+            if not self.use_copy:
+                rows_written = self._insert(cursor, table_name, columns, self._iter_rows(data, columns), skip_conflicts)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logging.error(f"Failed to bulk load into {table_name}: {str(e)}")
+            raise
+        finally:
+            conn.close()
+
+        elapsed = time() - t_start
+        self.total_rows += rows_written
+        self.total_seconds += elapsed
+        logging.info(
+            f"Wrote {rows_written} rows to {table_name} in {elapsed:.3f} seconds "
+            f"({rows_written / max(elapsed, 1e-9):.0f} rows/sec)"
+        )
+        return rows_written
+
+    @property
+    def rows_per_second(self) -> float:
+        """Average throughput over every write so far"""
+        return self.total_rows / self.total_seconds if self.total_seconds else 0.0
+
+class WriterPool:
+    """Several BulkWriters writing batches in parallel, one connection each
+
+    Every thread that writes gets its own BulkWriter, so each batch is
+    committed on its own pooled connection and one slow batch does not
+    hold up the others. write() loads a batch in the calling thread (for
+    callers that bring their own threads), submit() hands it to one of the
+    pool's `writers` threads and returns a Future. At most max_pending
+    submitted batches are pending; submit() waits for the oldest one beyond
+    that. The engine's pool_size should be at least the number of writers.
+    Writes are timed as the db_write stage when metrics are given.
+    """
+
+    def __init__(self, engine: Any, writers: int = 4, max_pending: Optional[int] = None, use_copy: bool = True,
+                 metrics: Optional[PipelineMetrics] = None):
+        self.engine = engine
+        self.metrics = metrics
+        self.writers = writers
+        self.max_pending = max_pending or 2 * writers
+        self.use_copy = use_copy
+        self._local = threading.local()
+        self._all_writers: List[BulkWriter] = []
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=writers, thread_name_prefix='db-writer')
+        self._pending = deque()
+
+    def _writer(self) -> BulkWriter:
+        """BulkWriter of the current thread"""
+        writer = getattr(self._local, 'writer', None)
+        if writer is None:
+            writer = self._local.writer = BulkWriter(self.engine, self.use_copy)
+            with self._lock:
+                self._all_writers.append(writer)
+        return writer
+
+    def write(self, table_name: str, data: Union[pd.DataFrame, Sequence[Dict]], columns: Optional[List[str]] = None,
+              skip_conflicts: bool = False) -> int:
+        """Write a batch now, in the calling thread"""
+        with stage_timer(self.metrics, 'db_write', len(data)):
+            rows_written = self._writer().write(table_name, data, columns, skip_conflicts)
+        if self.metrics is not None:
+            self.metrics.record_memory()
+        return rows_written
+
+    def submit(self, table_name: str, data: Union[pd.DataFrame, Sequence[Dict]], columns: Optional[List[str]] = None,
+               skip_conflicts: bool = False) -> Future:
+        """Queue a batch for one of the writer threads"""
+        return self.submit_fn(self.write, table_name, data, columns, skip_conflicts)
+
+    def submit_fn(self, fn: Callable[..., Any], *args) -> Future:
+        """Run fn(*args) on a writer thread, e.g. a function writing several tables through write()"""
+        future = self._executor.submit(fn, *args)
+        self._pending.append(future)
+        # Collect finished writes and wait when too many are pending
+        while self._pending and (self._pending[0].done() or len(self._pending) > self.max_pending):
+            self._pending.popleft().result()
+        return future
+
+    def wait(self) -> None:
+        """Wait until every submitted batch is committed, raising the first error"""
+        while self._pending:
+            self._pending.popleft().result()
+
+    def close(self) -> None:
+        try:
+            self.wait()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    @property
+    def total_rows(self) -> int:
+        return sum(writer.total_rows for writer in self._all_writers)
+
+    @property
+    def total_seconds(self) -> float:
+        return sum(writer.total_seconds for writer in self._all_writers)
+
+    @property
+    def rows_per_second(self) -> float:
+        """Average throughput of one connection"""
+        return self.total_rows / self.total_seconds if self.total_seconds else 0.0
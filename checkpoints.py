@@ -0,0 +1,93 @@
+import logging
+from typing import Any, Optional
+
+from sqlalchemy import text
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+class CheckpointStore:
+    """Progress of the pipeline per dataset, split and subset
+
+    rows_done is the number of source texts (in dataset order) whose chunks
+    are committed to processed_dataset, so a rerun can skip them.
+    """
+
+    def __init__(self, engine: Any):
+        self.engine = engine
+
+    def create_table(self) -> None:
+        """Create the checkpoint table if it doesn't exist"""
+        create_table_query = text("""
+        CREATE TABLE IF NOT EXISTS pipeline_checkpoints (
+            dataset_name TEXT NOT NULL,
+            split TEXT NOT NULL,
+            subset TEXT NOT NULL DEFAULT '',
+            rows_done BIGINT NOT NULL DEFAULT 0,
+            run_id TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (dataset_name, split, subset)
+        );
+        """)
+        with self.engine.connect() as conn:
+            conn.execute(create_table_query)
+            conn.commit()
+
+    def get(self, dataset_name: str, split: str, subset: Optional[str] = None) -> int:
+        """Number of source texts already done, 0 when there is no checkpoint"""
+        query = text("""
+        SELECT rows_done FROM pipeline_checkpoints
+        WHERE dataset_name = :dataset_name AND split = :split AND subset = :subset
+        """)
+        with self.engine.connect() as conn:
+            rows_done = conn.execute(
+                query, {'dataset_name': dataset_name, 'split': split, 'subset': subset or ''}
+            ).scalar()
+        return rows_done or 0
+
+    def get_run_id(self, dataset_name: str, split: str, subset: Optional[str] = None) -> Optional[str]:
+        """run_id of the run that wrote the checkpoint, None when there is none
+
+        A resumed run keeps this run_id, so the rows committed before and
+        after the resume belong to one run and are exported together.
+        """
+        query = text("""
+        SELECT run_id FROM pipeline_checkpoints
+        WHERE dataset_name = :dataset_name AND split = :split AND subset = :subset
+        """)
+        with self.engine.connect() as conn:
+            return conn.execute(
+                query, {'dataset_name': dataset_name, 'split': split, 'subset': subset or ''}
+            ).scalar()
+
+    def update(self, dataset_name: str, split: str, subset: Optional[str], rows_done: int,
+               run_id: Optional[str] = None) -> None:
+        """Record that the first rows_done source texts are done"""
+        query = text("""
+        INSERT INTO pipeline_checkpoints (dataset_name, split, subset, rows_done, run_id, updated_at)
+        VALUES (:dataset_name, :split, :subset, :rows_done, :run_id, CURRENT_TIMESTAMP)
+        ON CONFLICT (dataset_name, split, subset)
+        DO UPDATE SET rows_done = EXCLUDED.rows_done, run_id = EXCLUDED.run_id, updated_at = EXCLUDED.updated_at
+        """)
+        with self.engine.connect() as conn:
+            conn.execute(query, {
+                'dataset_name': dataset_name,
+                'split': split,
+                'subset': subset or '',
+                'rows_done': rows_done,
+                'run_id': run_id
+            })
+            conn.commit()
+
+    def reset(self, dataset_name: str, split: str, subset: Optional[str] = None) -> None:
+        """Forget the progress so the next run starts from row 0"""
+        query = text("""
+        DELETE FROM pipeline_checkpoints
+        WHERE dataset_name = :dataset_name AND split = :split AND subset = :subset
+        """)
+        with self.engine.connect() as conn:
+            conn.execute(query, {'dataset_name': dataset_name, 'split': split, 'subset': subset or ''})
+            conn.commit()
+        logging.info(f"Checkpoint reset for {dataset_name} {split} {subset or ''}")
@@ -1,8 +1,18 @@
 import re
 from typing import Dict, List
 
+import numpy as np
+import pandas as pd
+
+from dedup_index import NearDuplicateIndex, TextListIndex
+
 class DataValidator:
-    def __init__(self):
+    def __init__(self, dedup_index: NearDuplicateIndex = None):
+        # Optional near-duplicate index shared across calls (and runs)
+        self.dedup_index = dedup_index
+        # Index of the other_texts list given to is_duplicate/check_texts
+        self._other_texts_index = TextListIndex(str.lower)
+        
         # Simple patterns to find sensitive data
         # Pattern for email validation
         self.email_pattern = (
@@ -30,52 +40,62 @@ class DataValidator:
             r'\d{4}\b' # Last four digits
         )
         
+        # Compile the patterns once instead of on every call
+        self.email_re = re.compile(self.email_pattern)
+        self.phone_re = re.compile(self.phone_pattern)
+        self.ssn_re = re.compile(self.ssn_pattern)
+        # Cheap scan for what every match needs: an '@' (email) or
+        # 3 digits, optional separator, 2 digits (phone and SSN)
+        self.private_info_hint_re = re.compile(r'\d\d\d[-.]?\d\d')
+        # Runs of normal characters, removed to count them in one pass
+        self.normal_chars_re = re.compile(r'[a-zA-Z0-9\s]+')
+        
     def has_too_many_special_chars(self, text: str) -> bool:
         """Check if text has too many special characters (>30%)"""
         if not text:
             return False
         
         # Count normal vs special characters
-        normal_chars = len(re.findall(r'[a-zA-Z0-9\s]', text))
         total_chars = len(text)
-        alphanumeric_chars = len(re.findall(r'[a-zA-Z0-9\s]', text))
-        
-        if total_chars == 0:
-            return False
+        normal_chars = total_chars - len(self.normal_chars_re.sub('', text))
             
         # If more than 30% special chars, return True
         return (normal_chars / total_chars) < 0.7
     
+    def may_contain_private_info(self, text: str) -> bool:
+        """Quick check that rules out texts none of the patterns can match"""
+        return '@' in text or self.private_info_hint_re.search(text) is not None
+    
     def find_private_info(self, text: str) -> Dict[str, List[str]]:
         """Look for emails, phone numbers, and SSNs in text"""
+        # Most texts have no match at all, so skip the separate scans for them
+        if not self.may_contain_private_info(text):
+            return {'emails': [], 'phones': [], 'ssns': []}
+        
         found_info = {
-            'emails': re.findall(self.email_pattern, text),
-            'phones': re.findall(self.phone_pattern, text),
-            'ssns': re.findall(self.ssn_pattern, text)
+            'emails': self.email_re.findall(text),
+            'phones': self.phone_re.findall(text),
+            'ssns': self.ssn_re.findall(text)
         }
         return found_info
     
-    def is_duplicate(self, text: str, other_texts: List[str]) -> bool:
-        """Check if text is too similar to any existing text"""
-        if not text or not other_texts:
+    def is_duplicate(self, text: str, other_texts: List[str] = None) -> bool:
+        """Check if text is too similar to any existing text
+        
+        The texts in other_texts are lowercased once and put in a MinHash/LSH
+        index that is kept for that list: calls with the same list, grown
+        since, only index the new texts. Without other_texts the shared
+        dedup_index is queried.
+        """
+        if not text:
             return False
             
-        # Convert text to lowercase and get unique characters
-        text_chars = set(text.lower())
+        if other_texts:
+            index = self._other_texts_index.index_for(other_texts)
+        else:
+            index = self.dedup_index
         
-        # Compare with each existing text
-        for other in other_texts:
-            other_chars = set(other.lower())
-            
-            # Calculate how similar they are (0 to 1)
-            common_chars = len(text_chars & other_chars)
-            total_chars = len(text_chars | other_chars)
-            
-            # If 80% or more similar, it's a duplicate
-            if total_chars > 0 and (common_chars / total_chars) >= 0.8:
-                return True
-                
-        return False
+        return index is not None and index.is_duplicate(text.lower())
     
     def check_text(self, text: str, other_texts: List[str] = None) -> Dict:
         """Check text for problems and return results"""
@@ -97,8 +117,59 @@ class DataValidator:
             result['private_info'] = private_info
         
         # Check for duplicates
-        if other_texts and self.is_duplicate(text, other_texts):
+        if self.is_duplicate(text, other_texts):
             result['is_valid'] = False
             result['problems'].append('Similar to existing text')
         
+        return result
+    
+    def check_texts(self, texts: pd.Series, other_texts: List[str] = None) -> pd.DataFrame:
+        """Check a whole column of texts and return one row of flags per text
+        
+        Columns: too_many_special_chars, emails, phones, ssns,
+        has_private_info, is_duplicate and is_valid.
+        """
+        values = texts.fillna('').astype(str).tolist()
+        
+        # Share of special characters: one precompiled substitution per text
+        remove_normal = self.normal_chars_re.sub
+        too_many_special_chars = np.fromiter(
+            (bool(text) and (len(text) - len(remove_normal('', text))) / len(text) < 0.7 for text in values),
+            dtype=bool, count=len(values)
+        )
+        
+        # Quick scan first, separate patterns only for texts that hit
+        may_contain_private_info = self.may_contain_private_info
+        emails = [[] for _ in range(len(values))]
+        phones = [[] for _ in range(len(values))]
+        ssns = [[] for _ in range(len(values))]
+        has_private_info = np.zeros(len(values), dtype=bool)
+        for pos, text in enumerate(values):
+            if not may_contain_private_info(text):
+                continue
+            emails[pos] = self.email_re.findall(text)
+            phones[pos] = self.phone_re.findall(text)
+            ssns[pos] = self.ssn_re.findall(text)
+            has_private_info[pos] = bool(emails[pos] or phones[pos] or ssns[pos])
+        
+        # Duplicates against other_texts or the shared index
+        if other_texts:
+            index = self._other_texts_index.index_for(other_texts)
+        else:
+            index = self.dedup_index
+        if index is not None:
+            is_duplicate = np.fromiter((bool(text) and index.is_duplicate(text.lower()) for text in values),
+                                       dtype=bool, count=len(values))
+        else:
+            is_duplicate = np.zeros(len(values), dtype=bool)
+        
+        result = pd.DataFrame({
+            'too_many_special_chars': too_many_special_chars,
+            'emails': emails,
+            'phones': phones,
+            'ssns': ssns,
+            'has_private_info': has_private_info,
+            'is_duplicate': is_duplicate
+        }, index=texts.index)
+        result['is_valid'] = ~(result['too_many_special_chars'] | result['has_private_info'] | result['is_duplicate'])
         return result
\ No newline at end of file
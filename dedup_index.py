@@ -0,0 +1,185 @@
+import logging
+import os
+import zlib
+from typing import Callable, Dict, List, Optional, Sequence, Set
+
+import numpy as np
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+# Large prime for the MinHash permutations, hashes are kept to 32 bits
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+# Version 2 draws a and b below 2**32, so a * x + b (x is a 32-bit crc)
+# fits in uint64 and the permutation really is (a * x + b) mod prime.
+# Version 1 drew them below the prime and the product wrapped mod 2**64;
+# indexes saved with it keep using it (see load).
+HASH_VERSION = 2
+
+
+class NearDuplicateIndex:
+    """Near-duplicate index built on MinHash signatures and LSH banding
+
+    Texts are turned into character shingles and a MinHash signature. The
+    signature is split into bands, and texts sharing a band bucket become
+    candidates, so a query only looks at a few texts instead of all of them.
+    A candidate is a duplicate when the estimated Jaccard similarity of the
+    shingle sets reaches the threshold.
+    """
+
+    def __init__(self, threshold: float = 0.8, num_perm: int = 128, bands: int = 16,
+                 shingle_size: int = 5, seed: int = 1, hash_version: int = HASH_VERSION):
+        if num_perm % bands != 0:
+            raise ValueError("num_perm must be divisible by bands")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.seed = seed
+        self.hash_version = hash_version
+
+        # Random permutations (a * x + b) % prime, fixed by the seed so saved
+        # signatures stay comparable between runs
+        generator = np.random.RandomState(seed)
+        high = MERSENNE_PRIME if hash_version == 1 else np.uint64(1 << 32)
+        self._a = generator.randint(1, high, size=num_perm, dtype=np.uint64)
+        self._b = generator.randint(0, high, size=num_perm, dtype=np.uint64)
+
+        self._signatures: List[np.ndarray] = []
+        self._buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(bands)]
+
+    def __len__(self) -> int:
+        return len(self._signatures)
+
+    def shingles(self, text: str) -> Set[str]:
+        """Character shingles of the text"""
+        if len(text) <= self.shingle_size:
+            return {text}
+        return {text[i:i + self.shingle_size] for i in range(len(text) - self.shingle_size + 1)}
+
+    def signature(self, text: str) -> np.ndarray:
+        """MinHash signature of the text"""
+        hashes = np.fromiter(
+            (zlib.crc32(shingle.encode('utf-8')) for shingle in self.shingles(text)),
+            dtype=np.uint64
+        )
+        permuted = ((hashes[:, None] * self._a + self._b) % MERSENNE_PRIME) & MAX_HASH
+        return permuted.min(axis=0).astype(np.uint32)
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def _insert_signature(self, signature: np.ndarray) -> int:
+        doc_id = len(self._signatures)
+        self._signatures.append(signature)
+        for band, key in enumerate(self._band_keys(signature)):
+            self._buckets[band].setdefault(key, []).append(doc_id)
+        return doc_id
+
+    def _is_duplicate_signature(self, signature: np.ndarray) -> bool:
+        checked = set()
+        for band, key in enumerate(self._band_keys(signature)):
+            for doc_id in self._buckets[band].get(key, ()):
+                if doc_id in checked:
+                    continue
+                checked.add(doc_id)
+                # Share of equal MinHash values estimates the Jaccard similarity
+                if np.mean(self._signatures[doc_id] == signature) >= self.threshold:
+                    return True
+        return False
+
+    def insert(self, text: str) -> int:
+        """Add a text to the index and return its id"""
+        return self._insert_signature(self.signature(text))
+
+    def is_duplicate(self, text: str) -> bool:
+        """Check if text is too similar to any text in the index"""
+        if not text or not self._signatures:
+            return False
+        return self._is_duplicate_signature(self.signature(text))
+
+    def add_if_unique(self, text: str) -> bool:
+        """Add text unless it is a near duplicate; return True when it was added"""
+        if not text:
+            return False
+        signature = self.signature(text)
+        if self._signatures and self._is_duplicate_signature(signature):
+            return False
+        self._insert_signature(signature)
+        return True
+
+    @classmethod
+    def from_texts(cls, texts, **kwargs) -> 'NearDuplicateIndex':
+        """Build an index from a list of texts"""
+        index = cls(**kwargs)
+        for text in texts:
+            if text:
+                index.insert(text)
+        return index
+
+    def save(self, path: str) -> None:
+        """Save the signatures and settings to a .npz file"""
+        signatures = np.vstack(self._signatures) if self._signatures else np.empty((0, self.num_perm), dtype=np.uint32)
+        # Write through a file object so numpy keeps the path as given
+        with open(path, 'wb') as f:
+            np.savez_compressed(
+                f,
+                signatures=signatures,
+                settings=np.array([self.num_perm, self.bands, self.shingle_size, self.seed]),
+                threshold=np.array(self.threshold),
+                hash_version=np.array(self.hash_version)
+            )
+        logging.info(f"Saved near-duplicate index with {len(self)} texts to {path}")
+
+    @classmethod
+    def load(cls, path: str) -> 'NearDuplicateIndex':
+        """Load an index saved with save()"""
+        with np.load(path) as data:
+            num_perm, bands, shingle_size, seed = (int(value) for value in data['settings'])
+            # Files written before hash versions were saved use version 1
+            hash_version = int(data['hash_version']) if 'hash_version' in data.files else 1
+            index = cls(float(data['threshold']), num_perm, bands, shingle_size, seed, hash_version)
+            for signature in data['signatures']:
+                index._insert_signature(signature)
+        logging.info(f"Loaded near-duplicate index with {len(index)} texts from {path}")
+        return index
+
+    @classmethod
+    def load_or_create(cls, path: str, **kwargs) -> 'NearDuplicateIndex':
+        """Load the index at path if it exists, otherwise start an empty one"""
+        if path and os.path.exists(path):
+            return cls.load(path)
+        return cls(**kwargs)
+
+class TextListIndex:
+    """NearDuplicateIndex over a caller's list of texts, reused between calls
+
+    The index belongs to the list object it was built from; on later calls
+    only the texts appended since are normalized and inserted, so checking
+    each new text against a growing list no longer rebuilds the index from
+    every text. Another list, or a shorter one, starts a new index. Texts
+    changed in place are not noticed.
+    """
+
+    def __init__(self, normalize: Callable[[str], str]):
+        self.normalize = normalize
+        self._texts: Optional[Sequence[str]] = None
+        self._indexed = 0
+        self._index: Optional[NearDuplicateIndex] = None
+
+    def index_for(self, texts: Sequence[str]) -> NearDuplicateIndex:
+        """Index holding every text of texts"""
+        if self._texts is not texts or len(texts) < self._indexed:
+            self._texts = texts
+            self._indexed = 0
+            self._index = NearDuplicateIndex()
+        for text in texts[self._indexed:]:
+            if text:
+                self._index.insert(self.normalize(text))
+        self._indexed = len(texts)
+        return self._index
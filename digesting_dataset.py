@@ -5,7 +5,11 @@ from time import time
 import pandas as pd
 from sqlalchemy import create_engine
 from sqlalchemy.exc import SQLAlchemyError
-from datasets import load_dataset
+
+from adaptive_batching import batcher_from_params, estimate_bytes, rebatch_frames
+from bulk_writer import BulkWriter, WriterPool
+from metrics import PipelineMetrics
+from work_leasing import select_shard_rows
 
 # Configure logging
 logging.basicConfig(
@@ -15,6 +19,8 @@ logging.basicConfig(
 
 def load_from_huggingface(dataset_name, split='train', subset=None):
     """Load dataset from HuggingFace datasets"""
+    from datasets import load_dataset
+    
     try:
         logging.info(f"Loading dataset {dataset_name} from HuggingFace")
         if subset:
@@ -27,11 +33,59 @@ def load_from_huggingface(dataset_name, split='train', subset=None):
         logging.error(f"Failed to load dataset from HuggingFace: {str(e)}")
         raise
 
+def load_arrow_from_huggingface(dataset_name, split='train', subset=None):
+    """Load dataset from HuggingFace datasets as an Arrow table, without a pandas copy"""
+    from datasets import load_dataset
+    
+    try:
+        logging.info(f"Loading dataset {dataset_name} from HuggingFace as Arrow")
+        if subset:
+            dataset = load_dataset(dataset_name, subset, split=split)
+        else:
+            dataset = load_dataset(dataset_name, split=split)
+        return dataset.with_format('arrow')[:]
+    except Exception as e:
+        logging.error(f"Failed to load dataset from HuggingFace: {str(e)}")
+        raise
+
+def stream_from_huggingface(dataset_name, split='train', subset=None, batch_size=100000):
+    """Stream a HuggingFace dataset as DataFrames of at most batch_size rows
+    
+    Only one batch is held in memory at a time, whatever the size of the split.
+    """
+    from datasets import load_dataset
+    
+    try:
+        logging.info(f"Streaming dataset {dataset_name} from HuggingFace")
+        if subset:
+            dataset = load_dataset(dataset_name, subset, split=split, streaming=True)
+        else:
+            dataset = load_dataset(dataset_name, split=split, streaming=True)
+        for batch in dataset.iter(batch_size=batch_size):
+            yield pd.DataFrame(batch)
+    except Exception as e:
+        logging.error(f"Failed to stream dataset from HuggingFace: {str(e)}")
+        raise
+
+def iter_dataframe_chunks(df, chunk_size=100000):
+    """Yield consecutive slices of df without building a list of them"""
+    for i in range(0, len(df), chunk_size):
+        yield df[i:i + chunk_size]
+
 def create_db_engine(params):
-    """Create database engine with error handling"""
+    """Create database engine with error handling
+    
+    The connection pool is sized from params (pool_size, max_overflow,
+    pool_timeout, pool_recycle) so every parallel writer gets a connection.
+    """
     try:
         engine = create_engine(
-            f'postgresql://{params.user}:{params.password}@{params.host}:{params.port}/{params.db}'
+            f'postgresql://{params.user}:{params.password}@{params.host}:{params.port}/{params.db}',
+            pool_size=getattr(params, 'pool_size', None) or 5,
+            max_overflow=getattr(params, 'max_overflow', None) or 10,
+            pool_timeout=getattr(params, 'pool_timeout', None) or 30,
+            pool_recycle=getattr(params, 'pool_recycle', None) or -1,
+            pool_pre_ping=True
         )
         # Test the connection
         with engine.connect() as conn:
@@ -43,22 +97,55 @@ def create_db_engine(params):
 def main(params):
     try:
         # Load data from HuggingFace
-        df = load_from_huggingface(
-            params.dataset_name,
-            params.split,
-            params.subset
-        )
-        
-        # Convert to iterator for chunked processing
-        df_iter = [df[i:i + 100000] for i in range(0, len(df), 100000)]
-        df_iter = iter(df_iter)
-        
-        logging.info("Data loading completed successfully")
+        chunk_size = getattr(params, 'chunk_size', 100000)
+        streaming = getattr(params, 'streaming', False)
+        if streaming:
+            # Rows are only fetched as the chunks are pulled below
+            df_iter = stream_from_huggingface(
+                params.dataset_name,
+                params.split,
+                params.subset,
+                chunk_size
+            )
+        else:
+            df = load_from_huggingface(
+                params.dataset_name,
+                params.split,
+                params.subset
+            )
+            
+            logging.info("Data loading completed successfully")
+            
+            # Convert to iterator for chunked processing
+            df_iter = iter_dataframe_chunks(df, chunk_size)
+
+        metrics = PipelineMetrics(prefix='ingest')
+        # Resize the chunks from the measured write throughput instead of chunk_size
+        batcher = batcher_from_params(params, chunk_size, 'chunk', metrics)
+        if batcher is not None:
+            df_iter = rebatch_frames(df_iter, batcher)
 
         # Create database engine
         engine = create_db_engine(params)
+        writer = BulkWriter(engine)
+        writers = getattr(params, 'writers', 1) or 1
+        # Chunks after the first are committed by parallel writers
+        writer_pool = WriterPool(engine, writers, metrics=metrics) if writers > 1 else None
         logging.info("Database connection established")
 
+        def write_chunk(df, chunk_writer):
+            t_write = time()
+            chunk_writer.write(params.table_name, df)
+            if batcher is not None:
+                batcher.record(len(df), estimate_bytes(df), time() - t_write)
+
+        # Static sharding: this worker writes every num_shards-th source row
+        num_shards = getattr(params, 'num_shards', 1) or 1
+        shard_index = getattr(params, 'shard_index', 0) or 0
+        if not 0 <= shard_index < num_shards:
+            raise ValueError(f"--shard_index must be between 0 and {num_shards - 1}")
+        rows_seen = 0
+
         # Process chunks
         chunk_number = 0
         total_rows = 0
@@ -66,27 +153,47 @@ def main(params):
         while True:
             try:
                 t_start = time()
-                df = next(df_iter)
+                with metrics.timer('fetch'):
+                    df = next(df_iter)
                 
                 # Rename columns according to mapping if needed
                 if hasattr(params, 'columns_mapping'):
                     df = df.rename(columns=params.columns_mapping)
                 
-                df.to_sql(
-                    name=params.table_name,
-                    con=engine,
-                    if_exists='append' if chunk_number > 0 else 'replace',
-                    index=False
-                )
+                if num_shards > 1:
+                    offset = rows_seen
+                    rows_seen += len(df)
+                    df = select_shard_rows(df, offset, num_shards, shard_index)
+                
+                # Recreate the table from the first chunk, then COPY the rows in;
+                # shards share the table, so they only create it when it is missing
+                if chunk_number == 0:
+                    writer.prepare_table(params.table_name, df, if_exists='replace' if num_shards <= 1 else 'append')
+                if writer_pool is not None:
+                    writer_pool.submit_fn(write_chunk, df, writer_pool)
+                else:
+                    with metrics.timer('db_write', len(df)):
+                        write_chunk(df, writer)
+                metrics.record_memory()
                 
                 chunk_number += 1
                 total_rows += len(df)
                 t_end = time()
                 
                 logging.info(f'Chunk {chunk_number} inserted ({len(df)} rows), took {(t_end - t_start):.3f} seconds')
+                if getattr(params, 'metrics_textfile', None):
+                    metrics.write_textfile(params.metrics_textfile)
                 
             except StopIteration:
+                if streaming:
+                    logging.info("Data loading completed successfully")
+                if writer_pool is not None:
+                    writer_pool.close()
                 logging.info(f'Data ingestion completed successfully. Total rows processed: {total_rows}')
+                if getattr(params, 'metrics_textfile', None):
+                    metrics.write_textfile(params.metrics_textfile)
+                if getattr(params, 'metrics_summary', None):
+                    metrics.write_summary(params.metrics_summary, {'total_rows': total_rows, 'chunks': chunk_number})
                 break
             except Exception as e:
                 logging.error(f"Error processing chunk {chunk_number}: {str(e)}")
@@ -107,6 +214,25 @@ if __name__ == '__main__':
     parser.add_argument('--port', required=True, help='port for postgres')
     parser.add_argument('--db', required=True, help='database name for postgres')
     parser.add_argument('--table_name', required=True, help='name of the table where we will write the results to')
+    parser.add_argument('--chunk_size', type=int, default=100000, help='Number of rows written per chunk')
+    parser.add_argument('--streaming', action='store_true', help='Stream the dataset instead of downloading it first')
+    parser.add_argument('--writers', type=int, default=1, help='Chunks committed in parallel, one connection each')
+    parser.add_argument('--pool_size', type=int, default=5, help='Connections kept in the database pool')
+    parser.add_argument('--max_overflow', type=int, default=10, help='Extra connections allowed above pool_size')
+    parser.add_argument('--pool_timeout', type=int, default=30, help='Seconds to wait for a free connection')
+    parser.add_argument('--pool_recycle', type=int, default=-1, help='Reconnect connections older than this (seconds)')
+    parser.add_argument('--num_shards', type=int, default=1, help='Split the source rows into this many static shards')
+    parser.add_argument('--shard_index', type=int, default=0, help='Shard written by this worker (0 .. num_shards - 1)')
+    parser.add_argument('--adaptive_batching', action='store_true',
+                        help='Grow/shrink the chunks (starting at chunk_size) to hit a target size or latency')
+    parser.add_argument('--target_batch_mb', type=int, help='Target in-memory size of a chunk (default 32 MB)')
+    parser.add_argument('--target_batch_seconds', type=float, help='Target write time of a chunk')
+    parser.add_argument('--min_batch_size', type=int, default=100, help='Smallest adaptive chunk (rows)')
+    parser.add_argument('--max_batch_size', type=int, default=1000000, help='Largest adaptive chunk (rows)')
+    parser.add_argument('--min_free_memory_mb', type=int, default=512,
+                        help='Shrink the chunks when less memory than this is available')
+    parser.add_argument('--metrics_textfile', help='Prometheus textfile (node_exporter collector) updated after every chunk')
+    parser.add_argument('--metrics_summary', help='Write a JSON summary of the ingestion metrics to this path')
     
     args = parser.parse_args()
     
@@ -1,24 +1,260 @@
-from google.cloud import storage
-import pandas as pd
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Iterable, Iterator, List, Optional, Tuple, Union
+from urllib.parse import quote
+import io
+import itertools
 import os
 import logging
 
+from blob_cache import BlobCache, checksums_match
+from metrics import PipelineMetrics, stage_timer
+
+if TYPE_CHECKING:
+    # pyarrow and pandas (which loads pyarrow itself) are imported by the
+    # functions that use them, not with this module
+    import pandas as pd
+    import pyarrow as pa
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+# GCS compose accepts at most 32 source objects per call
+MAX_COMPOSE_SOURCES = 32
+
+# Supported export formats and their file extensions
+FILE_EXTENSIONS = {
+    'csv': '.csv',
+    'parquet': '.parquet',
+    'arrow': '.arrow'
+}
+
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.file'
+}
+
+# Compression codecs the Arrow IPC format supports
+IPC_COMPRESSIONS = ('zstd', 'lz4')
+
+def parse_gcs_uri(uri: str) -> Tuple[str, str]:
+    """Split gs://bucket/prefix into (bucket, prefix)"""
+    if not uri.startswith('gs://'):
+        raise ValueError(f"Not a gs:// URI: {uri}")
+    bucket_name, _, prefix = uri[len('gs://'):].partition('/')
+    if not bucket_name:
+        raise ValueError(f"No bucket in {uri}")
+    return bucket_name, prefix
+
+def file_format_of(name: str) -> Optional[str]:
+    """Export format of an object from its extension, None for other objects"""
+    for file_format, extension in FILE_EXTENSIONS.items():
+        if name.endswith(extension):
+            return file_format
+    return None
+
+def iter_file_tables(path: str, file_format: str, batch_rows: int = 10000) -> 'Iterator[pa.Table]':
+    """Read a local csv, parquet or Arrow IPC file as a stream of small tables"""
+    import pyarrow as pa
+    import pyarrow.csv
+    import pyarrow.parquet as pq
+    if file_format == 'csv':
+        batches = pyarrow.csv.open_csv(path)
+    elif file_format == 'parquet':
+        batches = pq.ParquetFile(path).iter_batches(batch_size=batch_rows)
+    elif file_format == 'arrow':
+        # Memory-mapped, only the batches that are read get paged in
+        reader = pa.ipc.open_file(pa.memory_map(path, 'r'))
+        batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+    else:
+        raise ValueError(f"Unsupported file format: {file_format}")
+    for batch in batches:
+        if batch.num_rows:
+            yield pa.Table.from_batches([batch])
+
 class GCPStorageHandler:
-    def __init__(self, credentials_path):
-        """Initialize GCP storage client"""
-        self.storage_client = storage.Client.from_service_account_json(credentials_path)
-        
+    def __init__(self, credentials_path: Optional[str] = None, max_workers: int = 8,
+                 part_rows: int = 100000, chunk_size: int = 8 * 1024 * 1024,
+                 file_format: str = 'csv', compression: Optional[str] = 'zstd',
+                 row_group_size: int = 100000):
+        """Initialize GCP storage client
+
+        When STORAGE_EMULATOR_HOST is set (e.g. a local fake-gcs-server) the
+        client talks to the emulator with anonymous credentials instead.
+        """
+        # google-cloud-storage is only imported when a handler is created
+        from google.cloud import storage
+        from google.auth.credentials import AnonymousCredentials
+
+        if os.environ.get('STORAGE_EMULATOR_HOST'):
+            self.storage_client = storage.Client(
+                project=os.environ.get('GCP_PROJECT', 'test-project'),
+                credentials=AnonymousCredentials()
+            )
+        elif credentials_path:
+            self.storage_client = storage.Client.from_service_account_json(credentials_path)
+        else:
+            # Application default credentials (GOOGLE_APPLICATION_CREDENTIALS, metadata server)
+            self.storage_client = storage.Client()
+        # Number of concurrent part/object uploads
+        self.max_workers = max_workers
+        # DataFrames with more rows are uploaded as parallel parts
+        self.part_rows = part_rows
+        # Resumable upload chunk size, must be a multiple of 256 KiB
+        self.chunk_size = chunk_size
+        # Default export format: csv, parquet (compressed) or arrow (IPC file)
+        if file_format not in FILE_EXTENSIONS:
+            raise ValueError(f"Unsupported file format: {file_format}")
+        self.file_format = file_format
+        self.compression = compression
+        self.row_group_size = row_group_size
+
+    def list_objects(self, bucket_name: str, prefix: str = '') -> List:
+        """Data objects (csv, parquet, arrow) under prefix, in name order
+
+        The .parts/ and .compose/ objects of unfinished uploads are left out.
+        """
+        try:
+            blobs = [
+                blob for blob in self.storage_client.list_blobs(bucket_name, prefix=prefix)
+                if file_format_of(blob.name) and '.parts/' not in blob.name and '.compose/' not in blob.name
+            ]
+            return sorted(blobs, key=lambda blob: blob.name)
+        except Exception as e:
+            logging.error(f"Failed to list gs://{bucket_name}/{prefix}: {str(e)}")
+            raise
+
+    def delete_objects(self, bucket_name: str, prefix: str) -> int:
+        """Delete every object under prefix and return how many there were"""
+        try:
+            blobs = list(self.storage_client.list_blobs(bucket_name, prefix=prefix))
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                list(executor.map(lambda blob: blob.delete(), blobs))
+            if blobs:
+                logging.info(f"Deleted {len(blobs)} objects under gs://{bucket_name}/{prefix}")
+            return len(blobs)
+        except Exception as e:
+            logging.error(f"Failed to delete gs://{bucket_name}/{prefix}: {str(e)}")
+            raise
+
+    def download_object(self, bucket_name: str, blob, destination_path: str,
+                        part_size: int = 32 * 1024 * 1024) -> str:
+        """Download an object to a local file with parallel range reads
+
+        blob comes from list_objects (or get_blob) and carries the size,
+        generation and checksums. The object is read in ranges of part_size
+        bytes on max_workers threads, each range written at its offset, and
+        the file is checked against the object's crc32c/md5 before it is
+        moved to destination_path. Reads are pinned to the listed
+        generation, so an object replaced meanwhile fails instead of mixing
+        two versions.
+        """
+        size = blob.size or 0
+        partial_path = f"{destination_path}.partial"
+        source = self.storage_client.bucket(bucket_name).blob(blob.name, generation=blob.generation)
+
+        def download_range(start):
+            # end is inclusive; the checksum of the whole file is checked below
+            data = source.download_as_bytes(start=start, end=min(start + part_size, size) - 1, checksum=None)
+            os.pwrite(fd, data, start)
+            return len(data)
+
+        try:
+            fd = os.open(partial_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.ftruncate(fd, size)
+                with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                    received = sum(executor.map(download_range, range(0, size, part_size)))
+            finally:
+                os.close(fd)
+            if received != size:
+                raise ValueError(f"gs://{bucket_name}/{blob.name}: got {received} bytes, expected {size}")
+            if not checksums_match(partial_path, blob.crc32c, blob.md5_hash):
+                raise ValueError(f"gs://{bucket_name}/{blob.name}: checksum mismatch")
+            os.replace(partial_path, destination_path)
+            logging.info(f"Downloaded gs://{bucket_name}/{blob.name} ({size / 2 ** 20:.1f} MB)")
+            return destination_path
+        except Exception as e:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            logging.error(f"Failed to download gs://{bucket_name}/{blob.name}: {str(e)}")
+            raise
+
+    def fetch_object(self, bucket_name: str, blob, cache: BlobCache, part_size: int = 32 * 1024 * 1024) -> str:
+        """Local path of an object, served from the disk cache or downloaded into it
+
+        The caller should hold a pin on the entry (cache.pin) until it is
+        done with the file, or eviction may delete it.
+        """
+        path = cache.get(bucket_name, blob.name, blob.generation)
+        if path is not None:
+            logging.info(f"gs://{bucket_name}/{blob.name} served from the download cache")
+            return path
+        downloaded = self.download_object(bucket_name, blob, cache.temp_path(bucket_name, blob.name, blob.generation),
+                                          part_size)
+        return cache.put(downloaded, bucket_name, blob.name, blob.generation, blob.crc32c, blob.md5_hash)
+
+    def stream_tables(self, bucket_name: str, prefix: str, cache: BlobCache, prefetch: int = 4,
+                      part_size: int = 32 * 1024 * 1024, batch_rows: int = 10000,
+                      metrics: Optional[PipelineMetrics] = None) -> 'Iterator[pa.Table]':
+        """Stream the rows of every data object under prefix as small Arrow tables
+
+        Objects are read in name order. While one file is parsed the next
+        prefetch objects are already downloading into the cache, so the
+        consumer rarely waits on the network. The file being read and the
+        prefetched ones are pinned in the cache until they are read, so up
+        to prefetch + 1 files are kept even beyond max_bytes.
+        """
+        blobs = self.list_objects(bucket_name, prefix)
+        if not blobs:
+            raise ValueError(f"No csv, parquet or arrow objects under gs://{bucket_name}/{prefix}")
+        logging.info(
+            f"Reading {len(blobs)} objects ({sum(blob.size or 0 for blob in blobs) / 2 ** 20:.1f} MB) "
+            f"from gs://{bucket_name}/{prefix}"
+        )
+
+        def fetch(blob):
+            with stage_timer(metrics, 'download', 1):
+                return self.fetch_object(bucket_name, blob, cache, part_size)
+
+        def submit(blob):
+            # Pinned before the download starts, unpinned once the file is read
+            cache.pin(bucket_name, blob.name, blob.generation)
+            pending.append((blob, executor.submit(fetch, blob)))
+
+        executor = ThreadPoolExecutor(max_workers=max(prefetch, 1))
+        pending = deque()
+        remaining = iter(blobs)
+        try:
+            for blob in itertools.islice(remaining, max(prefetch, 1)):
+                submit(blob)
+            while pending:
+                blob, future = pending[0]
+                path = future.result()
+                for blob_next in itertools.islice(remaining, 1):
+                    submit(blob_next)
+                yield from iter_file_tables(path, file_format_of(blob.name), batch_rows)
+                pending.popleft()
+                cache.unpin(bucket_name, blob.name, blob.generation)
+            logging.info(f"Download cache stats: {cache.stats()}")
+        finally:
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+            for blob, _ in pending:
+                cache.unpin(bucket_name, blob.name, blob.generation)
+            # Bring the cache back under its limit now nothing is pinned
+            cache.evict()
+
     def upload_file_to_bucket(self, bucket_name: str, source_file_path: str, destination_blob_name: str) -> None:
         """Upload a file to GCP bucket"""
         try:
             bucket = self.storage_client.bucket(bucket_name)
             blob = bucket.blob(destination_blob_name)
-            
+
             blob.upload_from_filename(source_file_path)
             logging.info(
                 f"File {source_file_path} uploaded to {destination_blob_name} in bucket {bucket_name}"
@@ -26,21 +262,313 @@ class GCPStorageHandler:
         except Exception as e:
             logging.error(f"Failed to upload file to GCP: {str(e)}")
             raise
-    
-    def upload_dataframe_to_bucket(self, bucket_name: str, df: pd.DataFrame, destination_blob_name: str) -> None:
-        """Upload a pandas DataFrame to GCP bucket as CSV"""
-        try:
-            # Save DataFrame to temporary CSV file
-            temp_file = 'temp_data.csv'
-            df.to_csv(temp_file, index=False)
-            
-            # Upload to GCP
-            self.upload_file_to_bucket(bucket_name, temp_file, destination_blob_name)
-            
-            # Clean up temporary file
-            os.remove(temp_file)
+
+    def upload_bytes_to_bucket(self, bucket_name: str, data: Union[bytes, io.IOBase], destination_blob_name: str,
+                               content_type: str = 'application/octet-stream') -> None:
+        """Upload bytes or a binary file object to GCP bucket with a resumable upload"""
+        try:
+            blob = self.storage_client.bucket(bucket_name).blob(destination_blob_name, chunk_size=self.chunk_size)
+            stream = io.BytesIO(data) if isinstance(data, (bytes, bytearray)) else data
+            blob.upload_from_file(stream, content_type=content_type)
+            logging.info(f"Uploaded {destination_blob_name} to bucket {bucket_name}")
+        except Exception as e:
+            logging.error(f"Failed to upload bytes to GCP: {str(e)}")
+            raise
+
+    @staticmethod
+    def _csv_bytes(df: 'pd.DataFrame', header: bool = True) -> bytes:
+        """Serialize a DataFrame to CSV in memory"""
+        return df.to_csv(index=False, header=header).encode('utf-8')
+
+    def _stream_dataframe(self, bucket_name: str, df: 'pd.DataFrame', destination_blob_name: str) -> None:
+        """Stream a DataFrame as CSV into one resumable upload, a slice at a time"""
+        blob = self.storage_client.bucket(bucket_name).blob(destination_blob_name, chunk_size=self.chunk_size)
+        with blob.open('wb', content_type='text/csv') as writer:
+            writer.write(self._csv_bytes(df.head(0)))
+            for start in range(0, len(df), self.part_rows):
+                writer.write(self._csv_bytes(df[start:start + self.part_rows], header=False))
+
+    def compose_parts(self, bucket_name: str, part_names: List[str], destination_blob_name: str) -> None:
+        """Compose part objects into one object server-side and delete the parts"""
+        bucket = self.storage_client.bucket(bucket_name)
+        sources = [bucket.blob(name) for name in part_names]
+        intermediates = []
+
+        # Compose in groups of 32 until one round is enough
+        level = 0
+        while len(sources) > MAX_COMPOSE_SOURCES:
+            next_sources = []
+            for i in range(0, len(sources), MAX_COMPOSE_SOURCES):
+                blob = bucket.blob(f"{destination_blob_name}.compose/{level}-{i // MAX_COMPOSE_SOURCES:05d}")
+                blob.compose(sources[i:i + MAX_COMPOSE_SOURCES])
+                next_sources.append(blob)
+            intermediates.extend(next_sources)
+            sources = next_sources
+            level += 1
+
+        destination = bucket.blob(destination_blob_name)
+        destination.content_type = 'text/csv'
+        destination.compose(sources)
+
+        # Remove the temporary objects
+        for name in part_names:
+            bucket.blob(name).delete()
+        for blob in intermediates:
+            blob.delete()
+
+    def _upload_dataframe_in_parts(self, bucket_name: str, df: 'pd.DataFrame', destination_blob_name: str) -> None:
+        """Upload slices of a DataFrame as parallel parts and compose them"""
+        starts = range(0, len(df), self.part_rows)
+        part_names = [f"{destination_blob_name}.parts/part-{i:05d}" for i in range(len(starts))]
+
+        def upload_part(i):
+            # Only the first part carries the CSV header
+            data = self._csv_bytes(df[starts[i]:starts[i] + self.part_rows], header=(i == 0))
+            self.storage_client.bucket(bucket_name).blob(part_names[i]).upload_from_string(data, content_type='text/csv')
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(upload_part, range(len(starts))))
+
+        self.compose_parts(bucket_name, part_names, destination_blob_name)
+
+    def _upload_table_in_parts(self, bucket_name: str, table: 'pa.Table', destination_blob_name: str) -> None:
+        """Upload row slices of an Arrow table as parallel CSV parts and compose them"""
+        import pyarrow as pa
+        import pyarrow.csv
+        starts = range(0, table.num_rows, self.part_rows)
+        part_names = [f"{destination_blob_name}.parts/part-{i:05d}" for i in range(len(starts))]
+
+        def upload_part(i):
+            # Only the first part carries the CSV header
+            sink = pa.BufferOutputStream()
+            pa.csv.write_csv(table.slice(starts[i], self.part_rows), sink,
+                             pa.csv.WriteOptions(include_header=(i == 0)))
+            self.upload_bytes_to_bucket(bucket_name, pa.BufferReader(sink.getvalue()), part_names[i], 'text/csv')
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(upload_part, range(len(starts))))
+
+        self.compose_parts(bucket_name, part_names, destination_blob_name)
+
+    def upload_dataframe_to_bucket(self, bucket_name: str, df: 'pd.DataFrame', destination_blob_name: str,
+                                   file_format: Optional[str] = None,
+                                   partition_cols: Optional[List[str]] = None) -> None:
+        """Upload a pandas DataFrame to GCP bucket as CSV
+
+        The CSV is serialized in memory and streamed to the bucket, no
+        temporary file is written. Large frames are split into parts of
+        part_rows rows that are uploaded in parallel and composed server-side.
+        Parquet and Arrow formats go through upload_table_to_bucket.
+        """
+        file_format = file_format or self.file_format
+        if file_format != 'csv' or partition_cols:
+            import pyarrow as pa
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            self.upload_table_to_bucket(bucket_name, table, destination_blob_name, file_format, partition_cols)
+            return
+
+        try:
+            if len(df) > self.part_rows:
+                self._upload_dataframe_in_parts(bucket_name, df, destination_blob_name)
+            else:
+                self._stream_dataframe(bucket_name, df, destination_blob_name)
+            logging.info(f"DataFrame uploaded to {destination_blob_name} in bucket {bucket_name}")
         except Exception as e:
             logging.error(f"Failed to upload DataFrame to GCP: {str(e)}")
-            if os.path.exists('temp_data.csv'):
-                os.remove('temp_data.csv')
-            raise
\ No newline at end of file
+            raise
+
+    def serialize_table(self, table: 'pa.Table', file_format: str) -> 'pa.Buffer':
+        """Serialize an Arrow table to parquet, Arrow IPC or CSV in memory"""
+        import pyarrow as pa
+        import pyarrow.csv
+        import pyarrow.parquet as pq
+        sink = pa.BufferOutputStream()
+        if file_format == 'parquet':
+            pq.write_table(table, sink, compression=self.compression or 'none', row_group_size=self.row_group_size)
+        elif file_format == 'arrow':
+            compression = self.compression if self.compression in IPC_COMPRESSIONS else None
+            options = pa.ipc.IpcWriteOptions(compression=compression)
+            with pa.ipc.new_file(sink, table.schema, options=options) as writer:
+                writer.write_table(table, max_chunksize=self.row_group_size)
+        elif file_format == 'csv':
+            pa.csv.write_csv(table, sink)
+        else:
+            raise ValueError(f"Unsupported file format: {file_format}")
+        return sink.getvalue()
+
+    @staticmethod
+    def _iter_partitions(table: 'pa.Table', partition_cols: List[str]):
+        """Yield (hive path, rows) for every distinct value of the partition columns"""
+        import pyarrow.compute as pc
+        keys = table.select(partition_cols).group_by(partition_cols).aggregate([]).to_pylist()
+        for key in keys:
+            mask = None
+            path_parts = []
+            for column in partition_cols:
+                value = key[column]
+                if value is None:
+                    condition = pc.is_null(table[column])
+                    path_parts.append(f"{column}=__HIVE_DEFAULT_PARTITION__")
+                else:
+                    condition = pc.equal(table[column], value)
+                    path_parts.append(f"{column}={quote(str(value), safe='')}")
+                mask = condition if mask is None else pc.and_(mask, condition)
+            # Partition values live in the path, not in the file
+            yield '/'.join(path_parts), table.filter(mask).drop(partition_cols)
+
+    def upload_table_to_bucket(self, bucket_name: str, table: 'pa.Table', destination_blob_name: str,
+                               file_format: Optional[str] = None,
+                               partition_cols: Optional[List[str]] = None,
+                               part_number: int = 0) -> None:
+        """Upload an Arrow table to GCP bucket without going through pandas
+
+        With partition_cols the destination is used as a prefix and one file
+        is written per partition in hive style, e.g.
+        prefix/split=train/chunk_bucket=0/part-00000.parquet
+        The serialized buffer is uploaded as it is, without a bytes copy;
+        CSV tables over part_rows rows go up as parallel parts that are
+        composed server-side.
+        """
+        import pyarrow as pa
+        file_format = file_format or self.file_format
+        try:
+            if not partition_cols:
+                if file_format == 'csv' and table.num_rows > self.part_rows:
+                    self._upload_table_in_parts(bucket_name, table, destination_blob_name)
+                    logging.info(f"Table uploaded to {destination_blob_name} in bucket {bucket_name}")
+                    return
+                data = self.serialize_table(table, file_format)
+                self.upload_bytes_to_bucket(bucket_name, pa.BufferReader(data), destination_blob_name,
+                                            CONTENT_TYPES[file_format])
+                return
+
+            prefix = destination_blob_name
+            if prefix.endswith(FILE_EXTENSIONS[file_format]):
+                prefix = prefix[:-len(FILE_EXTENSIONS[file_format])]
+            part_name = f"part-{part_number:05d}{FILE_EXTENSIONS[file_format]}"
+
+            def upload_partition(partition):
+                path, rows = partition
+                data = self.serialize_table(rows, file_format)
+                self.upload_bytes_to_bucket(bucket_name, pa.BufferReader(data), f"{prefix}/{path}/{part_name}",
+                                            CONTENT_TYPES[file_format])
+
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                list(executor.map(upload_partition, self._iter_partitions(table, partition_cols)))
+            logging.info(f"Table uploaded to {prefix} in bucket {bucket_name}, partitioned by {partition_cols}")
+        except Exception as e:
+            logging.error(f"Failed to upload table to GCP: {str(e)}")
+            raise
+
+    def upload_many(self, uploads: Iterable[Tuple[str, Union['pd.DataFrame', bytes, str], str]]) -> None:
+        """Upload several objects concurrently over the shared client
+
+        Each item is (bucket_name, source, destination_blob_name) where the
+        source is a DataFrame, an Arrow table, bytes, or a local file path.
+        """
+        import pandas as pd
+        import pyarrow as pa
+
+        def upload(item):
+            bucket_name, source, destination_blob_name = item
+            if isinstance(source, pd.DataFrame):
+                self.upload_dataframe_to_bucket(bucket_name, source, destination_blob_name)
+            elif isinstance(source, pa.Table):
+                self.upload_table_to_bucket(bucket_name, source, destination_blob_name)
+            elif isinstance(source, (bytes, bytearray)):
+                self.upload_bytes_to_bucket(bucket_name, source, destination_blob_name)
+            else:
+                self.upload_file_to_bucket(bucket_name, source, destination_blob_name)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(upload, uploads))
+
+
+class BatchUploader:
+    """Upload batches to a bucket as numbered parts while the pipeline runs
+
+    Every batch is serialized and uploaded on a background thread, so the
+    caller can write the same batch to the database at the same time. At
+    most 2 * max_workers uploads are in flight. CSV parts are composed into
+    destination_blob_name on close; parquet/arrow parts stay as a dataset
+    under the destination prefix (hive-partitioned with partition_cols).
+    """
+
+    def __init__(self, handler: GCPStorageHandler, bucket_name: str, destination_blob_name: str,
+                 partition_cols: Optional[List[str]] = None, metrics: Optional[PipelineMetrics] = None):
+        self.handler = handler
+        self.bucket_name = bucket_name
+        self.destination_blob_name = destination_blob_name
+        self.partition_cols = partition_cols or []
+        self.file_format = handler.file_format
+        self.extension = FILE_EXTENSIONS[self.file_format]
+        self.prefix = destination_blob_name
+        if self.prefix.endswith(self.extension):
+            self.prefix = self.prefix[:-len(self.extension)]
+        self.part_names: List[str] = []
+        self.rows_uploaded = 0
+        self._executor = ThreadPoolExecutor(max_workers=handler.max_workers)
+        self._in_flight = deque()
+        self.metrics = metrics
+
+    def _upload(self, df: 'pd.DataFrame', part_number: int) -> None:
+        with stage_timer(self.metrics, 'upload', len(df)):
+            self._upload_part(df, part_number)
+
+    def _upload_part(self, df: 'pd.DataFrame', part_number: int) -> None:
+        import pyarrow as pa
+        if self.file_format == 'csv' and not self.partition_cols:
+            # Only the first part carries the CSV header
+            data = GCPStorageHandler._csv_bytes(df, header=(part_number == 0))
+            self.handler.upload_bytes_to_bucket(self.bucket_name, data, self.part_names[part_number], 'text/csv')
+        elif self.partition_cols:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            self.handler.upload_table_to_bucket(self.bucket_name, table, self.prefix, self.file_format,
+                                                self.partition_cols, part_number)
+        else:
+            data = self.handler.serialize_table(pa.Table.from_pandas(df, preserve_index=False), self.file_format)
+            self.handler.upload_bytes_to_bucket(self.bucket_name, pa.BufferReader(data), self.part_names[part_number],
+                                                CONTENT_TYPES[self.file_format])
+
+    def discard_existing_parts(self) -> int:
+        """Delete parts left under the destination by an earlier, unfinished upload
+
+        Part numbers restart at 0 for every uploader, so without this the
+        parts of a crashed run beyond the new ones would stay in the export.
+        """
+        if self.file_format == 'csv' and not self.partition_cols:
+            return self.handler.delete_objects(self.bucket_name, f"{self.destination_blob_name}.parts/")
+        return self.handler.delete_objects(self.bucket_name, f"{self.prefix}/")
+
+    def write(self, df: 'pd.DataFrame') -> None:
+        """Queue one batch for upload"""
+        if df.empty:
+            return
+        part_number = len(self.part_names)
+        if self.file_format == 'csv' and not self.partition_cols:
+            self.part_names.append(f"{self.destination_blob_name}.parts/part-{part_number:05d}")
+        else:
+            self.part_names.append(f"{self.prefix}/part-{part_number:05d}{self.extension}")
+        self._in_flight.append(self._executor.submit(self._upload, df, part_number))
+        self.rows_uploaded += len(df)
+
+        # Wait for the oldest uploads so memory stays bounded
+        while len(self._in_flight) >= 2 * self.handler.max_workers:
+            self._in_flight.popleft().result()
+        if self.metrics is not None:
+            self.metrics.set_gauge('queue_depth', len(self._in_flight), queue='uploads')
+
+    def close(self) -> None:
+        """Wait for the pending uploads and compose the CSV parts"""
+        try:
+            while self._in_flight:
+                self._in_flight.popleft().result()
+        finally:
+            self._executor.shutdown(wait=True)
+
+        if self.file_format == 'csv' and not self.partition_cols and self.part_names:
+            self.handler.compose_parts(self.bucket_name, self.part_names, self.destination_blob_name)
+        logging.info(
+            f"Uploaded {self.rows_uploaded} rows in {len(self.part_names)} parts to "
+            f"{self.prefix} in bucket {self.bucket_name}"
+        )
@@ -1,51 +1,30 @@
+import argparse
+import hashlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from typing import Dict, Iterator, Optional, Tuple
+
 import pandas as pd
-from sqlalchemy import create_engine, text
-from gcp_storage import GCPStorageHandler
-
-# 🔹 PostgreSQL Connection Config
-DB_HOST = "localhost"  # Change if using a remote database
-DB_NAME = "gsm8k"
-DB_USER = "root"
-DB_PASSWORD = "root"
-DB_PORT = "5432"  # Default PostgreSQL port
-
-# 🔹 Initialize GCP Storage Handler
-gcp_handler = GCPStorageHandler("burmese-ai6666-54ed5333f7c9.json")
+from sqlalchemy import text
+
+from digesting_dataset import create_db_engine
+from gcp_storage import GCPStorageHandler, BatchUploader, FILE_EXTENSIONS
+from bulk_writer import BulkWriter
+from normalized_schema import create_normalized_tables, write_normalized
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
 RAW_BUCKET = "my-raw-data-bucket"
 PROCESSED_BUCKET = "my-process-data-bucket"
 
-# 🔹 Create Database Connection
-engine = create_engine(f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}")
-
-# 🔹 Define Table Schema (Ensure it Exists)
-create_table_query = text("""
-CREATE TABLE IF NOT EXISTS gsm8k_data (
-    id SERIAL PRIMARY KEY,
-    original_text TEXT NOT NULL,
-    processed_text TEXT NOT NULL,
-    token_count INT,
-    sentence_count INT,
-    avg_sentence_length FLOAT,
-    unique_tokens INT,
-    created_at TIMESTAMP DEFAULT NOW()
-);
-""")
-
-# Execute table creation
-with engine.connect() as conn:
-    conn.execute(create_table_query)
-    conn.commit()
-
-# 🔹 Load CSV Files into DataFrame
-train_df = pd.read_csv("processed_data/gsm8k_train.csv")
-test_df = pd.read_csv("processed_data/gsm8k_test.csv")
-
-# 🔹 Upload raw data to GCP
-gcp_handler.upload_dataframe_to_bucket(RAW_BUCKET, train_df, "raw/gsm8k_train.csv")
-gcp_handler.upload_dataframe_to_bucket(RAW_BUCKET, test_df, "raw/gsm8k_test.csv")
-
-# 🔹 Select Relevant Columns
-columns_mapping = {
+# 🔹 CSV columns and the table columns they are loaded into
+COLUMNS_MAPPING = {
     "Original": "original_text",
     "Processed": "processed_text",
     "token_count": "token_count",
@@ -54,15 +33,188 @@ columns_mapping = {
     "unique_tokens": "unique_tokens",
 }
 
-train_df = train_df.rename(columns=columns_mapping)
-test_df = test_df.rename(columns=columns_mapping)
+# 🔹 Explicit dtypes so pandas doesn't have to infer them chunk by chunk
+CSV_DTYPES = {
+    "Original": "string",
+    "Processed": "string",
+    "token_count": "Int64",
+    "sentence_count": "Int64",
+    "avg_sentence_length": "float64",
+    "unique_tokens": "Int64",
+}
+
+def arrow_column_types() -> Dict:
+    """CSV_DTYPES as pyarrow types for the pyarrow CSV reader"""
+    import pyarrow as pa
+    return {
+        "Original": pa.string(),
+        "Processed": pa.string(),
+        "token_count": pa.int64(),
+        "sentence_count": pa.int64(),
+        "avg_sentence_length": pa.float64(),
+        "unique_tokens": pa.int64(),
+    }
+
+def create_table(engine):
+    """Create the gsm8k_data table if it doesn't exist"""
+    create_table_query = text("""
+    CREATE TABLE IF NOT EXISTS gsm8k_data (
+        id SERIAL PRIMARY KEY,
+        original_text TEXT NOT NULL,
+        processed_text TEXT NOT NULL,
+        token_count INT,
+        sentence_count INT,
+        avg_sentence_length FLOAT,
+        unique_tokens INT,
+        created_at TIMESTAMP DEFAULT NOW()
+    );
+    """)
+    with engine.connect() as conn:
+        conn.execute(create_table_query)
+        conn.commit()
+    logging.info("Table gsm8k_data created successfully")
+
+def iter_csv_chunks(path: str, chunk_size: int = 100000, csv_engine: str = 'pandas',
+                    block_size: int = 16 * 1024 * 1024) -> Iterator[pd.DataFrame]:
+    """Stream a CSV file as DataFrames, so only one chunk is in memory at a time
+
+    The pandas engine reads chunk_size rows per chunk with CSV_DTYPES; the
+    pyarrow engine reads blocks of block_size bytes with the same types,
+    parsing on several threads.
+    """
+    if csv_engine == 'pyarrow':
+        import pyarrow.csv
+        reader = pyarrow.csv.open_csv(
+            path,
+            read_options=pyarrow.csv.ReadOptions(block_size=block_size),
+            convert_options=pyarrow.csv.ConvertOptions(column_types=arrow_column_types())
+        )
+        for batch in reader:
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, chunksize=chunk_size, dtype=CSV_DTYPES)
+
+def add_chunk_numbers(df: pd.DataFrame, previous: Tuple[Optional[str], int]) -> Tuple[pd.DataFrame, Tuple[str, int]]:
+    """Add content_hash and chunk_number, continuing the numbering of the previous CSV chunk
+    
+    The rows of one original text are consecutive in the CSV, so only the
+    last text of the previous chunk can carry on into this one. previous is
+    that text's hash and chunk count; the same pair is returned for df.
+    """
+    df = df.assign(content_hash=df['original_text'].map(
+        lambda original: hashlib.sha256(str(original).encode('utf-8')).hexdigest()
+    ))
+    df = df.assign(chunk_number=df.groupby('content_hash').cumcount())
+    if df.empty:
+        # e.g. a CSV with only a header
+        return df.assign(content_hash=pd.Series(dtype='string'), chunk_number=pd.Series(dtype='int64')), previous
+    last_hash, last_count = previous
+    if last_hash is not None:
+        df.loc[df['content_hash'] == last_hash, 'chunk_number'] += last_count
+    last_hash = df['content_hash'].iloc[-1]
+    return df, (last_hash, int(df.loc[df['content_hash'] == last_hash, 'chunk_number'].max()) + 1)
+
+def load_file(path: str, engine, gcp_handler: GCPStorageHandler, params: argparse.Namespace) -> int:
+    """Load one CSV into the database and both buckets in a single pass
+
+    Every chunk is parsed once, queued for the raw upload as it is, then
+    renamed, written to the database and queued for the processed upload.
+    Uploads run on background threads while the next chunk is parsed.
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    extension = FILE_EXTENSIONS[gcp_handler.file_format]
+    raw_uploader = BatchUploader(gcp_handler, RAW_BUCKET, f"raw/{name}{extension}")
+    processed_uploader = BatchUploader(gcp_handler, PROCESSED_BUCKET, f"processed/{name}{extension}")
+    writer = BulkWriter(engine)
+    total_rows = 0
+    previous = (None, 0)
+
+    try:
+        for chunk_number, chunk in enumerate(iter_csv_chunks(path, params.chunk_size, params.csv_engine,
+                                                            params.block_size_mb * 1024 * 1024)):
+            if chunk.empty:
+                continue
+            t_start = time()
+            raw_uploader.write(chunk)
+
+            # 🔹 Select relevant columns
+            df = chunk.rename(columns=COLUMNS_MAPPING)
+            df = df[[column for column in COLUMNS_MAPPING.values() if column in df.columns]]
+            if params.schema == "normalized":
+                # Each original text is stored once in documents, its chunks in chunks
+                df, previous = add_chunk_numbers(df, previous)
+                write_normalized(writer, df)
+            else:
+                writer.write("gsm8k_data", df)
+            processed_uploader.write(df)
+
+            total_rows += len(df)
+            logging.info(f"{name}: chunk {chunk_number + 1} loaded ({len(df)} rows), took {time() - t_start:.3f} seconds")
+    finally:
+        raw_uploader.close()
+        processed_uploader.close()
+
+    logging.info(f"{name}: {total_rows} rows loaded into PostgreSQL and GCP Storage")
+    return total_rows
+
+def main(params: argparse.Namespace) -> int:
+    try:
+        engine = create_db_engine(params)
+        if params.schema == "normalized":
+            create_normalized_tables(engine)
+        else:
+            create_table(engine)
+
+        gcp_handler = GCPStorageHandler(
+            params.credentials,
+            max_workers=params.upload_workers,
+            file_format=params.export_format
+        )
+
+        # 🔹 Load the files concurrently, each one streamed chunk by chunk
+        with ThreadPoolExecutor(max_workers=params.parallel_files) as executor:
+            futures = [executor.submit(load_file, path, engine, gcp_handler, params) for path in params.files]
+            total_rows = sum(future.result() for future in futures)
+
+        logging.info(f"Data successfully loaded into PostgreSQL and GCP Storage: {total_rows} rows")
+        return total_rows
+    except Exception as e:
+        logging.error(f"Load pipeline failed: {str(e)}")
+        raise
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load processed CSV files into Postgres and GCP Storage')
+    parser.add_argument('--files', nargs='+',
+                        default=['processed_data/gsm8k_train.csv', 'processed_data/gsm8k_test.csv'],
+                        help='CSV files to load, one split per file')
+    parser.add_argument('--user', default='root', help='user name for postgres')
+    parser.add_argument('--password', default=os.environ.get('PGPASSWORD'), help='password for postgres (default $PGPASSWORD)')
+    parser.add_argument('--host', default='localhost', help='host for postgres')
+    parser.add_argument('--port', default='5432', help='port for postgres')
+    parser.add_argument('--db', default='gsm8k', help='database name for postgres')
+    parser.add_argument('--pool_size', type=int, default=5, help='Connections kept in the database pool')
+    parser.add_argument('--credentials', default=os.environ.get('GOOGLE_APPLICATION_CREDENTIALS'),
+                        help='Service account JSON (default $GOOGLE_APPLICATION_CREDENTIALS)')
+    parser.add_argument('--export_format', default='csv', choices=list(FILE_EXTENSIONS),
+                        help='File format of the bucket uploads')
+    parser.add_argument('--schema', default='flat', choices=['flat', 'normalized'],
+                        help='flat: gsm8k_data, normalized: documents + chunks tables')
+    parser.add_argument('--csv_engine', default='pandas', choices=['pandas', 'pyarrow'], help='CSV parser')
+    parser.add_argument('--chunk_size', type=int, default=100000, help='Rows per chunk (pandas engine)')
+    parser.add_argument('--block_size_mb', type=int, default=16, help='MB per chunk (pyarrow engine)')
+    parser.add_argument('--parallel_files', type=int, default=2, help='Files loaded at the same time')
+    parser.add_argument('--upload_workers', type=int, default=4,
+                        help='Concurrent uploads per file (bounds the chunks held in memory)')
 
-# 🔹 Append Data to PostgreSQL
-train_df.to_sql("gsm8k_data", engine, if_exists="append", index=False)
-test_df.to_sql("gsm8k_data", engine, if_exists="append", index=False)
+    args = parser.parse_args()
+    if args.password is None:
+        parser.error('no postgres password: pass --password or set PGPASSWORD')
 
-# 🔹 Upload processed data to GCP
-gcp_handler.upload_dataframe_to_bucket(PROCESSED_BUCKET, train_df, "processed/gsm8k_train.csv")
-gcp_handler.upload_dataframe_to_bucket(PROCESSED_BUCKET, test_df, "processed/gsm8k_test.csv")
+    try:
+        main(args)
+    except Exception as e:
+        logging.error(str(e))
+        exit(1)
 
-print("✅ Data successfully loaded into PostgreSQL and GCP Storage!")
\ No newline at end of file
+# cmd
+# python load_pipeline.py --files processed_data/gsm8k_train.csv processed_data/gsm8k_test.csv --password=root --csv_engine=pyarrow
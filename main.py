@@ -1,11 +1,38 @@
+import time
+
+# Start of the import/startup time budget
+_START_TIME = time.perf_counter()
+
+import contextlib
+import hashlib
+import itertools
+import json
 import logging
-from typing import Dict, Any
+import os
+import multiprocessing
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Callable, Iterable, Iterator, List, Tuple, Union
 
-from digesting_dataset import load_from_huggingface, create_db_engine
+from digesting_dataset import load_arrow_from_huggingface, stream_from_huggingface, create_db_engine
 from text_preprocessor import TextPreprocessor
-from gcp_storage import GCPStorageHandler
+from bulk_writer import WriterPool
+from dedup_index import NearDuplicateIndex
+from checkpoints import CheckpointStore
+from preprocess_cache import PreprocessCache
+from gcp_storage import GCPStorageHandler, BatchUploader, FILE_EXTENSIONS, parse_gcs_uri
+from blob_cache import BlobCache
+from metrics import PipelineMetrics, stage_timer, timed_iter, profiled
+from adaptive_batching import AdaptiveBatcher, batcher_from_params, estimate_bytes
+from work_leasing import WorkQueue, LeaseHeartbeat, in_shard
+from token_store import TokenShardWriter, pack_token_ids
+from stage_pipeline import Stage, StagePipeline, ProgressTracker
+from normalized_schema import (FLAT_VIEW, create_normalized_tables, create_normalized_indexes,
+                               drop_normalized_indexes, write_normalized)
 from sqlalchemy import text
 import pandas as pd
+import pyarrow as pa
 import argparse
 
 # Configure logging
@@ -14,11 +41,86 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
-def create_table(engine):
-    """Create the database table if it doesn't exist"""
-    create_table_query = text("""
+IMPORT_SECONDS = time.perf_counter() - _START_TIME
+
+def report_startup(preprocessor_seconds: float, budget_seconds: float = None) -> Dict:
+    """Log the import and startup time so it can be tracked between releases"""
+    report = {
+        'import_seconds': round(IMPORT_SECONDS, 3),
+        'preprocessor_seconds': round(preprocessor_seconds, 3),
+        'startup_seconds': round(time.perf_counter() - _START_TIME, 3),
+        'budget_seconds': budget_seconds
+    }
+    logging.info(f"Startup time: {json.dumps(report)}")
+    if budget_seconds is not None and report['startup_seconds'] > budget_seconds:
+        logging.warning(f"Startup took {report['startup_seconds']}s, over the budget of {budget_seconds}s")
+    return report
+
+# Secondary indexes; with --defer_indexes they are dropped before a bulk
+# load and built once it is done
+SECONDARY_INDEXES = {
+    'idx_token_count': 'token_count',
+    'idx_sentence_count': 'sentence_count',
+    'idx_run_id': 'run_id'
+}
+
+def partition_bounds(partitions: int) -> List[str]:
+    """Split points of the content_hash (hex) range into equal parts"""
+    return [f'{i * 0x10000 // partitions:04x}' for i in range(1, partitions)]
+
+def partition_ddl(partitioning: str, partitions: int) -> Tuple[str, List[str]]:
+    """PARTITION BY clause and the CREATE TABLE statements of the partitions
+    
+    Both schemes partition by content_hash so the unique index used to skip
+    already loaded rows stays valid on the partitioned table.
+    """
+    if partitioning == 'hash':
+        return 'PARTITION BY HASH (content_hash)', [
+            f"CREATE TABLE IF NOT EXISTS processed_dataset_p{i} PARTITION OF processed_dataset "
+            f"FOR VALUES WITH (MODULUS {partitions}, REMAINDER {i});"
+            for i in range(partitions)
+        ]
+    if partitioning == 'range':
+        bounds = ['MINVALUE'] + [f"'{bound}'" for bound in partition_bounds(partitions)] + ['MAXVALUE']
+        return 'PARTITION BY RANGE (content_hash)', [
+            f"CREATE TABLE IF NOT EXISTS processed_dataset_p{i} PARTITION OF processed_dataset "
+            f"FOR VALUES FROM ({bounds[i]}) TO ({bounds[i + 1]});"
+            for i in range(partitions)
+        ]
+    raise ValueError(f"Unknown partitioning: {partitioning}")
+
+def create_table(engine, partitioning: str = None, partitions: int = 8, defer_indexes: bool = False):
+    """Create the database table if it doesn't exist
+    
+    With partitioning ('hash' or 'range' on content_hash) a new table is
+    created as a partitioned table with `partitions` partitions; an existing
+    table is kept as it is. With defer_indexes the secondary indexes are
+    dropped so the load doesn't maintain them (see create_indexes).
+    """
+    if partitioning:
+        with engine.connect() as conn:
+            relkind = conn.execute(text(
+                "SELECT relkind FROM pg_class WHERE oid = to_regclass('processed_dataset')"
+            )).scalar()
+        if relkind is not None and relkind != 'p':
+            logging.warning("processed_dataset already exists and is not partitioned, keeping it as it is")
+            partitioning = None
+    
+    if partitioning:
+        partition_clause, partition_tables = partition_ddl(partitioning, partitions)
+        # The primary key of a partitioned table must contain the partition key
+        id_column = 'id SERIAL'
+        primary_key = ',\n        PRIMARY KEY (id, content_hash)'
+        content_hash_column = 'content_hash TEXT NOT NULL'
+    else:
+        partition_clause, partition_tables = '', []
+        id_column = 'id SERIAL PRIMARY KEY'
+        primary_key = ''
+        content_hash_column = 'content_hash TEXT'
+    
+    create_table_query = text(f"""
     CREATE TABLE IF NOT EXISTS processed_dataset (
-        id SERIAL PRIMARY KEY,
+        {id_column},
         original_text TEXT NOT NULL,
         processed_text TEXT NOT NULL,
         token_count INTEGER,
@@ -28,38 +130,77 @@ def create_table(engine):
         max_sentence_length INTEGER,
         min_sentence_length INTEGER,
         chunk_number INTEGER,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    );
-    CREATE INDEX IF NOT EXISTS idx_token_count ON processed_dataset(token_count);
-    CREATE INDEX IF NOT EXISTS idx_sentence_count ON processed_dataset(sentence_count);
+        run_id TEXT,
+        {content_hash_column},
+        token_ids BYTEA,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP{primary_key}
+    ) {partition_clause};
+    {' '.join(partition_tables)}
+    ALTER TABLE processed_dataset ADD COLUMN IF NOT EXISTS run_id TEXT;
+    ALTER TABLE processed_dataset ADD COLUMN IF NOT EXISTS content_hash TEXT;
+    ALTER TABLE processed_dataset ADD COLUMN IF NOT EXISTS token_ids BYTEA;
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_content_hash_chunk ON processed_dataset(content_hash, chunk_number);
     """)
     
     with engine.connect() as conn:
         conn.execute(create_table_query)
         conn.commit()
     logging.info("Database table created successfully")
+    
+    if defer_indexes:
+        drop_indexes(engine)
+    else:
+        create_indexes(engine)
 
-def process_and_load_data(dataset: pd.DataFrame, preprocessor: TextPreprocessor, engine: Any, batch_size: int = 1000):
-    """Process the dataset and load it into the database"""
-    total_processed = 0
-    batch = []
+def create_indexes(engine):
+    """Build the secondary indexes of processed_dataset (no-op when they exist)"""
+    t_start = time.perf_counter()
+    with engine.connect() as conn:
+        for name, column in SECONDARY_INDEXES.items():
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON processed_dataset({column})"))
+        conn.commit()
+    logging.info(f"Secondary indexes ready in {time.perf_counter() - t_start:.3f} seconds")
+
+def drop_indexes(engine):
+    """Drop the secondary indexes before a bulk load"""
+    with engine.connect() as conn:
+        for name in SECONDARY_INDEXES:
+            conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+        conn.commit()
+    logging.info("Secondary indexes dropped until the load is done")
+
+# Preprocessor owned by each worker process of the pool
+_worker_preprocessor = None
+
+def _init_worker(cache_path: str = None, cache_max_bytes: int = None, collect_metrics: bool = False,
+                 sentence_splitter: str = 'punkt'):
+    """Load the TextPreprocessor once per worker process"""
+    global _worker_preprocessor
+    cache = PreprocessCache(cache_path, cache_max_bytes) if cache_path else None
+    metrics = PipelineMetrics() if collect_metrics else None
+    _worker_preprocessor = TextPreprocessor(cache=cache, metrics=metrics, sentence_splitter=sentence_splitter)
+
+def build_batch_items(texts: List[str], results: List[Dict], token_dtype: str = None) -> List[Dict]:
+    """Turn processed texts into rows for the processed_dataset table
     
-    for idx, row in dataset.iterrows():
-        # Extract text from various possible column names
-        text = row.get('text') or row.get('question') or row.get('content')
-        if not text:
-            continue
-            
-        # Process text
-        result = preprocessor.process_text(text)
-        
+    When the results hold token ids and token_dtype is given, every row
+    gets its chunk's ids packed into bytes (token_ids).
+    """
+    batch = []
+    for text, result in zip(texts, results):
         # Skip invalid texts
         if not result['chunks']:
             continue
+        
+        # Natural key of the source row, makes reloading a batch harmless.
+        # It is the text alone: identical texts (also from other splits)
+        # share it and only the first one loaded is kept
+        content_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
             
         # Add each chunk to batch
         for chunk_num, chunk in enumerate(result['chunks']):
             batch_item = {
+                'content_hash': content_hash,
                 'original_text': text,
                 'processed_text': chunk,
                 'chunk_number': chunk_num,
@@ -70,76 +211,835 @@ def process_and_load_data(dataset: pd.DataFrame, preprocessor: TextPreprocessor,
                 'max_sentence_length': result['stats'].get('max_sentence_length', 0),
                 'min_sentence_length': result['stats'].get('min_sentence_length', 0)
             }
+            if token_dtype and 'token_ids' in result:
+                batch_item['token_ids'] = pack_token_ids(result['token_ids'][chunk_num], token_dtype)
             batch.append(batch_item)
+    return batch
+
+def _process_shard(shard) -> Tuple[List[Dict], Dict]:
+    """Process one shard of texts inside a worker process
+    
+    Returns the rows and the worker's metrics since the previous shard.
+    """
+    texts, max_tokens, stride, token_ids = shard
+    results = _worker_preprocessor.process_texts(texts, max_tokens, stride, token_ids)
+    metrics = _worker_preprocessor.metrics
+    rows = build_batch_items(texts, results, _worker_preprocessor.token_dtype if token_ids else None)
+    return rows, metrics.snapshot(reset=True) if metrics is not None else None
+
+def create_worker_pool(preprocessor: TextPreprocessor, workers: int):
+    """Process pool whose workers each load their own TextPreprocessor"""
+    # Spawn keeps the tokenizer threads of the parent out of the workers
+    ctx = multiprocessing.get_context('spawn')
+    # Workers open the same cache file as the parent preprocessor
+    cache = preprocessor.cache
+    initargs = (
+        cache.path if cache is not None else None,
+        cache.max_bytes if cache is not None else None,
+        preprocessor.metrics is not None,
+        preprocessor.sentence_splitter
+    )
+    return ctx.Pool(workers, initializer=_init_worker, initargs=initargs)
+
+# Columns that can hold the text, in order of preference
+TEXT_COLUMNS = ('text', 'question', 'content')
+
+# Rows converted to Python strings at a time when reading an Arrow table
+ARROW_BATCH_ROWS = 10000
+
+def resolve_text_column(columns: Iterable[str]) -> str:
+    """Pick the text column once per dataset instead of probing every row"""
+    columns = list(columns)
+    for name in TEXT_COLUMNS:
+        if name in columns:
+            return name
+    raise ValueError(f"No text column ({', '.join(TEXT_COLUMNS)}) in {columns}")
+
+def iter_texts(dataset: Union[pd.DataFrame, pa.Table, Iterable[Union[pd.DataFrame, pa.Table]]]) -> Iterator[str]:
+    """Yield the text of every row that has one
+    
+    The dataset is a DataFrame, an Arrow table, or an iterable of either
+    (streaming mode). The text column is resolved from the first batch.
+    Arrow tables are read record batch by record batch straight from their
+    column, so no pandas copy or per-row Series is made.
+    """
+    batches = [dataset] if isinstance(dataset, (pd.DataFrame, pa.Table)) else dataset
+    column = None
+    for batch in batches:
+        if column is None:
+            column = resolve_text_column(batch.column_names if isinstance(batch, pa.Table) else batch.columns)
+        if isinstance(batch, pa.Table):
+            for record_batch in batch.select([column]).to_batches(max_chunksize=ARROW_BATCH_ROWS):
+                for text in record_batch.column(0).to_pylist():
+                    if text:
+                        yield text
+        else:
+            for text in batch[column]:
+                if isinstance(text, str) and text:
+                    yield text
+
+def iter_unique_texts(items: Iterable[Tuple[int, str]], preprocessor: TextPreprocessor,
+                      dedup_index: NearDuplicateIndex) -> Iterator[Tuple[int, str]]:
+    """Drop texts that are near duplicates of a text already in the index"""
+    skipped = 0
+    for position, text in items:
+        if dedup_index.add_if_unique(preprocessor.clean_text(text)):
+            yield position, text
+        else:
+            skipped += 1
+            if preprocessor.metrics is not None:
+                preprocessor.metrics.inc('texts_skipped_total', reason='duplicate')
+    logging.info(f"Skipped {skipped} near-duplicate texts")
+
+def iter_shards(items: Iterable, shard_size: int, batcher: AdaptiveBatcher = None) -> Iterator[List]:
+    """Group items into lists of shard_size, or of batcher.size when a batcher is given"""
+    shard = []
+    for item in items:
+        shard.append(item)
+        if len(shard) >= (batcher.size if batcher is not None else shard_size):
+            yield shard
+            shard = []
+    if shard:
+        yield shard
+
+def iter_processed_rows(items: Iterable[Tuple[int, str]], preprocessor: TextPreprocessor, shard_size: int = 1000,
+                        max_tokens: int = 512, stride: int = 0, workers: int = 1,
+                        token_ids: bool = False, pool=None) -> Iterator[Tuple[List[Dict], int]]:
+    """Process (position, text) pairs shard by shard, in the original order
+    
+    Yields the rows of each shard together with the number of source texts
+    that are done once those rows are written (last position + 1).
+    With workers > 1 the shards are spread over a process pool where every
+    worker loads its own TextPreprocessor once; their stage metrics are
+    merged into preprocessor.metrics. With token_ids the rows carry the
+    packed token ids of their chunk. A pool from create_worker_pool can be
+    passed in to reuse its workers across calls; it is left open.
+    """
+    shards = iter_shards(items, shard_size)
+    metrics = preprocessor.metrics
+    token_dtype = preprocessor.token_dtype if token_ids else None
+    
+    if workers <= 1:
+        for shard in shards:
+            shard_texts = [text for _, text in shard]
+            results = preprocessor.process_texts(shard_texts, max_tokens, stride, token_ids)
+            with stage_timer(metrics, 'build_rows', len(shard_texts)):
+                rows = build_batch_items(shard_texts, results, token_dtype)
+            yield rows, shard[-1][0] + 1
+        return
+    
+    def collect(result):
+        rows, snapshot = result.get()
+        if snapshot is not None:
+            metrics.merge(snapshot)
+        return rows
+    
+    with create_worker_pool(preprocessor, workers) if pool is None else contextlib.nullcontext(pool) as pool:
+        # Keep a bounded number of shards in flight so memory stays flat,
+        # and collect them in the order they were submitted
+        in_flight = deque()
+        for shard in shards:
+            shard_texts = [text for _, text in shard]
+            in_flight.append((
+                pool.apply_async(_process_shard, ((shard_texts, max_tokens, stride, token_ids),)),
+                shard[-1][0] + 1
+            ))
+            if metrics is not None:
+                metrics.set_gauge('queue_depth', len(in_flight), queue='shards')
+            if len(in_flight) >= workers * 2:
+                result, done = in_flight.popleft()
+                yield collect(result), done
+        while in_flight:
+            result, done = in_flight.popleft()
+            yield collect(result), done
+
+def load_in_stages(items: Iterable[Tuple[int, str]], preprocessor: TextPreprocessor,
+                   write_batch: Callable[[List[Dict]], None], upload_batch: Callable[[List[Dict]], None] = None,
+                   batch_size: int = 1000, max_tokens: int = 512, stride: int = 0, workers: int = 1,
+                   queue_size: int = 4, write_concurrency: int = 1, skip_texts: int = 0,
+                   on_progress: Callable[[int], None] = None, batcher: AdaptiveBatcher = None,
+                   token_ids: bool = False, pool=None) -> Tuple[int, int]:
+    """Run fetch -> preprocess -> DB write -> upload as overlapping stages
+    
+    Fetching runs on its own thread, preprocessing on `workers` threads that
+    each keep one shard busy in the process pool (or one thread in-process
+    when workers <= 1), DB writes on write_concurrency threads and uploads
+    on one thread. The stages are connected by queues of queue_size shards,
+    so wall time follows the slowest stage instead of the sum of them.
+    write_batch must be safe to call from several threads. With a batcher
+    the shard size (in source texts) follows batcher.size, which adapts to
+    the measured DB writes. A pool passed in is used and left open.
+    Returns the number of rows written and of source texts done.
+    """
+    metrics = preprocessor.metrics
+    token_dtype = preprocessor.token_dtype if token_ids else None
+    tracker = ProgressTracker(skip_texts)
+    total_processed = 0
+    own_pool = pool is None and workers > 1
+    if own_pool:
+        pool = create_worker_pool(preprocessor, workers)
+    
+    def preprocess(item):
+        seq, shard = item
+        shard_texts = [text for _, text in shard]
+        if pool is not None:
+            rows, snapshot = pool.apply(_process_shard, ((shard_texts, max_tokens, stride, token_ids),))
+            if snapshot is not None and metrics is not None:
+                metrics.merge(snapshot)
+        else:
+            results = preprocessor.process_texts(shard_texts, max_tokens, stride, token_ids)
+            with stage_timer(metrics, 'build_rows', len(shard_texts)):
+                rows = build_batch_items(shard_texts, results, token_dtype)
+        return seq, shard[-1][0] + 1, rows, len(shard_texts)
+    
+    def write(item):
+        if item[2]:
+            t_write = time.perf_counter()
+            write_batch(item[2])
+            if batcher is not None:
+                batcher.record(item[3], estimate_bytes(item[2]), time.perf_counter() - t_write)
+        return item
+    
+    def upload(item):
+        if item[2]:
+            upload_batch(item[2])
+        return item
+    
+    stages = [
+        Stage('preprocess', preprocess, max(workers, 1)),
+        Stage('db_write', write, write_concurrency)
+    ]
+    if upload_batch is not None:
+        stages.append(Stage('upload', upload))
+    
+    try:
+        pipeline = StagePipeline(enumerate(iter_shards(items, batch_size, batcher)), stages, queue_size, metrics)
+        for seq, done, rows, _ in pipeline.run():
+            total_processed += len(rows)
+            # Only checkpoint once every earlier shard is written as well
+            mark = tracker.complete(seq, done)
+            if mark is not None:
+                logging.info(f"Processed {total_processed} texts")
+                if on_progress:
+                    on_progress(mark)
+    finally:
+        if own_pool:
+            pool.terminate()
+            pool.join()
+    return total_processed, tracker.mark
+
+def upload_raw_batches(gcp_handler: GCPStorageHandler, bucket_name: str, prefix: str,
+                       batches: Iterable[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+    """Upload every streamed batch as its own part and pass it on"""
+    extension = FILE_EXTENSIONS[gcp_handler.file_format]
+    for part_number, batch in enumerate(batches):
+        gcp_handler.upload_dataframe_to_bucket(bucket_name, batch, f"{prefix}/part-{part_number:05d}{extension}")
+        yield batch
+
+def add_partition_columns(df: pd.DataFrame, split: str, partition_by: List[str],
+                          chunk_bucket_size: int = 4) -> pd.DataFrame:
+    """Add the columns used for hive-style partitioning of the export"""
+    if 'split' in partition_by:
+        df['split'] = split
+    if 'chunk_bucket' in partition_by:
+        df['chunk_bucket'] = df['chunk_number'] // chunk_bucket_size
+    return df
+
+def process_and_load_data(dataset: Union[pd.DataFrame, pa.Table, Iterable[pd.DataFrame]], preprocessor: TextPreprocessor, engine: Any, batch_size: int = 1000,
+                          max_tokens: int = 512, stride: int = 0, workers: int = 1,
+                          dedup_index: NearDuplicateIndex = None, run_id: str = None,
+                          uploader: BatchUploader = None, split: str = None,
+                          partition_by: List[str] = None, chunk_bucket_size: int = 4,
+                          skip_texts: int = 0, on_progress: Callable[[int], None] = None,
+                          pipelined: bool = False, queue_size: int = 4, write_concurrency: int = 1,
+                          schema: str = 'flat', batcher: AdaptiveBatcher = None,
+                          num_shards: int = 1, shard_index: int = 0,
+                          token_storage: List[str] = None, token_writer: TokenShardWriter = None,
+                          pool=None):
+    """Process the dataset and load it into the database
+    
+    When an uploader is given every batch is also handed to it, so the
+    bucket export is written while the rows go into the table.
+    The first skip_texts source texts are skipped (resuming a run), and
+    on_progress is called with the number of source texts done after every
+    committed batch. Rows already in the table are skipped by content_hash
+    (a hash of the text only, so a text repeated in the dataset or loaded
+    before from another split is stored once).
+    Stage timings go to preprocessor.metrics when it is set.
+    With pipelined=True the stages run concurrently (see load_in_stages),
+    each shard of batch_size texts being written as one batch.
+    write_concurrency batches are committed in parallel, each on its own
+    connection (see WriterPool). With schema='normalized' the rows go into
+    the documents and chunks tables instead of processed_dataset.
+    With a batcher (see AdaptiveBatcher) the number of rows per written
+    batch, or the texts per shard when pipelined, starts at batch_size and
+    follows the measured write size and latency.
+    With num_shards > 1 only the texts at positions shard_index,
+    shard_index + num_shards, ... are loaded; positions and skip_texts
+    still count every source text.
+    token_storage lists where the token ids of the chunks are kept:
+    'bytea' stores them packed in the token_ids column, 'shards' appends
+    them to token_writer (see token_store.py).
+    pool is a worker pool from create_worker_pool to reuse across calls
+    (e.g. one per leased range); without it each call starts its own.
+    """
+    total_processed = 0
+    batch = []
+    batch_done = skip_texts
+    texts_seen = skip_texts
+    metrics = preprocessor.metrics
+    token_storage = token_storage or []
+    writer_pool = WriterPool(engine, write_concurrency, metrics=metrics)
+    # Batches handed to the writer pool, with the source texts they complete
+    pending_writes = deque()
+    if metrics is not None and not isinstance(dataset, (pd.DataFrame, pa.Table)):
+        # Streamed batches are downloaded while they are pulled
+        dataset = timed_iter(dataset, metrics, 'fetch')
+    
+    def upload_batch(batch):
+        # The text exports leave the binary token ids to the token shards
+        df = pd.DataFrame(batch).drop(columns=['token_ids'], errors='ignore')
+        if partition_by:
+            df = add_partition_columns(df, split, partition_by, chunk_bucket_size)
+        uploader.write(df)
+    
+    def tag_batch(batch):
+        if run_id:
+            for item in batch:
+                item['run_id'] = run_id
+        if token_writer is not None:
+            token_writer.write_rows(batch)
+        if token_storage and 'bytea' not in token_storage:
+            for item in batch:
+                item.pop('token_ids', None)
+    
+    def write_rows(batch):
+        t_write = time.perf_counter()
+        if schema == 'normalized':
+            write_normalized(writer_pool, batch)
+        else:
+            writer_pool.write('processed_dataset', batch, skip_conflicts=True)
+        if batcher is not None and not pipelined:
+            batcher.record(len(batch), estimate_bytes(batch), time.perf_counter() - t_write)
+    
+    def commit_batch(batch):
+        tag_batch(batch)
+        write_rows(batch)
+    
+    def write_batch(batch, done):
+        tag_batch(batch)
+        if uploader is not None:
+            # Upload runs on background threads while COPY writes the batch
+            upload_batch(batch)
+        if write_concurrency <= 1:
+            write_rows(batch)
+            if on_progress:
+                on_progress(done)
+            return
+        pending_writes.append((writer_pool.submit_fn(write_rows, batch), done))
+        # Checkpoint the batches committed so far, in order
+        while pending_writes and pending_writes[0][0].done():
+            future, committed = pending_writes.popleft()
+            future.result()
+            if on_progress:
+                on_progress(committed)
+    
+    def iter_items():
+        nonlocal texts_seen
+        # Skip the texts a previous run already committed
+        for position, text in itertools.islice(enumerate(iter_texts(dataset)), skip_texts, None):
+            texts_seen = position + 1
+            if in_shard(position, num_shards, shard_index):
+                yield position, text
+    
+    items = iter_items()
+    if dedup_index is not None:
+        items = iter_unique_texts(items, preprocessor, dedup_index)
+    
+    if pipelined:
+        total_processed, batch_done = load_in_stages(
+            items,
+            preprocessor,
+            commit_batch,
+            upload_batch if uploader is not None else None,
+            batch_size,
+            max_tokens,
+            stride,
+            workers,
+            queue_size,
+            write_concurrency,
+            skip_texts,
+            on_progress,
+            batcher,
+            bool(token_storage),
+            pool
+        )
+    else:
+        for rows, done in iter_processed_rows(items, preprocessor, batch_size, max_tokens, stride, workers,
+                                              bool(token_storage), pool):
+            batch.extend(rows)
+            batch_done = done
             
-        # Process batch when it reaches batch_size
-        if len(batch) >= batch_size:
-            df = pd.DataFrame(batch)
-            df.to_sql('processed_dataset', engine, if_exists='append', index=False)
+            # Process batch when it reaches batch_size
+            if len(batch) >= (batcher.size if batcher is not None else batch_size):
+                write_batch(batch, batch_done)
+                total_processed += len(batch)
+                logging.info(f"Processed {total_processed} texts")
+                batch = []
+        
+        # Process remaining items
+        if batch:
+            write_batch(batch, batch_done)
             total_processed += len(batch)
-            logging.info(f"Processed {total_processed} texts")
-            batch = []
-    
-    # Process remaining items
-    if batch:
-        df = pd.DataFrame(batch)
-        df.to_sql('processed_dataset', engine, if_exists='append', index=False)
-        total_processed += len(batch)
+        while pending_writes:
+            future, committed = pending_writes.popleft()
+            future.result()
+            if on_progress:
+                on_progress(committed)
+    writer_pool.close()
+    if metrics is not None:
+        metrics.inc('texts_read_total', texts_seen - skip_texts)
+        metrics.inc('rows_written_total', total_processed)
+    if on_progress:
+        on_progress(max(batch_done, texts_seen))
     
+    logging.info(
+        f"Average write throughput: {writer_pool.rows_per_second:.0f} rows/sec per connection, "
+        f"{write_concurrency} connection(s)"
+    )
     return total_processed
 
+def process_leased_ranges(work_queue: WorkQueue, job_id: str, dataset: Union[pd.DataFrame, pa.Table],
+                          run_range: Callable[[Union[pd.DataFrame, pa.Table], int], int],
+                          poll_seconds: float = 10) -> int:
+    """Lease row ranges of the dataset until every range is done
+    
+    run_range(rows, range_start) loads the rows of one range and returns the
+    number of rows written. A range that fails is released for another
+    worker and the error is raised. When nothing is left to lease but other
+    workers still hold leases, this waits for them: a lease of a crashed
+    worker expires and is taken over here.
+    """
+    total_processed = 0
+    while True:
+        lease = work_queue.lease(job_id)
+        if lease is None:
+            progress = work_queue.progress(job_id)
+            if not progress.get('leased'):
+                logging.info(f"Job {job_id} has no ranges left: {progress}")
+                return total_processed
+            time.sleep(poll_seconds)
+            continue
+        
+        range_start, range_end = lease
+        logging.info(f"Leased rows [{range_start}, {range_end}) of job {job_id}")
+        try:
+            with LeaseHeartbeat(work_queue, job_id, range_start):
+                rows_written = run_range(dataset[range_start:range_end], range_start)
+        except Exception:
+            work_queue.release(job_id, range_start)
+            raise
+        if not work_queue.complete(job_id, range_start, rows_written):
+            logging.warning(f"Range {range_start} of job {job_id} was taken over by another worker before it completed")
+        total_processed += rows_written
+
+def export_run_to_bucket(engine: Any, run_id: str, uploader: BatchUploader, split: str = None,
+                         partition_by: List[str] = None, chunk_bucket_size: int = 4, chunk_size: int = 100000,
+                         source: str = 'processed_dataset') -> int:
+    """Export the rows of one run with a server-side cursor, chunk by chunk
+    
+    source is processed_dataset or, for the normalized schema, FLAT_VIEW;
+    both give the same columns.
+    """
+    total_rows = 0
+    query = text(f'SELECT * FROM {source} WHERE run_id = :run_id ORDER BY id')
+    with engine.connect() as conn:
+        conn = conn.execution_options(stream_results=True)
+        for df in pd.read_sql(query, conn, params={'run_id': run_id}, chunksize=chunk_size):
+            # The text exports leave the binary token ids to the token shards
+            df = df.drop(columns=['token_ids'], errors='ignore')
+            if partition_by:
+                df = add_partition_columns(df, split, partition_by, chunk_bucket_size)
+            uploader.write(df)
+            total_rows += len(df)
+    return total_rows
+
+def job_id_for(params: Dict) -> str:
+    """Work queue job of a dataset split (coordinator mode)"""
+    return f"{params['dataset_name']}/{params['split']}/{params.get('subset') or ''}"
+
+def db_params_for(params: Dict) -> argparse.Namespace:
+    """create_db_engine settings from the command line parameters"""
+    return argparse.Namespace(
+        user=params['user'],
+        password=params['password'],
+        host=params['host'],
+        port=params['port'],
+        db=params['db'],
+        # Every parallel writer keeps a connection, plus one for checkpoints
+        pool_size=max(params.get('pool_size') or 5, params.get('write_concurrency', 1) + 1),
+        max_overflow=params.get('max_overflow', 10),
+        pool_timeout=params.get('pool_timeout', 30),
+        pool_recycle=params.get('pool_recycle', -1)
+    )
+
+def reset_job(params: Dict) -> None:
+    """Delete the work ranges of a coordinator job so the next workers plan it again
+
+    A separate one-shot step (--reset_job), run once while no worker is
+    running, so a restarted replica can never wipe the progress of the
+    others.
+    """
+    work_queue = WorkQueue(create_db_engine(db_params_for(params)))
+    work_queue.create_table()
+    work_queue.reset(job_id_for(params))
+
 def main(params: Dict):
     try:
-        # Step 1: Load dataset from HuggingFace
-        logging.info(f"Loading dataset {params['dataset_name']} from HuggingFace")
-        dataset = load_from_huggingface(
-            params['dataset_name'],
-            params['split'],
-            params.get('subset')
+        if params.get('reset_job'):
+            reset_job(params)
+            return
+
+        if params.get('offline'):
+            # Nothing may be downloaded: HuggingFace reads its local cache only
+            os.environ['PIPELINE_OFFLINE'] = '1'
+            os.environ['HF_HUB_OFFLINE'] = '1'
+            os.environ['HF_DATASETS_OFFLINE'] = '1'
+        if params.get('artifacts_dir'):
+            os.environ['PIPELINE_ARTIFACTS_DIR'] = params['artifacts_dir']
+        
+        streaming = params.get('streaming', False)
+        source = params.get('source')
+        num_shards = params.get('num_shards') or 1
+        shard_index = params.get('shard_index') or 0
+        coordinator = params.get('coordinator', False)
+        if not 0 <= shard_index < num_shards:
+            raise ValueError(f"--shard_index must be between 0 and {num_shards - 1}")
+        if coordinator and (streaming or num_shards > 1):
+            raise ValueError("--coordinator leases ranges of the loaded dataset, it can't be combined with --streaming or --num_shards")
+        if coordinator and params.get('restart'):
+            # Every replica gets the same command; resetting here would wipe the others' progress
+            raise ValueError("--restart doesn't apply to --coordinator, reset the job once with --reset_job before starting the workers")
+        export_format = params.get('export_format', 'csv')
+        extension = FILE_EXTENSIONS[export_format]
+        raw_table = None
+        metrics = PipelineMetrics()
+        if params.get('metrics_port'):
+            metrics.serve(params['metrics_port'])
+        gcp_handler = GCPStorageHandler(
+            "burmese-ai6666-54ed5333f7c9.json",
+            file_format=export_format,
+            compression=params.get('compression', 'zstd'),
+            row_group_size=params.get('row_group_size', 100000)
         )
-        logging.info(f"Successfully loaded {len(dataset)} rows from HuggingFace")
         
-        # Step 2: Initialize preprocessor and GCP handler
-        preprocessor = TextPreprocessor()
-        gcp_handler = GCPStorageHandler("burmese-ai6666-54ed5333f7c9.json")
+        # Step 1: Load dataset from HuggingFace, or from a bucket with --source
+        if source:
+            # e.g. the raw split uploaded by an earlier run, downloaded once
+            # into the local cache and read again from there
+            bucket_name, prefix = parse_gcs_uri(source)
+            logging.info(f"Loading dataset {params['dataset_name']} from {source}")
+            download_cache = BlobCache(
+                params.get('download_cache_dir', '.bucket_cache'),
+                params.get('download_cache_mb', 10240) * 1024 * 1024
+            )
+            dataset = gcp_handler.stream_tables(
+                bucket_name,
+                prefix,
+                download_cache,
+                params.get('prefetch', 4),
+                params.get('download_part_mb', 32) * 1024 * 1024,
+                params.get('stream_batch_size', 10000),
+                metrics
+            )
+            if coordinator:
+                # Ranges are sliced from the whole table
+                dataset = pa.concat_tables(list(dataset), promote_options='default')
+                logging.info(f"Successfully loaded {len(dataset)} rows from {source}")
+        elif streaming:
+            logging.info(f"Streaming dataset {params['dataset_name']} from HuggingFace")
+            # Batches are pulled lazily by the processing step below
+            dataset = stream_from_huggingface(
+                params['dataset_name'],
+                params['split'],
+                params.get('subset'),
+                params.get('stream_batch_size', 10000)
+            )
+        else:
+            logging.info(f"Loading dataset {params['dataset_name']} from HuggingFace")
+            # Stay in Arrow: the raw export and the text column are read
+            # from the table, no pandas copy of the strings is made
+            raw_table = load_arrow_from_huggingface(
+                params['dataset_name'],
+                params['split'],
+                params.get('subset')
+            )
+            dataset = raw_table
+            logging.info(f"Successfully loaded {len(dataset)} rows from HuggingFace")
         
-        # Step 3: Upload raw data to GCP
-        logging.info("Uploading raw data to GCP bucket")
-        gcp_handler.upload_dataframe_to_bucket(
-            "my-raw-data-bucket",
-            dataset,
-            f"raw/{params['dataset_name']}_{params['split']}.csv"
+        # Step 2: Initialize preprocessor
+        cache = None
+        if params.get('cache_path'):
+            cache = PreprocessCache(params['cache_path'], params.get('cache_max_mb', 1024) * 1024 * 1024)
+        t_preprocessor = time.perf_counter()
+        preprocessor = TextPreprocessor(
+            cache=cache,
+            metrics=metrics,
+            sentence_splitter=params.get('sentence_splitter', 'punkt')
         )
+        startup = report_startup(time.perf_counter() - t_preprocessor, params.get('startup_budget'))
+        metrics.set_gauge('startup_seconds', startup['startup_seconds'])
+        
+        # Step 3: Upload raw data to GCP
+        # In pipelined mode the raw upload runs in the background while
+        # the data is processed. Data read with --source is already in a
+        # bucket and is not uploaded again.
+        if not source:
+            logging.info("Uploading raw data to GCP bucket")
+        pipelined = params.get('pipelined', False)
+        background = ThreadPoolExecutor(max_workers=1)
+        raw_upload = None
+        
+        def start_raw_upload():
+            return background.submit(
+                gcp_handler.upload_table_to_bucket,
+                "my-raw-data-bucket",
+                raw_table,
+                f"raw/{params['dataset_name']}_{params['split']}{extension}"
+            )
+        
+        # Only one worker of a sharded job uploads the raw data: shard 0, or
+        # in coordinator mode the worker that plans the ranges (step 6)
+        if streaming and not source and shard_index == 0:
+            # Each batch is uploaded as a part while it flows to processing
+            dataset = upload_raw_batches(
+                gcp_handler,
+                "my-raw-data-bucket",
+                f"raw/{params['dataset_name']}_{params['split']}",
+                dataset
+            )
+        elif not streaming and not source and not coordinator and shard_index == 0:
+            raw_upload = start_raw_upload()
+        if raw_upload is not None and not pipelined:
+            raw_upload.result()
         
         # Step 4: Create database connection
-        db_params = argparse.Namespace(
-            user=params['user'],
-            password=params['password'],
-            host=params['host'],
-            port=params['port'],
-            db=params['db']
-        )
-        engine = create_db_engine(db_params)
+        engine = create_db_engine(db_params_for(params))
         
         # Step 5: Create table
-        create_table(engine)
+        schema = params.get('schema', 'flat')
+        if schema == 'normalized':
+            if params.get('partitioning'):
+                logging.warning("--partitioning only applies to the flat processed_dataset table, ignoring it")
+            create_normalized_tables(engine)
+            if params.get('defer_indexes'):
+                drop_normalized_indexes(engine)
+            else:
+                create_normalized_indexes(engine)
+        else:
+            create_table(
+                engine,
+                params.get('partitioning'),
+                params.get('partitions', 8),
+                params.get('defer_indexes', False)
+            )
+        token_storage = params.get('token_storage') or []
+        if 'bytea' in token_storage:
+            # Tell consumers how to read the packed ids (token_store.unpack_token_ids)
+            with engine.connect() as conn:
+                conn.execute(text(
+                    f"COMMENT ON COLUMN {'chunks' if schema == 'normalized' else 'processed_dataset'}.token_ids IS "
+                    f"'{preprocessor.token_dtype} little-endian token ids of {preprocessor.tokenizer.name_or_path}'"
+                ))
+                conn.commit()
+        # Every static shard keeps its own checkpoint; in coordinator mode the
+        # work ranges record the progress instead
+        checkpoint_split = params['split']
+        if num_shards > 1:
+            checkpoint_split = f"{params['split']}#shard-{shard_index}-of-{num_shards}"
+        checkpoints = CheckpointStore(engine)
+        checkpoints.create_table()
+        if params.get('restart'):
+            checkpoints.reset(params['dataset_name'], checkpoint_split, params.get('subset'))
+        skip_texts = 0 if coordinator else checkpoints.get(params['dataset_name'], checkpoint_split, params.get('subset'))
+        run_id = None
+        if skip_texts:
+            logging.info(f"Resuming after {skip_texts} texts completed by a previous run")
+            # Keep the run_id of the interrupted run: its committed rows are
+            # part of this run's export
+            run_id = checkpoints.get_run_id(params['dataset_name'], checkpoint_split, params.get('subset'))
         
         # Step 6: Process and load data
-        total_processed = process_and_load_data(
-            dataset,
-            preprocessor,
-            engine,
-            params.get('batch_size', 1000)
+        run_id = run_id or uuid.uuid4().hex
+        export_mode = params.get('export_mode', 'tee')
+        if skip_texts and export_mode == 'tee':
+            # The batches uploaded before the crash don't match the checkpoint
+            # (uploads run ahead of the commits), so export every committed
+            # row of the run from the table instead
+            logging.info("Resumed run: exporting the processed rows with the cursor instead of tee")
+            export_mode = 'cursor'
+        partition_by = params.get('partition_by') or []
+        processed_name = f"processed/{params['dataset_name']}_{params['split']}_processed"
+        work_queue = None
+        if coordinator:
+            work_queue = WorkQueue(engine, lease_seconds=params.get('lease_seconds', 120))
+            work_queue.create_table()
+            # Each worker exports its own rows (cursor mode) next to the others
+            processed_name = f"{processed_name}-{work_queue.worker_id}"
+        elif num_shards > 1:
+            processed_name = f"{processed_name}-shard-{shard_index:05d}-of-{num_shards:05d}"
+        uploader = BatchUploader(
+            gcp_handler,
+            "my-process-data-bucket",
+            f"{processed_name}{extension}",
+            partition_by,
+            metrics
         )
+        if skip_texts:
+            uploader.discard_existing_parts()
+        logging.info(f"Starting run {run_id}")
+        
+        token_writer = None
+        if 'shards' in token_storage:
+            token_writer = TokenShardWriter(
+                params.get('token_shard_dir', 'token_shards'),
+                preprocessor.token_dtype,
+                f"{params['dataset_name'].replace('/', '_')}_{params['split']}-{run_id}",
+                params.get('token_shard_rows', 100000)
+            )
+        
+        dedup_index = None
+        if params.get('dedup') or params.get('dedup_index'):
+            dedup_index = NearDuplicateIndex.load_or_create(params.get('dedup_index'))
+        
+        def on_progress(done):
+            if not coordinator:
+                checkpoints.update(params['dataset_name'], checkpoint_split, params.get('subset'), done, run_id)
+            if params.get('metrics_textfile'):
+                metrics.write_textfile(params['metrics_textfile'])
+        
+        run = process_and_load_data
+        if params.get('profile') and not coordinator:
+            run = profiled(process_and_load_data, params['profile'])
+        batcher = batcher_from_params(params, params.get('batch_size', 1000), 'batch', metrics)
+        
+        def load(rows, rows_uploader, rows_skip):
+            return run(
+                rows,
+                preprocessor,
+                engine,
+                batch_size=params.get('batch_size', 1000),
+                max_tokens=params.get('max_tokens', 512),
+                stride=params.get('stride', 0),
+                workers=params.get('workers', 1),
+                dedup_index=dedup_index,
+                run_id=run_id,
+                uploader=rows_uploader if export_mode == 'tee' else None,
+                split=params['split'],
+                partition_by=partition_by,
+                chunk_bucket_size=params.get('chunk_bucket_size', 4),
+                skip_texts=rows_skip,
+                on_progress=on_progress,
+                pipelined=pipelined,
+                queue_size=params.get('queue_size', 4),
+                write_concurrency=params.get('write_concurrency', 1),
+                schema=schema,
+                batcher=batcher,
+                num_shards=num_shards,
+                shard_index=shard_index,
+                token_storage=token_storage,
+                token_writer=token_writer,
+                pool=worker_pool
+            )
+        
+        # The worker processes load the tokenizer and punkt once for the
+        # whole run, not once per leased range
+        workers = params.get('workers', 1)
+        worker_pool = create_worker_pool(preprocessor, workers) if workers > 1 else None
+        try:
+            if coordinator:
+                # Scale the app to N replicas: they all lease ranges of the same job
+                job_id = job_id_for(params)
+                if work_queue.plan(job_id, len(dataset), params.get('lease_rows', 10000)) and not source:
+                    raw_upload = start_raw_upload()
+            
+                def run_range(rows, range_start):
+                    # One export object per range, so a range done twice is uploaded once
+                    range_uploader = BatchUploader(
+                        gcp_handler,
+                        "my-process-data-bucket",
+                        f"processed/{params['dataset_name']}_{params['split']}_processed/range-{range_start:012d}{extension}",
+                        partition_by,
+                        metrics
+                    )
+                    try:
+                        return load(rows, range_uploader, 0)
+                    finally:
+                        range_uploader.close()
+            
+                process_ranges = process_leased_ranges
+                if params.get('profile'):
+                    # One profile covering every range this replica leases
+                    process_ranges = profiled(process_leased_ranges, params['profile'])
+                total_processed = process_ranges(work_queue, job_id, dataset, run_range)
+            else:
+                total_processed = load(dataset, uploader, skip_texts)
+        finally:
+            if worker_pool is not None:
+                worker_pool.terminate()
+                worker_pool.join()
+        if raw_upload is not None:
+            raw_upload.result()
+        background.shutdown()
+        
+        if cache is not None:
+            logging.info(f"Preprocessing cache stats: {cache.stats()}")
+        
+        if dedup_index is not None and params.get('dedup_index'):
+            dedup_index.save(params['dedup_index'])
+        
+        if params.get('defer_indexes'):
+            # Build the indexes once instead of maintaining them row by row
+            if schema == 'normalized':
+                create_normalized_indexes(engine)
+            else:
+                create_indexes(engine)
         
         # Step 7: Upload processed data to GCP
+        # In tee mode the batches were uploaded during step 6, otherwise the
+        # rows of this run are read back with a server-side cursor
         logging.info("Uploading processed data to GCP bucket")
-        processed_df = pd.read_sql('SELECT * FROM processed_dataset', engine)
-        gcp_handler.upload_dataframe_to_bucket(
-            "my-process-data-bucket",
-            processed_df,
-            f"processed/{params['dataset_name']}_{params['split']}_processed.csv"
-        )
+        if export_mode == 'cursor':
+            export_run_to_bucket(
+                engine,
+                run_id,
+                uploader,
+                params['split'],
+                partition_by,
+                params.get('chunk_bucket_size', 4),
+                source=FLAT_VIEW if schema == 'normalized' else 'processed_dataset'
+            )
+        uploader.close()
+        if token_writer is not None:
+            # The shards are memory-mapped by consumers, see token_store.TokenShardReader
+            token_shards = token_writer.close()
+            gcp_handler.upload_many(
+                ("my-process-data-bucket", path,
+                 f"tokens/{params['dataset_name']}_{params['split']}/{os.path.basename(path)}")
+                for path in token_shards
+            )
+            logging.info(f"Uploaded {len(token_shards)} token shards ({token_writer.total_chunks} chunks)")
+        
+        # Step 8: Export the run metrics
+        if params.get('metrics_textfile'):
+            metrics.write_textfile(params['metrics_textfile'])
+        summary = metrics.summary()
+        stage_seconds = {
+            name: stats['sum'] for name, stats in summary['histograms'].items() if name.startswith('stage_seconds')
+        }
+        logging.info(f"Time per stage: {json.dumps(stage_seconds)}")
+        if params.get('metrics_summary'):
+            metrics.write_summary(params['metrics_summary'], {'run_id': run_id, 'total_processed': total_processed})
         
         logging.info(f"Pipeline completed successfully. Total processed texts: {total_processed}")
         
@@ -158,6 +1058,77 @@ if __name__ == '__main__':
     parser.add_argument('--port', default='5432', help='port for postgres')
     parser.add_argument('--db', default='gsm8k', help='database name for postgres')
     parser.add_argument('--batch_size', type=int, default=1000, help='Batch size for processing')
+    parser.add_argument('--adaptive_batching', action='store_true',
+                        help='Grow/shrink the batches (starting at batch_size) to hit a target size or latency')
+    parser.add_argument('--target_batch_mb', type=int, help='Target in-memory size of a written batch (default 32 MB)')
+    parser.add_argument('--target_batch_seconds', type=float, help='Target write time of a batch')
+    parser.add_argument('--min_batch_size', type=int, default=100, help='Smallest adaptive batch')
+    parser.add_argument('--max_batch_size', type=int, default=1000000, help='Largest adaptive batch')
+    parser.add_argument('--min_free_memory_mb', type=int, default=512,
+                        help='Shrink the batches when less memory than this is available')
+    parser.add_argument('--max_tokens', type=int, default=512, help='Maximum number of tokens per chunk')
+    parser.add_argument('--stride', type=int, default=0, help='Number of overlapping tokens between chunks')
+    parser.add_argument('--workers', type=int, default=1, help='Number of preprocessing processes')
+    parser.add_argument('--artifacts_dir', help='Directory with the pinned tokenizer and nltk data (see artifacts.py)')
+    parser.add_argument('--offline', action='store_true', help='Never download anything, load local artifacts only')
+    parser.add_argument('--startup_budget', type=float, help='Warn when import + startup takes longer (seconds)')
+    parser.add_argument('--cache_path', help='SQLite file caching preprocessing results between runs')
+    parser.add_argument('--cache_max_mb', type=int, default=1024, help='Size limit of the preprocessing cache in MB')
+    parser.add_argument('--sentence_splitter', default='punkt', choices=['punkt', 'regex'],
+                        help='Sentence splitter for the statistics (regex is faster, see benchmark.py for its accuracy)')
+    parser.add_argument('--dedup', action='store_true', help='Skip near-duplicate texts')
+    parser.add_argument('--dedup_index', help='Path of a saved near-duplicate index to load and update (implies --dedup)')
+    parser.add_argument('--export_format', default='csv', choices=list(FILE_EXTENSIONS),
+                        help='File format of the bucket exports')
+    parser.add_argument('--compression', default='zstd', help='Compression codec for parquet/arrow exports (e.g. zstd, snappy)')
+    parser.add_argument('--row_group_size', type=int, default=100000, help='Rows per parquet row group / arrow record batch')
+    parser.add_argument('--partition_by', nargs='*', choices=['split', 'chunk_bucket'],
+                        help='Write the processed export hive-partitioned by these columns')
+    parser.add_argument('--chunk_bucket_size', type=int, default=4, help='Chunk numbers per chunk_bucket partition')
+    parser.add_argument('--restart', action='store_true',
+                        help='Ignore the checkpoint and start from the first row (not with --coordinator, see --reset_job)')
+    parser.add_argument('--export_mode', default='tee', choices=['tee', 'cursor'],
+                        help='tee: upload batches while loading them, cursor: export this run from the table afterwards')
+    parser.add_argument('--streaming', action='store_true', help='Stream the dataset with constant memory')
+    parser.add_argument('--stream_batch_size', type=int, default=10000, help='Rows per streamed batch')
+    parser.add_argument('--source', help='Read the dataset from csv/parquet/arrow objects under gs://bucket/prefix instead of HuggingFace')
+    parser.add_argument('--download_cache_dir', default='.bucket_cache', help='Local cache of the --source objects')
+    parser.add_argument('--download_cache_mb', type=int, default=10240, help='Size limit of the download cache in MB')
+    parser.add_argument('--prefetch', type=int, default=4, help='--source objects downloaded ahead of the one being read')
+    parser.add_argument('--download_part_mb', type=int, default=32, help='MB per parallel range read of a --source object')
+    parser.add_argument('--pipelined', action='store_true',
+                        help='Overlap fetching, preprocessing, DB writes and uploads in concurrent stages')
+    parser.add_argument('--queue_size', type=int, default=4, help='Shards buffered between two pipelined stages')
+    parser.add_argument('--write_concurrency', type=int, default=1,
+                        help='Batches committed in parallel, each on its own connection')
+    parser.add_argument('--pool_size', type=int, default=5, help='Connections kept in the database pool')
+    parser.add_argument('--max_overflow', type=int, default=10, help='Extra connections allowed above pool_size')
+    parser.add_argument('--pool_timeout', type=int, default=30, help='Seconds to wait for a free connection')
+    parser.add_argument('--pool_recycle', type=int, default=-1, help='Reconnect connections older than this (seconds)')
+    parser.add_argument('--schema', default='flat', choices=['flat', 'normalized'],
+                        help=f'flat: processed_dataset, normalized: documents + chunks tables (flat view {FLAT_VIEW})')
+    parser.add_argument('--partitioning', choices=['hash', 'range'],
+                        help='Create processed_dataset partitioned by content_hash (new tables only)')
+    parser.add_argument('--partitions', type=int, default=8, help='Number of partitions of processed_dataset')
+    parser.add_argument('--defer_indexes', action='store_true',
+                        help='Drop the secondary indexes during the load and build them afterwards')
+    parser.add_argument('--token_storage', nargs='*', choices=['bytea', 'shards'],
+                        help='Keep the token ids of every chunk: packed in the token_ids column and/or in Arrow token shards')
+    parser.add_argument('--token_shard_dir', default='token_shards', help='Local directory of the token shards')
+    parser.add_argument('--token_shard_rows', type=int, default=100000, help='Chunks per token shard')
+    parser.add_argument('--num_shards', type=int, default=1, help='Split the source texts into this many static shards')
+    parser.add_argument('--shard_index', type=int, default=0, help='Shard processed by this worker (0 .. num_shards - 1)')
+    parser.add_argument('--coordinator', action='store_true',
+                        help='Lease row ranges from the pipeline_work_ranges table, so any number of replicas can share a job')
+    parser.add_argument('--reset_job', action='store_true',
+                        help='Delete the work ranges of the coordinator job and exit (refused while workers hold leases)')
+    parser.add_argument('--lease_rows', type=int, default=10000, help='Source rows per leased range')
+    parser.add_argument('--lease_seconds', type=int, default=120,
+                        help='A lease without heartbeat for this long is taken over by another worker')
+    parser.add_argument('--metrics_textfile', help='Prometheus textfile (node_exporter collector) updated after every batch')
+    parser.add_argument('--metrics_port', type=int, help='Serve Prometheus metrics on this port while the run lasts')
+    parser.add_argument('--metrics_summary', help='Write a JSON summary of the run metrics to this path')
+    parser.add_argument('--profile', help='Run process_and_load_data under cProfile and dump the stats to this path')
     
     args = parser.parse_args()
     
@@ -0,0 +1,308 @@
+import bisect
+import contextlib
+import cProfile
+import functools
+import io
+import json
+import logging
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+# Upper bounds (seconds) of the stage duration histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def current_rss_bytes() -> Optional[int]:
+    """Resident set size of this process right now (Linux only)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+def available_memory_bytes() -> Optional[int]:
+    """Memory the kernel can still hand out without swapping (Linux only)"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def peak_rss_bytes() -> int:
+    """Peak resident set size of this process so far"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+class PipelineMetrics:
+    """Counters, gauges and histograms of one pipeline run
+
+    Every metric has a name and optional labels (e.g. stage='tokenize').
+    The values can be exported in the Prometheus text format (textfile
+    collector or a small HTTP endpoint) and as a JSON run summary. Worker
+    processes keep their own instance and send a snapshot back to the
+    parent, which merges it.
+    """
+
+    def __init__(self, prefix: str = 'pipeline', buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple, float] = {}
+        self._gauges: Dict[Tuple, float] = {}
+        # key -> [bucket counts..., count, sum, max]
+        self._histograms: Dict[Tuple, list] = {}
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, Any]) -> Tuple:
+        return (name,) + tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """Add value to a counter"""
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels) -> None:
+        """Set a gauge, e.g. a queue depth"""
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """Add one observation to a histogram"""
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * len(self.buckets) + [0, 0.0, 0.0]
+            bucket = bisect.bisect_left(self.buckets, value)
+            if bucket < len(self.buckets):
+                histogram[bucket] += 1
+            histogram[-3] += 1
+            histogram[-2] += value
+            histogram[-1] = max(histogram[-1], value)
+
+    @contextlib.contextmanager
+    def timer(self, stage: str, rows: int = None) -> Iterator[None]:
+        """Time a block as one observation of stage_seconds{stage=...}"""
+        t_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - t_start, stage=stage)
+            if rows is not None:
+                self.inc('stage_rows_total', rows, stage=stage)
+
+    def record_memory(self) -> None:
+        """Update the memory gauges of this process"""
+        rss = current_rss_bytes()
+        if rss is not None:
+            self.set_gauge('memory_rss_bytes', rss)
+        self.set_gauge('memory_peak_rss_bytes', peak_rss_bytes())
+
+    def snapshot(self, reset: bool = False) -> Dict:
+        """Picklable copy of the values, optionally resetting them"""
+        with self._lock:
+            snapshot = {
+                'counters': dict(self._counters),
+                'gauges': dict(self._gauges),
+                'histograms': {key: list(value) for key, value in self._histograms.items()}
+            }
+            if reset:
+                self._counters.clear()
+                self._histograms.clear()
+        return snapshot
+
+    def merge(self, snapshot: Dict) -> None:
+        """Add the values of another instance (e.g. from a worker process)"""
+        with self._lock:
+            for key, value in snapshot['counters'].items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            for key, value in snapshot['histograms'].items():
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    self._histograms[key] = list(value)
+                    continue
+                for i in range(len(value) - 1):
+                    histogram[i] += value[i]
+                histogram[-1] = max(histogram[-1], value[-1])
+
+    def _labels_text(self, key: Tuple, extra: Dict[str, str] = None) -> str:
+        labels = list(key[1:]) + list((extra or {}).items())
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+    def to_prometheus(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        self.record_memory()
+        snapshot = self.snapshot()
+        lines = []
+        typed = set()
+
+        def add_type(name, metric_type):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} {metric_type}')
+
+        for key, value in sorted(snapshot['counters'].items()):
+            name = f'{self.prefix}_{key[0]}'
+            add_type(name, 'counter')
+            lines.append(f'{name}{self._labels_text(key)} {value}')
+        for key, value in sorted(snapshot['gauges'].items()):
+            name = f'{self.prefix}_{key[0]}'
+            add_type(name, 'gauge')
+            lines.append(f'{name}{self._labels_text(key)} {value}')
+        for key, value in sorted(snapshot['histograms'].items()):
+            name = f'{self.prefix}_{key[0]}'
+            add_type(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, value):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{self._labels_text(key, {"le": str(bound)})} {cumulative}')
+            lines.append(f'{name}_bucket{self._labels_text(key, {"le": "+Inf"})} {value[-3]}')
+            lines.append(f'{name}_count{self._labels_text(key)} {value[-3]}')
+            lines.append(f'{name}_sum{self._labels_text(key)} {value[-2]}')
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path: str) -> None:
+        """Write the metrics for the node_exporter textfile collector
+
+        The file is replaced atomically so the collector never reads half of it.
+        """
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+        logging.debug(f"Metrics written to {path}")
+
+    def serve(self, port: int, host: str = '0.0.0.0') -> ThreadingHTTPServer:
+        """Serve the metrics on http://host:port/metrics from a daemon thread"""
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+        return server
+
+    def _quantile(self, histogram: list, q: float) -> float:
+        """Estimate a quantile from the bucket counts (upper bound of its bucket)"""
+        rank = q * histogram[-3]
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, histogram):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return min(bound, histogram[-1])
+        return histogram[-1]
+
+    def summary(self) -> Dict:
+        """Run summary: totals per metric and duration statistics per stage"""
+        self.record_memory()
+        snapshot = self.snapshot()
+
+        def name_of(key):
+            labels = ','.join(f'{k}={v}' for k, v in key[1:])
+            return f'{key[0]}{{{labels}}}' if labels else key[0]
+
+        histograms = {}
+        for key, value in snapshot['histograms'].items():
+            count, total, maximum = value[-3:]
+            histograms[name_of(key)] = {
+                'count': count,
+                'sum': round(total, 6),
+                'mean': round(total / count, 6) if count else None,
+                'p50': round(self._quantile(value, 0.5), 6),
+                'p99': round(self._quantile(value, 0.99), 6),
+                'max': round(maximum, 6)
+            }
+        return {
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started_at)),
+            'wall_seconds': round(time.time() - self.started_at, 3),
+            'counters': {name_of(key): value for key, value in snapshot['counters'].items()},
+            'gauges': {name_of(key): value for key, value in snapshot['gauges'].items()},
+            'histograms': histograms
+        }
+
+    def write_summary(self, path: str, extra: Dict = None) -> None:
+        """Save the run summary as JSON"""
+        summary = self.summary()
+        if extra:
+            summary.update(extra)
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2)
+        logging.info(f"Run summary written to {path}")
+
+def stage_timer(metrics: Optional[PipelineMetrics], stage: str, rows: int = None):
+    """metrics.timer(stage), or a no-op when metrics are off"""
+    if metrics is None:
+        return contextlib.nullcontext()
+    return metrics.timer(stage, rows)
+
+def timed_iter(iterable: Iterable, metrics: Optional[PipelineMetrics], stage: str) -> Iterator:
+    """Pass the items of iterable through, timing how long each one takes to produce
+
+    Used for lazy sources (streamed batches), where the time is spent in next().
+    """
+    if metrics is None:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    while True:
+        t_start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        metrics.observe('stage_seconds', time.perf_counter() - t_start, stage=stage)
+        if hasattr(item, '__len__'):
+            metrics.inc('stage_rows_total', len(item), stage=stage)
+        yield item
+
+def profiled(fn: Callable, output_path: str, top: int = 25) -> Callable:
+    """Wrap fn so every call runs under cProfile
+
+    The raw stats are dumped to output_path (open them with snakeviz or
+    `python -m pstats`) and the top functions by cumulative time are logged.
+    For sampling instead, leave this off and attach py-spy to the process:
+    py-spy record -o profile.svg --pid <pid>
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profiler.disable()
+            profiler.dump_stats(output_path)
+            report = io.StringIO()
+            pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(top)
+            logging.info(f"Profile of {fn.__name__} written to {output_path}\n{report.getvalue()}")
+    return wrapper
@@ -0,0 +1,142 @@
+import hashlib
+import logging
+from typing import Any, Dict, List, Sequence, Tuple
+
+import pandas as pd
+from sqlalchemy import text
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+# View with the columns of the flat processed_dataset table
+FLAT_VIEW = 'processed_dataset_flat'
+
+# Document level columns, stored once per source text
+DOCUMENT_COLUMNS = [
+    'content_hash', 'original_text', 'token_count', 'sentence_count', 'unique_tokens',
+    'avg_sentence_length', 'max_sentence_length', 'min_sentence_length', 'run_id'
+]
+
+# Chunk level columns, one row per chunk
+CHUNK_COLUMNS = ['content_hash', 'chunk_number', 'processed_text', 'run_id', 'token_ids']
+
+# Secondary indexes of the normalized tables: name -> (table, column)
+NORMALIZED_INDEXES = {
+    'idx_documents_token_count': ('documents', 'token_count'),
+    'idx_documents_sentence_count': ('documents', 'sentence_count'),
+    'idx_chunks_run_id': ('chunks', 'run_id')
+}
+
+def create_normalized_tables(engine: Any) -> None:
+    """Create the documents and chunks tables and the flat view over them
+
+    documents holds every source text and its statistics once, keyed by
+    content_hash; chunks holds the processed chunks and points to their
+    document. FLAT_VIEW joins them back into the processed_dataset shape.
+    """
+    create_tables_query = text(f"""
+    CREATE TABLE IF NOT EXISTS documents (
+        id BIGSERIAL PRIMARY KEY,
+        content_hash TEXT NOT NULL UNIQUE,
+        original_text TEXT NOT NULL,
+        token_count INTEGER,
+        sentence_count INTEGER,
+        unique_tokens INTEGER,
+        avg_sentence_length FLOAT,
+        max_sentence_length INTEGER,
+        min_sentence_length INTEGER,
+        run_id TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS chunks (
+        id BIGSERIAL PRIMARY KEY,
+        content_hash TEXT NOT NULL REFERENCES documents(content_hash),
+        chunk_number INTEGER NOT NULL,
+        processed_text TEXT NOT NULL,
+        run_id TEXT,
+        token_ids BYTEA,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (content_hash, chunk_number)
+    );
+    ALTER TABLE chunks ADD COLUMN IF NOT EXISTS token_ids BYTEA;
+    CREATE OR REPLACE VIEW {FLAT_VIEW} AS
+    SELECT
+        c.id,
+        d.original_text,
+        c.processed_text,
+        d.token_count,
+        d.sentence_count,
+        d.unique_tokens,
+        d.avg_sentence_length,
+        d.max_sentence_length,
+        d.min_sentence_length,
+        c.chunk_number,
+        c.run_id,
+        c.content_hash,
+        c.created_at,
+        c.token_ids
+    FROM chunks c
+    JOIN documents d ON d.content_hash = c.content_hash;
+    """)
+
+    with engine.connect() as conn:
+        conn.execute(create_tables_query)
+        conn.commit()
+    logging.info(f"Tables documents and chunks and view {FLAT_VIEW} created successfully")
+
+def split_rows(rows: Sequence[Dict]) -> Tuple[List[Dict], List[Dict]]:
+    """Split flat processed_dataset rows into document rows and chunk rows"""
+    documents = {}
+    chunks = []
+    for row in rows:
+        if row['content_hash'] not in documents:
+            documents[row['content_hash']] = {column: row.get(column) for column in DOCUMENT_COLUMNS}
+        chunks.append({column: row.get(column) for column in CHUNK_COLUMNS})
+    return list(documents.values()), chunks
+
+def split_dataframe(df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Split a flat DataFrame into documents and chunks
+
+    content_hash and chunk_number are derived from original_text when the
+    DataFrame doesn't have them (e.g. CSV exports of the flat table).
+    Columns the DataFrame lacks are left out.
+    """
+    if 'content_hash' not in df.columns:
+        df = df.assign(content_hash=df['original_text'].map(
+            lambda original: hashlib.sha256(str(original).encode('utf-8')).hexdigest()
+        ))
+    if 'chunk_number' not in df.columns:
+        df = df.assign(chunk_number=df.groupby('content_hash').cumcount())
+    documents = df.drop_duplicates('content_hash')[[c for c in DOCUMENT_COLUMNS if c in df.columns]]
+    chunks = df[[c for c in CHUNK_COLUMNS if c in df.columns]]
+    return documents, chunks
+
+def write_normalized(writer: Any, rows: Any) -> int:
+    """Write flat rows (list of dicts or DataFrame) into documents and chunks
+
+    Documents go first so the chunks always find theirs; both skip rows
+    that are already loaded. writer is a BulkWriter or WriterPool.
+    Returns the number of chunk rows written.
+    """
+    if isinstance(rows, pd.DataFrame):
+        documents, chunks = split_dataframe(rows)
+    else:
+        documents, chunks = split_rows(rows)
+    writer.write('documents', documents, skip_conflicts=True)
+    return writer.write('chunks', chunks, skip_conflicts=True)
+
+def create_normalized_indexes(engine: Any) -> None:
+    """Build the secondary indexes of documents and chunks"""
+    with engine.connect() as conn:
+        for name, (table, column) in NORMALIZED_INDEXES.items():
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table}({column})"))
+        conn.commit()
+
+def drop_normalized_indexes(engine: Any) -> None:
+    """Drop the secondary indexes of documents and chunks before a bulk load"""
+    with engine.connect() as conn:
+        for name in NORMALIZED_INDEXES:
+            conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+        conn.commit()
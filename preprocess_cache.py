@@ -0,0 +1,187 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+from typing import Dict, List, Optional
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+# Buffered access times and hit/miss counts are written back at least this often
+FLUSH_SECONDS = 30
+FLUSH_KEYS = 10000
+
+class PreprocessCache:
+    """Disk-backed cache of TextPreprocessor results in SQLite
+
+    Entries are keyed by a hash of the input text, the tokenizer name and
+    the chunking settings, and hold the cleaned text, chunks and stats.
+    When the stored size goes over max_bytes the least recently used
+    entries are evicted. Several processes can share one cache file.
+    Lookups only read: access times and hit/miss counts are kept in memory
+    and written back with the next put_many, evict, stats or close (or
+    after FLUSH_SECONDS / FLUSH_KEYS), so workers that only hit the cache
+    don't queue on the SQLite writer lock for every batch.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 1024 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # Not yet written back: key -> last access, and hit/miss counts
+        self._touched: Dict[str, float] = {}
+        self._pending_hits = 0
+        self._pending_misses = 0
+        self._last_flush = time.time()
+        # The staged pipeline hands the cache to another thread (one at a time)
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript("""
+        CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            last_access REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_last_access ON entries(last_access);
+        CREATE TABLE IF NOT EXISTS cache_stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            hits INTEGER NOT NULL DEFAULT 0,
+            misses INTEGER NOT NULL DEFAULT 0,
+            total_bytes INTEGER NOT NULL DEFAULT 0
+        );
+        INSERT OR IGNORE INTO cache_stats (id) VALUES (1);
+        """)
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(text: str, tokenizer_name: str, max_tokens: int, stride: int = 0) -> str:
+        """Cache key for one input text and preprocessing setup"""
+        key_source = f"{tokenizer_name}\x00{max_tokens}\x00{stride}\x00{text}"
+        return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, Dict]:
+        """Look up several keys at once and return the entries found"""
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        # Stay below SQLite's limit on query parameters
+        for start in range(0, len(unique_keys), 500):
+            part = unique_keys[start:start + 500]
+            placeholders = ','.join('?' * len(part))
+            rows = self.conn.execute(
+                f"SELECT key, value FROM entries WHERE key IN ({placeholders})", part
+            ).fetchall()
+            for key, value in rows:
+                found[key] = json.loads(value)
+
+        hits = sum(1 for key in keys if key in found)
+        misses = len(keys) - hits
+        self.hits += hits
+        self.misses += misses
+        self._pending_hits += hits
+        self._pending_misses += misses
+        now = time.time()
+        for key in found:
+            self._touched[key] = now
+        if len(self._touched) >= FLUSH_KEYS or now - self._last_flush >= FLUSH_SECONDS:
+            with self.conn:
+                self._flush()
+        return found
+
+    def _flush(self) -> None:
+        """Write the buffered access times and hit/miss counts (inside a transaction)"""
+        if self._touched:
+            self.conn.executemany(
+                "UPDATE entries SET last_access = ? WHERE key = ?",
+                [(accessed, key) for key, accessed in self._touched.items()]
+            )
+        if self._pending_hits or self._pending_misses:
+            self.conn.execute(
+                "UPDATE cache_stats SET hits = hits + ?, misses = misses + ? WHERE id = 1",
+                (self._pending_hits, self._pending_misses)
+            )
+        self._touched = {}
+        self._pending_hits = 0
+        self._pending_misses = 0
+        self._last_flush = time.time()
+
+    def get(self, key: str) -> Optional[Dict]:
+        return self.get_many([key]).get(key)
+
+    def put_many(self, entries: Dict[str, Dict]) -> None:
+        """Store several results and evict old entries when over max_bytes"""
+        if not entries:
+            return
+        now = time.time()
+        rows = []
+        for key, result in entries.items():
+            # numpy scalars in the stats become plain numbers
+            value = json.dumps(result, default=lambda o: o.item())
+            rows.append((key, value, len(value), now))
+
+        with self.conn:
+            self._flush()
+            # Entries being replaced no longer count towards the total size
+            replaced = 0
+            for start in range(0, len(rows), 500):
+                part = [row[0] for row in rows[start:start + 500]]
+                replaced += self.conn.execute(
+                    f"SELECT COALESCE(SUM(size), 0) FROM entries WHERE key IN ({','.join('?' * len(part))})", part
+                ).fetchone()[0]
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO entries (key, value, size, last_access) VALUES (?, ?, ?, ?)", rows
+            )
+            self.conn.execute(
+                "UPDATE cache_stats SET total_bytes = total_bytes + ? WHERE id = 1",
+                (sum(row[2] for row in rows) - replaced,)
+            )
+            total_bytes = self.conn.execute("SELECT total_bytes FROM cache_stats WHERE id = 1").fetchone()[0]
+
+        if total_bytes > self.max_bytes:
+            self.evict()
+
+    def put(self, key: str, result: Dict) -> None:
+        self.put_many({key: result})
+
+    def evict(self) -> None:
+        """Drop least recently used entries until the cache is at 90% of max_bytes"""
+        target = int(self.max_bytes * 0.9)
+        with self.conn:
+            # Recent hits must count before choosing what to drop
+            self._flush()
+            total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            to_delete = []
+            for key, size in self.conn.execute("SELECT key, size FROM entries ORDER BY last_access").fetchall():
+                if total_bytes <= target:
+                    break
+                to_delete.append((key,))
+                total_bytes -= size
+            self.conn.executemany("DELETE FROM entries WHERE key = ?", to_delete)
+            self.conn.execute("UPDATE cache_stats SET total_bytes = ? WHERE id = 1", (total_bytes,))
+            evicted = len(to_delete)
+        logging.info(f"Evicted {evicted} entries from the preprocessing cache")
+
+    def stats(self) -> Dict:
+        """Hit/miss counters of this process and of the cache file overall"""
+        with self.conn:
+            self._flush()
+        hits, misses, total_bytes = self.conn.execute(
+            "SELECT hits, misses, total_bytes FROM cache_stats WHERE id = 1"
+        ).fetchone()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'total_hits': hits,
+            'total_misses': misses,
+            'total_bytes': total_bytes
+        }
+
+    def close(self) -> None:
+        with self.conn:
+            self._flush()
+        self.conn.close()
@@ -0,0 +1,176 @@
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+from metrics import PipelineMetrics
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+# End-of-stream marker passed down the queues
+_DONE = object()
+
+class _Stopped(Exception):
+    """Raised inside a stage thread when the pipeline is shutting down"""
+
+class Stage:
+    """One step of a StagePipeline
+
+    fn takes an item from the previous stage and returns the item for the
+    next one. workers is the number of threads running fn; I/O-bound stages
+    (DB writes, uploads) get more threads, CPU-bound work should be handed
+    to a process pool from inside fn.
+    """
+
+    def __init__(self, name: str, fn: Callable[[Any], Any], workers: int = 1):
+        if workers < 1:
+            raise ValueError(f"Stage {name} needs at least one worker")
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+
+class StagePipeline:
+    """Run stages on threads connected by bounded queues
+
+    A source thread pulls items from the source iterable (fetching), each
+    stage reads from a queue of at most queue_size items and writes to the
+    next one. When a stage falls behind, the queue in front of it fills up
+    and the stages before it block (backpressure), so memory stays bounded
+    while all stages work at the same time. With more than one worker a
+    stage may pass items on out of order. The first error stops every
+    stage and is raised again by run().
+    """
+
+    def __init__(self, source: Iterable, stages: List[Stage], queue_size: int = 4,
+                 metrics: Optional[PipelineMetrics] = None, poll_seconds: float = 0.1):
+        self.source = source
+        self.stages = stages
+        self.queue_size = queue_size
+        self.metrics = metrics
+        self.poll_seconds = poll_seconds
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+        self._stop = threading.Event()
+        self._error: Optional[BaseException] = None
+        self._lock = threading.Lock()
+        self._finished_workers: Dict[int, int] = {}
+        self._threads: List[threading.Thread] = []
+
+    def _put(self, q: queue.Queue, item: Any) -> None:
+        while True:
+            if self._stop.is_set():
+                raise _Stopped()
+            try:
+                q.put(item, timeout=self.poll_seconds)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, q: queue.Queue) -> Any:
+        while True:
+            if self._stop.is_set():
+                raise _Stopped()
+            try:
+                return q.get(timeout=self.poll_seconds)
+            except queue.Empty:
+                continue
+
+    def _fail(self, error: BaseException) -> None:
+        with self._lock:
+            if self._error is None:
+                self._error = error
+        self._stop.set()
+
+    def _run_source(self) -> None:
+        try:
+            for item in self.source:
+                self._put(self._queues[0], item)
+            self._put(self._queues[0], _DONE)
+        except _Stopped:
+            pass
+        except BaseException as e:
+            logging.error(f"Stage fetch failed: {str(e)}")
+            self._fail(e)
+
+    def _run_stage(self, index: int) -> None:
+        stage = self.stages[index]
+        inbox, outbox = self._queues[index], self._queues[index + 1]
+        try:
+            while True:
+                item = self._get(inbox)
+                if item is _DONE:
+                    # Leave the marker for the other workers of this stage,
+                    # the last one to see it passes it on
+                    with self._lock:
+                        self._finished_workers[index] = self._finished_workers.get(index, 0) + 1
+                        last = self._finished_workers[index] == stage.workers
+                    self._put(outbox if last else inbox, _DONE)
+                    return
+                t_start = time.perf_counter()
+                result = stage.fn(item)
+                if self.metrics is not None:
+                    # Busy time of the stage threads, next to the stage_seconds timings
+                    self.metrics.observe('pipeline_busy_seconds', time.perf_counter() - t_start, stage=stage.name)
+                    self.metrics.set_gauge('queue_depth', inbox.qsize(), queue=stage.name)
+                self._put(outbox, result)
+        except _Stopped:
+            pass
+        except BaseException as e:
+            logging.error(f"Stage {stage.name} failed: {str(e)}")
+            self._fail(e)
+
+    def _start(self) -> None:
+        self._threads.append(threading.Thread(target=self._run_source, name='stage-fetch', daemon=True))
+        for index, stage in enumerate(self.stages):
+            for worker in range(stage.workers):
+                self._threads.append(threading.Thread(
+                    target=self._run_stage, args=(index,), name=f'stage-{stage.name}-{worker}', daemon=True
+                ))
+        for thread in self._threads:
+            thread.start()
+
+    def run(self) -> Iterator[Any]:
+        """Start the stages and yield what the last stage produces"""
+        self._start()
+        try:
+            while True:
+                item = self._get(self._queues[-1])
+                if item is _DONE:
+                    break
+                yield item
+        except _Stopped:
+            pass
+        finally:
+            # Also stops the threads when the caller stops iterating early
+            self._stop.set()
+            for thread in self._threads:
+                thread.join()
+        if self._error is not None:
+            raise self._error
+
+class ProgressTracker:
+    """Turn out-of-order completions into an in-order progress mark
+
+    Items are numbered 0, 1, 2, ... in source order. complete(seq, done)
+    records that item seq is finished and that done source rows are covered
+    once every item up to seq is. The mark only moves past an item when all
+    items before it are finished, so it is safe to checkpoint.
+    """
+
+    def __init__(self, start: int = 0):
+        self.mark = start
+        self._next_seq = 0
+        self._pending: Dict[int, int] = {}
+
+    def complete(self, seq: int, done: int) -> Optional[int]:
+        """Record item seq; return the new mark when it moved, else None"""
+        self._pending[seq] = done
+        moved = False
+        while self._next_seq in self._pending:
+            self.mark = max(self.mark, self._pending.pop(self._next_seq))
+            self._next_seq += 1
+            moved = True
+        return self.mark if moved else None
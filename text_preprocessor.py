@@ -1,19 +1,111 @@
+import os
 import re
 import numpy as np
-from typing import List, Dict
-from transformers import AutoTokenizer
-from nltk.tokenize import sent_tokenize
-import nltk
+from typing import Any, List, Dict, Sequence, Tuple, Union
+
+from artifacts import TOKENIZER_NAME, get_artifacts_dir, is_offline, tokenizer_path, nltk_data_path
+from dedup_index import NearDuplicateIndex, TextListIndex
+from preprocess_cache import PreprocessCache
+from metrics import PipelineMetrics, stage_timer
+from token_store import token_dtype_for
+
+# Sentence ends for the regex splitter: whitespace after . ! or ?
+SENTENCE_END_RE = re.compile(r'(?<=[.!?])\s+')
+
+# Columns returned by calculate_stats_batch
+STATS_COLUMNS = (
+    'token_count', 'unique_tokens', 'sentence_count', 'avg_sentence_length',
+    'max_sentence_length', 'min_sentence_length', 'sentence_length_std'
+)
+
+# Symbols clean_text keeps besides a-z, 0-9 and whitespace
+CLEAN_SYMBOLS = (
+    '+-*/='      # Basic operators
+    '<>≤≥≠'      # Comparison operators
+    '∑∏∫√∂∞π'    # Advanced math symbols
+    '()[]{}^'    # Brackets and power
+    '.,'         # Dots and commas
+)
+
+class TextCleaner:
+    """clean_text compiled once: lowercase, drop what isn't allowed, collapse whitespace
+    
+    ASCII texts (most of them) go through a bytes.translate deletion table,
+    other texts through one precompiled pattern deleting runs of
+    disallowed characters. split/join then turns every whitespace run into
+    one space and trims, which is what the \\s+ substitution and strip() did.
+    """
+    
+    def __init__(self, symbols: str = CLEAN_SYMBOLS):
+        self.delete_re = re.compile(f'[^a-z0-9\\s{re.escape(symbols)}]+')
+        keep = {ord(char) for char in 'abcdefghijklmnopqrstuvwxyz0123456789' + symbols if ord(char) < 128}
+        keep.update(code for code in range(128) if chr(code).isspace())
+        self.delete_ascii = bytes(code for code in range(128) if code not in keep)
+    
+    def clean(self, text: str) -> str:
+        text = text.lower()
+        if text.isascii():
+            text = text.encode('ascii').translate(None, self.delete_ascii).decode('ascii')
+        else:
+            text = self.delete_re.sub('', text)
+        return ' '.join(text.split())
+
+def regex_sent_tokenize(text: str) -> List[str]:
+    """Split text into sentences at whitespace after . ! or ?"""
+    return [sentence for sentence in SENTENCE_END_RE.split(text.strip()) if sentence]
 
 class TextPreprocessor:
-    def __init__(self):
+    def __init__(self, dedup_index: NearDuplicateIndex = None, cache: PreprocessCache = None,
+                 artifacts_dir: str = None, offline: bool = None, metrics: PipelineMetrics = None,
+                 sentence_splitter: str = 'punkt'):
+        """Load the tokenizer and nltk punkt
+        
+        They are loaded from artifacts_dir (see artifacts.py) when it holds
+        them. In offline mode nothing is downloaded and a missing artifact
+        is an error. sentence_splitter picks punkt or the faster regex
+        splitter for the sentence statistics.
+        """
+        if sentence_splitter not in ('punkt', 'regex'):
+            raise ValueError(f"Unknown sentence splitter: {sentence_splitter}")
+        
+        # transformers and nltk are only imported by the stage that needs them
+        from transformers import AutoTokenizer
+        import nltk
+        from nltk.tokenize import sent_tokenize
+        
+        # Optional near-duplicate index shared across calls (and runs)
+        self.dedup_index = dedup_index
+        # Optional disk cache of process_text results
+        self.cache = cache
+        # Optional per-stage timings of process_texts
+        self.metrics = metrics
+        artifacts_dir = get_artifacts_dir(artifacts_dir)
+        offline = is_offline(offline)
+        
         # Initialize tokenizer for chunking
-        self.tokenizer = AutoTokenizer.from_pretrained('bert-base-uncased')
+        if artifacts_dir and os.path.isdir(tokenizer_path(artifacts_dir)):
+            self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_path(artifacts_dir), local_files_only=True)
+        else:
+            self.tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_NAME, local_files_only=offline)
+        # Smallest type holding every token id (see token_store.py)
+        self.token_dtype = token_dtype_for(len(self.tokenizer))
+        
         # Download NLTK data for sentence tokenization
+        if artifacts_dir and nltk_data_path(artifacts_dir) not in nltk.data.path:
+            nltk.data.path.insert(0, nltk_data_path(artifacts_dir))
         try:
             nltk.data.find('tokenizers/punkt')
         except LookupError:
+            if offline:
+                raise
             nltk.download('punkt')
+        self.punkt_sent_tokenize = sent_tokenize
+        self.sentence_splitter = sentence_splitter
+        self.sent_tokenize = sent_tokenize if sentence_splitter == 'punkt' else regex_sent_tokenize
+        # Cleaning patterns, compiled once and shared by every clean_text call
+        self.cleaner = TextCleaner()
+        # Index of the other_texts list given to is_duplicate
+        self._other_texts_index = TextListIndex(self.clean_text)
     
     def clean_text(self, text: str) -> str:
         """Makes text cleaner by:
@@ -21,91 +113,189 @@ class TextPreprocessor:
         2. Keeping English alphabet, mathematical symbols, and spaces
         3. Preserving common mathematical expressions
         """
-        # Step 1: Make all letters lowercase
-        cleaned_text = text.lower()
-        
-        # Step 2: Keep English letters, numbers, math symbols, and spaces
-        # Define allowed math symbols
-        math_symbols = [
-            'a-z0-9\\s',  # Letters, numbers, spaces
-            '\\+\\-\\*/=',  # Basic operators
-            '<>≤≥≠',      # Comparison operators
-            '∑∏∫√∂∞π',    # Advanced math symbols
-            '\\(\\)\\[\\]\\{\\}\\^',  # Brackets and power
-            '\\.,',       # Dots and commas
-        ]
-        
-        # Join all symbols and create pattern
-        pattern = f'[^{"".join(math_symbols)}]'
-        cleaned_text = re.sub(pattern, '', cleaned_text)
-        
-        # Step 3: Replace multiple spaces with single space and trim
-        cleaned_text = re.sub(r'\s+', ' ', cleaned_text).strip()
-        
-        return cleaned_text
+        return self.cleaner.clean(text)
+    
+    def clean_texts(self, texts: Union[Sequence[str], Any]) -> List[str]:
+        """clean_text for a list of texts or an Arrow string array (nulls become '')"""
+        if hasattr(texts, 'to_pylist'):
+            texts = texts.to_pylist()
+        clean = self.cleaner.clean
+        return [clean(text) if text else '' for text in texts]
     
-    def is_duplicate(self, text: str, other_texts: List[str]) -> bool:
-        """Check if text is too similar to any existing text"""
-        if not text or not other_texts:
+    def is_duplicate(self, text: str, other_texts: List[str] = None) -> bool:
+        """Check if text is too similar to any existing text
+        
+        The texts in other_texts are cleaned once and put in a MinHash/LSH
+        index that is kept for that list: calls with the same list, grown
+        since, only index the new texts. Without other_texts the shared
+        dedup_index is queried.
+        """
+        if not text:
             return False
             
         # Clean the text first
         text = self.clean_text(text)
-        text_chars = set(text)
         
-        # Compare with each existing text
-        for other in other_texts:
-            other = self.clean_text(other)
-            other_chars = set(other)
-            
-            # Calculate similarity ratio
-            common_chars = len(text_chars & other_chars)
-            total_chars = len(text_chars | other_chars)
-            
-            # If 80% or more similar, it's a duplicate
-            if total_chars > 0 and (common_chars / total_chars) >= 0.8:
-                return True
-                
-        return False
+        if other_texts:
+            index = self._other_texts_index.index_for(other_texts)
+        else:
+            index = self.dedup_index
+        
+        return index is not None and index.is_duplicate(text)
     
-    def chunk_text(self, text: str, max_tokens: int = 512) -> List[str]:
+    def chunk_text(self, text: str, max_tokens: int = 512, stride: int = 0) -> List[str]:
         """Split text into chunks of maximum token length"""
-        # Tokenize the entire text
-        tokens = self.tokenizer.encode(text, add_special_tokens=False)
-        chunks = []
+        return self.chunk_texts([text], max_tokens, stride)[0]
+    
+    def chunk_texts(self, texts: List[str], max_tokens: int = 512, stride: int = 0) -> List[List[str]]:
+        """Split a batch of texts into chunks of maximum token length
+        
+        The whole batch goes through the fast tokenizer in one call and chunks
+        are cut from the original text with the character offset mapping, so
+        no decode round-trip is needed. `stride` is the number of tokens
+        shared by two neighbouring chunks (0 means no overlap).
+        """
+        return self.chunk_texts_with_ids(texts, max_tokens, stride)[0]
+    
+    def chunk_texts_with_ids(self, texts: List[str], max_tokens: int = 512,
+                             stride: int = 0) -> Tuple[List[List[str]], List[List[List[int]]]]:
+        """chunk_texts that also returns the token ids of every chunk
+        
+        The ids come from the same tokenizer call, so consumers can store
+        them instead of tokenizing the chunks again.
+        """
+        if max_tokens <= 0:
+            raise ValueError("max_tokens must be positive")
+        if stride < 0 or stride >= max_tokens:
+            raise ValueError("stride must be >= 0 and smaller than max_tokens")
+        if not texts:
+            return [], []
+        
+        # Tokenize the entire batch at once
+        encodings = self.tokenizer(
+            list(texts),
+            add_special_tokens=False,
+            return_offsets_mapping=True,
+            return_attention_mask=False,
+            return_token_type_ids=False,
+            verbose=False
+        )
         
-        # Split into chunks of max_tokens
-        for i in range(0, len(tokens), max_tokens):
-            chunk_tokens = tokens[i:i + max_tokens]
-            chunk_text = self.tokenizer.decode(chunk_tokens)
-            chunks.append(chunk_text)
+        step = max_tokens - stride
+        all_chunks = []
+        all_ids = []
+        for text, offsets, input_ids in zip(texts, encodings['offset_mapping'], encodings['input_ids']):
+            chunks = []
+            chunk_ids = []
+            # Split into windows of max_tokens and slice the text by offsets
+            for i in range(0, len(offsets), step):
+                window = offsets[i:i + max_tokens]
+                chunks.append(text[window[0][0]:window[-1][1]])
+                chunk_ids.append(input_ids[i:i + max_tokens])
+                if i + max_tokens >= len(offsets):
+                    break
+            all_chunks.append(chunks)
+            all_ids.append(chunk_ids)
         
-        return chunks
+        return all_chunks, all_ids
     
     def calculate_stats(self, text: str) -> Dict:
         """Calculate basic NLP statistics for the text"""
-        # Tokenize into sentences
-        sentences = sent_tokenize(text)
-        
-        # Calculate token counts
-        tokens = text.split()
-        token_count = len(tokens)
-        unique_tokens = len(set(tokens))
-        
-        # Calculate sentence length statistics
-        sentence_lengths = [len(sent.split()) for sent in sentences]
-        
-        stats = {
-            'token_count': token_count,
-            'unique_tokens': unique_tokens,
-            'sentence_count': len(sentences),
-            'avg_sentence_length': np.mean(sentence_lengths),
-            'max_sentence_length': max(sentence_lengths),
-            'min_sentence_length': min(sentence_lengths),
-            'sentence_length_std': np.std(sentence_lengths)
+        columns = self.calculate_stats_batch([text])
+        return {name: values[0] for name, values in columns.items()}
+    
+    def calculate_stats_batch(self, texts: Union[Sequence[str], Any]) -> Dict[str, List]:
+        """Calculate the statistics of a batch of texts, column by column
+        
+        texts is a list of cleaned texts or an Arrow string array. Sentence
+        lengths of the whole batch go into one flat array with an offsets
+        array marking where each text starts, so the sums, extremes and
+        spreads come from a few numpy reductions instead of per-text calls.
+        Returns one list per statistic (see STATS_COLUMNS), in input order;
+        texts without sentences get zeros.
+        """
+        if hasattr(texts, 'to_pylist'):
+            texts = texts.to_pylist()
+        
+        token_counts = np.zeros(len(texts), dtype=np.int64)
+        unique_tokens = np.zeros(len(texts), dtype=np.int64)
+        sentence_counts = np.zeros(len(texts), dtype=np.int64)
+        sentence_lengths = []
+        for i, text in enumerate(texts):
+            if not text:
+                continue
+            tokens = text.split()
+            token_counts[i] = len(tokens)
+            unique_tokens[i] = len(set(tokens))
+            sentences = self.sent_tokenize(text)
+            sentence_counts[i] = len(sentences)
+            sentence_lengths.extend(len(sentence.split()) for sentence in sentences)
+        
+        # Flat sentence lengths, text i owns lengths[offsets[i]:offsets[i + 1]]
+        lengths = np.array(sentence_lengths, dtype=np.int64)
+        offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        np.cumsum(sentence_counts, out=offsets[1:])
+        
+        avg_lengths = np.zeros(len(texts), dtype=np.float64)
+        max_lengths = np.zeros(len(texts), dtype=np.int64)
+        min_lengths = np.zeros(len(texts), dtype=np.int64)
+        std_lengths = np.zeros(len(texts), dtype=np.float64)
+        has_sentences = sentence_counts > 0
+        if lengths.size:
+            starts = offsets[:-1][has_sentences]
+            counts = sentence_counts[has_sentences]
+            avg_lengths[has_sentences] = np.add.reduceat(lengths, starts) / counts
+            max_lengths[has_sentences] = np.maximum.reduceat(lengths, starts)
+            min_lengths[has_sentences] = np.minimum.reduceat(lengths, starts)
+            # Two-pass standard deviation, like np.std
+            deviations = lengths - np.repeat(avg_lengths[has_sentences], counts)
+            std_lengths[has_sentences] = np.sqrt(np.add.reduceat(deviations * deviations, starts) / counts)
+        
+        # Plain Python numbers, ready for the bulk writer and the cache
+        return {
+            'token_count': token_counts.tolist(),
+            'unique_tokens': unique_tokens.tolist(),
+            'sentence_count': sentence_counts.tolist(),
+            'avg_sentence_length': avg_lengths.tolist(),
+            'max_sentence_length': max_lengths.tolist(),
+            'min_sentence_length': min_lengths.tolist(),
+            'sentence_length_std': std_lengths.tolist()
         }
+    
+    def compare_sentence_splitters(self, texts: Sequence[str]) -> Dict:
+        """Measure how often the regex splitter agrees with punkt on texts
         
-        return stats
+        Returns the share of texts where both give the same sentences and
+        where both give the same number of sentences, and the share of
+        punkt sentence boundaries the regex splitter also finds.
+        """
+        same_sentences = same_count = punkt_boundaries = found_boundaries = 0
+        texts = [text for text in texts if text]
+        for text in texts:
+            punkt_sentences = self.punkt_sent_tokenize(text)
+            regex_sentences = regex_sent_tokenize(text)
+            same_sentences += punkt_sentences == regex_sentences
+            same_count += len(punkt_sentences) == len(regex_sentences)
+            # Boundaries as word positions, so whitespace differences don't count
+            punkt_ends = set(np.cumsum([len(sentence.split()) for sentence in punkt_sentences])[:-1].tolist())
+            regex_ends = set(np.cumsum([len(sentence.split()) for sentence in regex_sentences])[:-1].tolist())
+            punkt_boundaries += len(punkt_ends)
+            found_boundaries += len(punkt_ends & regex_ends)
+        return {
+            'texts': len(texts),
+            'same_sentences': same_sentences / len(texts) if texts else None,
+            'same_sentence_count': same_count / len(texts) if texts else None,
+            'boundary_recall': found_boundaries / punkt_boundaries if punkt_boundaries else None
+        }
+    
+    def _cache_key(self, text: str, max_tokens: int = 512, stride: int = 0) -> str:
+        # The configured name, not name_or_path: that is a local path when the
+        # tokenizer comes from the artifacts dir, and must not split the cache
+        setup = TOKENIZER_NAME
+        # Stats from the regex splitter must not be served to punkt runs
+        if self.sentence_splitter != 'punkt':
+            setup = f"{setup}+{self.sentence_splitter}"
+        return PreprocessCache.make_key(text, setup, max_tokens, stride)
     
     def process_text(self, text: str, other_texts: List[str] = None) -> Dict:
         """Main function that processes text by:
@@ -115,21 +305,84 @@ class TextPreprocessor:
         4. Chunking text into 512-token segments
         5. Calculating NLP statistics
         """
+        cached = self.cache.get(self._cache_key(text)) if self.cache is not None else None
+        
         # Clean the text
-        cleaned_text = self.clean_text(text)
+        cleaned_text = cached['text'] if cached else self.clean_text(text)
         
-        # Check for duplicates if other_texts is provided
-        if other_texts and self.is_duplicate(cleaned_text, other_texts):
+        # Check for duplicates against other_texts or the shared index
+        if other_texts:
+            if self.is_duplicate(cleaned_text, other_texts):
+                return {'text': '', 'chunks': [], 'stats': {}}
+        elif self.dedup_index is not None and not self.dedup_index.add_if_unique(cleaned_text):
             return {'text': '', 'chunks': [], 'stats': {}}
         
+        if cached:
+            return cached
+        
         # Chunk the text
         chunks = self.chunk_text(cleaned_text)
         
         # Calculate statistics
         stats = self.calculate_stats(cleaned_text)
         
-        return {
+        result = {
             'text': cleaned_text,
             'chunks': chunks,
             'stats': stats
-        }
\ No newline at end of file
+        }
+        if self.cache is not None:
+            self.cache.put(self._cache_key(text), result)
+        
+        return result
+    
+    def process_texts(self, texts: List[str], max_tokens: int = 512, stride: int = 0,
+                      token_ids: bool = False) -> List[Dict]:
+        """Batch version of process_text (without the duplicate check)
+        
+        With token_ids every result also has 'token_ids', the ids of each
+        chunk; cached results without them count as misses.
+        """
+        results = [None] * len(texts)
+        
+        # Take what the cache already has
+        if self.cache is not None:
+            with stage_timer(self.metrics, 'cache_lookup', len(texts)):
+                keys = [self._cache_key(text, max_tokens, stride) for text in texts]
+                found = self.cache.get_many(keys)
+            for i, key in enumerate(keys):
+                result = found.get(key)
+                if result is not None and (not token_ids or 'token_ids' in result):
+                    results[i] = result
+        missing = [i for i, result in enumerate(results) if result is None]
+        if self.metrics is not None:
+            self.metrics.inc('cache_hits_total', len(texts) - len(missing))
+        
+        with stage_timer(self.metrics, 'clean', len(missing)):
+            cleaned_texts = self.clean_texts([texts[i] for i in missing])
+        
+        # Chunk the whole batch with a single tokenizer call
+        with stage_timer(self.metrics, 'tokenize', len(missing)):
+            all_chunks, all_ids = self.chunk_texts_with_ids(cleaned_texts, max_tokens, stride)
+        
+        with stage_timer(self.metrics, 'sentence_stats', len(missing)):
+            # Statistics of every text with chunks in one batch
+            with_chunks = [j for j, chunks in enumerate(all_chunks) if chunks]
+            columns = self.calculate_stats_batch([cleaned_texts[j] for j in with_chunks])
+            stats = [{} for _ in missing]
+            for row, j in enumerate(with_chunks):
+                stats[j] = {name: columns[name][row] for name in STATS_COLUMNS}
+            for i, cleaned_text, chunks, chunk_ids, text_stats in zip(missing, cleaned_texts, all_chunks, all_ids, stats):
+                results[i] = {
+                    'text': cleaned_text,
+                    'chunks': chunks,
+                    'stats': text_stats
+                }
+                if token_ids:
+                    results[i]['token_ids'] = chunk_ids
+        
+        if self.cache is not None and missing:
+            with stage_timer(self.metrics, 'cache_store', len(missing)):
+                self.cache.put_many({keys[i]: results[i] for i in missing})
+        
+        return results
\ No newline at end of file
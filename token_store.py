@@ -0,0 +1,215 @@
+import glob
+import logging
+import os
+import threading
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pyarrow as pa
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+# Token id types, little-endian so the bytes mean the same on every machine
+TOKEN_DTYPES = {
+    'uint16': np.dtype('<u2'),
+    'int32': np.dtype('<i4')
+}
+
+ARROW_TOKEN_TYPES = {
+    'uint16': pa.uint16(),
+    'int32': pa.int32()
+}
+
+SHARD_EXTENSION = '.tokens.arrow'
+
+# Suffix of a shard still being written; renamed away once its footer is written
+PARTIAL_SUFFIX = '.partial'
+
+def token_dtype_for(vocab_size: int) -> str:
+    """Smallest token id type for a vocabulary (uint16 up to 65536 ids)"""
+    return 'uint16' if vocab_size <= np.iinfo(np.uint16).max + 1 else 'int32'
+
+def pack_token_ids(token_ids: Sequence[int], dtype: str) -> bytes:
+    """Token ids as packed little-endian bytes (bytea in Postgres)"""
+    return np.asarray(token_ids, dtype=TOKEN_DTYPES[dtype]).tobytes()
+
+def unpack_token_ids(data: bytes, dtype: str) -> np.ndarray:
+    """Read-only view of packed token ids, without copying the bytes"""
+    return np.frombuffer(data, dtype=TOKEN_DTYPES[dtype])
+
+class TokenShardWriter:
+    """Write chunk token ids into memory-mappable Arrow IPC shards
+
+    Every shard is an uncompressed Arrow IPC file with the columns
+    content_hash, chunk_number and token_ids (a list column: one flat
+    array of ids plus an offsets array marking where each chunk starts).
+    A new shard is started after shard_rows chunks; the files are named
+    {prefix}-{number}.tokens.arrow in directory. A shard is written as
+    {name}.partial and only renamed once it is complete, so a killed run
+    never leaves an unreadable shard under the final name. Safe to call
+    from several writer threads.
+
+    Shards already in directory with the same prefix (a resumed run keeps
+    its run_id, see main.py) are kept and the numbering carries on after
+    them; close() returns them as well. They may hold chunks written after
+    the last checkpoint, which the resumed run writes again: look chunks up
+    by (content_hash, chunk_number), duplicates carry the same ids.
+    """
+
+    def __init__(self, directory: str, dtype: str = 'uint16', prefix: str = 'shard',
+                 shard_rows: int = 100000, batch_rows: int = 10000):
+        self.directory = directory
+        self.dtype = dtype
+        self.prefix = prefix
+        self.shard_rows = shard_rows
+        self.batch_rows = batch_rows
+        self.schema = pa.schema([
+            ('content_hash', pa.string()),
+            ('chunk_number', pa.int32()),
+            ('token_ids', pa.list_(ARROW_TOKEN_TYPES[dtype]))
+        ])
+        self.total_chunks = 0
+        self._writer = None
+        self._shard_chunks = 0
+        self._pending: Dict[str, list] = {'content_hash': [], 'chunk_number': [], 'token_ids': []}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # Shards of an interrupted run with this prefix; its unfinished shard is dropped
+        pattern = os.path.join(glob.escape(directory), f"{glob.escape(prefix)}-*")
+        self.paths: List[str] = sorted(glob.glob(pattern + SHARD_EXTENSION))
+        for stale in glob.glob(pattern + SHARD_EXTENSION + PARTIAL_SUFFIX):
+            os.remove(stale)
+        if self.paths:
+            logging.info(f"Continuing after {len(self.paths)} existing token shards {prefix}-*")
+
+    def _flush(self) -> None:
+        """Write the pending chunks as one record batch"""
+        if not self._pending['content_hash']:
+            return
+        ids = self._pending['token_ids']
+        offsets = np.zeros(len(ids) + 1, dtype=np.int32)
+        np.cumsum([len(chunk_ids) for chunk_ids in ids], out=offsets[1:])
+        values = np.concatenate(ids) if ids else np.array([], dtype=TOKEN_DTYPES[self.dtype])
+        batch = pa.record_batch([
+            pa.array(self._pending['content_hash'], pa.string()),
+            pa.array(self._pending['chunk_number'], pa.int32()),
+            pa.ListArray.from_arrays(pa.array(offsets), pa.array(values, ARROW_TOKEN_TYPES[self.dtype]))
+        ], schema=self.schema)
+
+        if self._writer is None:
+            path = os.path.join(self.directory, f"{self.prefix}-{len(self.paths):05d}{SHARD_EXTENSION}")
+            self._writer = pa.ipc.new_file(path + PARTIAL_SUFFIX, self.schema)
+            self.paths.append(path)
+        self._writer.write_batch(batch)
+        self._shard_chunks += len(ids)
+        self._pending = {'content_hash': [], 'chunk_number': [], 'token_ids': []}
+
+        if self._shard_chunks >= self.shard_rows:
+            self._close_shard()
+
+    def _close_shard(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            os.replace(self.paths[-1] + PARTIAL_SUFFIX, self.paths[-1])
+            logging.info(f"Token shard {self.paths[-1]} written ({self._shard_chunks} chunks)")
+            self._writer = None
+            self._shard_chunks = 0
+
+    def write(self, content_hash: str, chunk_number: int, token_ids: np.ndarray) -> None:
+        """Add the token ids of one chunk"""
+        with self._lock:
+            self._pending['content_hash'].append(content_hash)
+            self._pending['chunk_number'].append(chunk_number)
+            self._pending['token_ids'].append(np.asarray(token_ids, dtype=TOKEN_DTYPES[self.dtype]))
+            self.total_chunks += 1
+            if len(self._pending['content_hash']) >= self.batch_rows:
+                self._flush()
+
+    def write_rows(self, rows: Sequence[Dict]) -> None:
+        """Add the chunks of processed_dataset rows holding packed token_ids"""
+        for row in rows:
+            if row.get('token_ids') is not None:
+                self.write(row['content_hash'], row['chunk_number'], unpack_token_ids(row['token_ids'], self.dtype))
+
+    def close(self) -> List[str]:
+        """Write what is pending, finish the last shard and return every shard path"""
+        with self._lock:
+            self._flush()
+            self._close_shard()
+        return self.paths
+
+class TokenShardReader:
+    """Serve the chunks of one token shard straight from a memory map
+
+    Chunks are numbered in file order; reader[i] returns the token ids of
+    chunk i as a numpy view into the mapped file, so nothing is copied or
+    read before it is used. get(content_hash, chunk_number) looks a chunk
+    up by its key.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._source = pa.memory_map(path, 'r')
+        reader = pa.ipc.open_file(self._source)
+        self._batches = []
+        self._offsets = []
+        self._values = []
+        # First chunk number of every record batch
+        starts = [0]
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            token_ids = batch.column('token_ids')
+            self._batches.append(batch)
+            self._offsets.append(token_ids.offsets.to_numpy())
+            self._values.append(token_ids.values.to_numpy(zero_copy_only=True))
+            starts.append(starts[-1] + batch.num_rows)
+        self._starts = np.array(starts, dtype=np.int64)
+        self._index: Optional[Dict[Tuple[str, int], int]] = None
+
+    def __len__(self) -> int:
+        return int(self._starts[-1])
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"Chunk {i} out of range ({len(self)} chunks)")
+        batch = int(np.searchsorted(self._starts, i, side='right')) - 1
+        row = i - self._starts[batch]
+        offsets = self._offsets[batch]
+        return self._values[batch][offsets[row]:offsets[row + 1]]
+
+    def key(self, i: int) -> Tuple[str, int]:
+        """(content_hash, chunk_number) of chunk i"""
+        batch = int(np.searchsorted(self._starts, i, side='right')) - 1
+        row = int(i - self._starts[batch])
+        return (self._batches[batch].column('content_hash')[row].as_py(),
+                self._batches[batch].column('chunk_number')[row].as_py())
+
+    def get(self, content_hash: str, chunk_number: int) -> Optional[np.ndarray]:
+        """Token ids of a chunk by its key, None when the shard doesn't have it"""
+        if self._index is None:
+            # Built on the first lookup only
+            self._index = {}
+            for batch, start in zip(self._batches, self._starts):
+                hashes = batch.column('content_hash').to_pylist()
+                numbers = batch.column('chunk_number').to_pylist()
+                for row, key in enumerate(zip(hashes, numbers)):
+                    self._index[key] = int(start) + row
+        i = self._index.get((content_hash, chunk_number))
+        return self[i] if i is not None else None
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        for offsets, values in zip(self._offsets, self._values):
+            for row in range(len(offsets) - 1):
+                yield values[offsets[row]:offsets[row + 1]]
+
+    def close(self) -> None:
+        self._source.close()
+
+def open_token_shards(directory: str) -> List[TokenShardReader]:
+    """Readers for every token shard in directory, in name order"""
+    return [TokenShardReader(path) for path in sorted(glob.glob(os.path.join(directory, f"*{SHARD_EXTENSION}")))]
@@ -0,0 +1,224 @@
+import logging
+import os
+import socket
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+import pandas as pd
+from sqlalchemy import text
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+def default_worker_id() -> str:
+    """Host name and pid, unique per container replica"""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+def in_shard(position: int, num_shards: int, shard_index: int) -> bool:
+    """Whether the source row at position belongs to shard shard_index of num_shards"""
+    return num_shards <= 1 or position % num_shards == shard_index
+
+def select_shard_rows(df: pd.DataFrame, offset: int, num_shards: int, shard_index: int) -> pd.DataFrame:
+    """Rows of df (starting at source position offset) that belong to the shard"""
+    if num_shards <= 1:
+        return df
+    first = (shard_index - offset) % num_shards
+    return df.iloc[first::num_shards]
+
+class WorkQueue:
+    """Row ranges of a job leased to workers through a Postgres table
+
+    Every worker plans the same ranges (only the first one inserts them),
+    then repeatedly leases a range with SELECT ... FOR UPDATE SKIP LOCKED,
+    so concurrent workers never get the same range and never wait for each
+    other. A lease expires lease_seconds after the last heartbeat; expired
+    leases of crashed workers are handed out again by lease(). Ranges have
+    to be safe to process twice (the pipeline skips rows already loaded).
+    """
+
+    def __init__(self, engine: Any, worker_id: Optional[str] = None, lease_seconds: int = 120):
+        self.engine = engine
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_seconds = lease_seconds
+
+    def create_table(self) -> None:
+        """Create the work queue table if it doesn't exist"""
+        create_table_query = text("""
+        CREATE TABLE IF NOT EXISTS pipeline_work_ranges (
+            job_id TEXT NOT NULL,
+            range_start BIGINT NOT NULL,
+            range_end BIGINT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            worker_id TEXT,
+            lease_expires_at TIMESTAMP,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            rows_written BIGINT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (job_id, range_start)
+        );
+        CREATE INDEX IF NOT EXISTS idx_work_ranges_status ON pipeline_work_ranges(job_id, status);
+        """)
+        with self.engine.connect() as conn:
+            conn.execute(create_table_query)
+            conn.commit()
+
+    def plan(self, job_id: str, total_rows: int, range_rows: int) -> int:
+        """Split rows [0, total_rows) into ranges of range_rows; return how many were new
+
+        Ranges that already exist are kept, so every worker can call this.
+        """
+        query = text("""
+        INSERT INTO pipeline_work_ranges (job_id, range_start, range_end)
+        SELECT :job_id, range_start, LEAST(range_start + :range_rows, :total_rows)
+        FROM generate_series(0, :total_rows - 1, :range_rows) AS range_start
+        ON CONFLICT (job_id, range_start) DO NOTHING
+        """)
+        with self.engine.connect() as conn:
+            created = conn.execute(query, {
+                'job_id': job_id, 'total_rows': total_rows, 'range_rows': range_rows
+            }).rowcount
+            conn.commit()
+        if created:
+            logging.info(f"Planned {created} ranges of {range_rows} rows for job {job_id}")
+        return created
+
+    def lease(self, job_id: str) -> Optional[Tuple[int, int]]:
+        """Lease the next pending (or expired) range, None when there is none left"""
+        query = text("""
+        UPDATE pipeline_work_ranges
+        SET status = 'leased', worker_id = :worker_id, attempts = attempts + 1,
+            lease_expires_at = CURRENT_TIMESTAMP + :lease_seconds * INTERVAL '1 second',
+            updated_at = CURRENT_TIMESTAMP
+        WHERE (job_id, range_start) IN (
+            SELECT job_id, range_start FROM pipeline_work_ranges
+            WHERE job_id = :job_id
+              AND (status = 'pending' OR (status = 'leased' AND lease_expires_at < CURRENT_TIMESTAMP))
+            ORDER BY range_start
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING range_start, range_end, attempts
+        """)
+        with self.engine.connect() as conn:
+            row = conn.execute(query, {
+                'job_id': job_id, 'worker_id': self.worker_id, 'lease_seconds': self.lease_seconds
+            }).first()
+            conn.commit()
+        if row is None:
+            return None
+        range_start, range_end, attempts = row
+        if attempts > 1:
+            logging.warning(f"Reclaimed expired range [{range_start}, {range_end}) of job {job_id} (attempt {attempts})")
+        return range_start, range_end
+
+    def heartbeat(self, job_id: str, range_start: int) -> bool:
+        """Extend the lease of a range; False when it was lost to another worker"""
+        query = text("""
+        UPDATE pipeline_work_ranges
+        SET lease_expires_at = CURRENT_TIMESTAMP + :lease_seconds * INTERVAL '1 second',
+            updated_at = CURRENT_TIMESTAMP
+        WHERE job_id = :job_id AND range_start = :range_start
+          AND worker_id = :worker_id AND status = 'leased'
+        """)
+        with self.engine.connect() as conn:
+            updated = conn.execute(query, {
+                'job_id': job_id, 'range_start': range_start,
+                'worker_id': self.worker_id, 'lease_seconds': self.lease_seconds
+            }).rowcount
+            conn.commit()
+        return updated > 0
+
+    def complete(self, job_id: str, range_start: int, rows_written: int) -> bool:
+        """Mark a leased range as done; False when the lease was lost meanwhile"""
+        query = text("""
+        UPDATE pipeline_work_ranges
+        SET status = 'done', rows_written = :rows_written, lease_expires_at = NULL,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE job_id = :job_id AND range_start = :range_start
+          AND worker_id = :worker_id AND status = 'leased'
+        """)
+        with self.engine.connect() as conn:
+            updated = conn.execute(query, {
+                'job_id': job_id, 'range_start': range_start,
+                'worker_id': self.worker_id, 'rows_written': rows_written
+            }).rowcount
+            conn.commit()
+        return updated > 0
+
+    def release(self, job_id: str, range_start: int) -> None:
+        """Give a leased range back (e.g. after an error) so another worker takes it now"""
+        query = text("""
+        UPDATE pipeline_work_ranges
+        SET status = 'pending', worker_id = NULL, lease_expires_at = NULL, updated_at = CURRENT_TIMESTAMP
+        WHERE job_id = :job_id AND range_start = :range_start
+          AND worker_id = :worker_id AND status = 'leased'
+        """)
+        with self.engine.connect() as conn:
+            conn.execute(query, {'job_id': job_id, 'range_start': range_start, 'worker_id': self.worker_id})
+            conn.commit()
+
+    def progress(self, job_id: str) -> Dict[str, int]:
+        """Number of ranges per status"""
+        query = text("""
+        SELECT status, COUNT(*) FROM pipeline_work_ranges WHERE job_id = :job_id GROUP BY status
+        """)
+        with self.engine.connect() as conn:
+            return {status: count for status, count in conn.execute(query, {'job_id': job_id})}
+
+    def reset(self, job_id: str) -> None:
+        """Forget the ranges of a job so it is planned and processed again
+
+        Refused while a range of the job is leased and the lease hasn't
+        expired: workers are still running it.
+        """
+        with self.engine.connect() as conn:
+            active = conn.execute(text("""
+            SELECT COUNT(*) FROM pipeline_work_ranges
+            WHERE job_id = :job_id AND status = 'leased' AND lease_expires_at >= CURRENT_TIMESTAMP
+            """), {'job_id': job_id}).scalar()
+            if active:
+                raise RuntimeError(
+                    f"Job {job_id} has {active} ranges leased by running workers, stop them before resetting it"
+                )
+            conn.execute(text("DELETE FROM pipeline_work_ranges WHERE job_id = :job_id"), {'job_id': job_id})
+            conn.commit()
+        logging.info(f"Work ranges reset for job {job_id}")
+
+class LeaseHeartbeat:
+    """Context manager sending heartbeats for a leased range from a daemon thread
+
+    A heartbeat is sent every lease_seconds / 3. When the lease is lost
+    (the worker stalled past the expiry and another worker took the range)
+    lost is set and a warning logged; the work may go on, reprocessing is
+    harmless, but complete() will then return False.
+    """
+
+    def __init__(self, work_queue: WorkQueue, job_id: str, range_start: int):
+        self.work_queue = work_queue
+        self.job_id = job_id
+        self.range_start = range_start
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='lease-heartbeat', daemon=True)
+
+    def _run(self) -> None:
+        interval = max(self.work_queue.lease_seconds / 3, 1)
+        while not self._stop.wait(interval):
+            try:
+                if not self.work_queue.heartbeat(self.job_id, self.range_start):
+                    self.lost = True
+                    logging.warning(f"Lost the lease of range {self.range_start} of job {self.job_id}")
+                    return
+            except Exception as e:
+                # A missed heartbeat only matters once the lease expires
+                logging.error(f"Heartbeat failed: {str(e)}")
+
+    def __enter__(self) -> 'LeaseHeartbeat':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stop.set()
+        self._thread.join()